@@ -1,14 +1,24 @@
 import asyncio
+import atexit
 import json
+import heapq
 import os
-import random
-from typing import List
+import re
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows. The journal is not locked, only one process may write the cache there
+    fcntl = None
 
 from telethon import TelegramClient, utils as tutils
 from telethon.errors import ChannelPrivateError, FloodWaitError
 
 from telethon.hints import EntityLike
-from telethon.tl.types import InputPeerChannel, InputPeerSelf
+from telethon.tl.functions.channels import GetChannelsRequest
+from telethon.tl.types import InputPeerChannel, InputPeerSelf, InputChannel
 
 import logging
 
@@ -17,7 +27,76 @@ from src.common.get_project_root import get_project_root
 logger = logging.getLogger(__name__)
 
 CHANNEL_CACHE_FILEPATH = 'src/data/channels_cache.json'
-CHANNEL_RESTORE_REQUEST_PROB = 1/5000
+# another process (e.g. the bot) may rewrite the cache. Its modification time is checked at most this often
+CHANNEL_REGISTRY_CHECK_INTERVAL_SEC = 60
+CHANNEL_RESOLVE_BATCH_SIZE = 100  # channels per GetChannelsRequest
+CHANNEL_CACHE_JOURNAL_SUFFIX = '.journal.jsonl'  # changes since the last snapshot, next to CHANNEL_CACHE_FILEPATH
+CHANNEL_JOURNAL_FLUSH_INTERVAL_SEC = 5
+CHANNEL_JOURNAL_COMPACT_ENTRIES = 1000
+# scheme and host, then the path: '+HASH' or 'joinchat/HASH' for invite links, whose hashes are case-sensitive
+_CHANNEL_LINK_RE = re.compile(r'^(?P<prefix>(?:https?://)?(?:www\.)?(?:t|telegram)\.me/)(?P<path>.*)$', re.IGNORECASE)
+
+
+class ChannelRecord:
+    """
+    Immutable cached fields of a channel. `ChannelRegistry` keeps one record per channel ID and replaces it only when
+    the fields change, so everything restored from the cache shares the same record objects.
+
+    Attributes
+    ----------
+    id : int
+    name : Optional[str]
+    link : Optional[str]
+    is_public : Optional[bool]
+    updated_at : Optional[float]
+        Time of the last request of the fields, None if they never were requested.
+    """
+
+    __slots__ = ('id', 'name', 'link', 'is_public', 'updated_at')
+
+    def __init__(self, channel_id: int, name: Optional[str], link: Optional[str], is_public: Optional[bool],
+                 updated_at: Optional[float] = None):
+        object.__setattr__(self, 'id', channel_id)
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'link', link)
+        object.__setattr__(self, 'is_public', is_public)
+        object.__setattr__(self, 'updated_at', updated_at)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    @classmethod
+    def from_dict(cls, channel_id: int, v: dict) -> 'ChannelRecord':
+        """From the fields as they are stored in the cache files"""
+        return cls(channel_id, v['username'], v['invite_link'], v['is_public'], v.get('updated_at'))
+
+    def to_dict(self) -> dict:
+        return {'id': self.id, 'username': self.name, 'invite_link': self.link, 'is_public': self.is_public,
+                'updated_at': self.updated_at}
+
+    def _fields(self) -> tuple:
+        return self.id, self.name, self.link, self.is_public, self.updated_at
+
+    def __eq__(self, other):
+        if isinstance(other, ChannelRecord):
+            return self._fields() == other._fields()
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def _is_complete(self) -> bool:
+        """Whether a channel restored from the record wouldn't need a request"""
+        return self.name is not None and (self.link is not None or self.is_public == False)
+
+    def __str__(self):
+        return _channel_str(self)
+
+    def __repr__(self):
+        return f"""ChannelRecord(id={self.id}, name="{self.name}", link="{self.link}", public={self.is_public}, updated_at={self.updated_at})"""
 
 
 class Channel:
@@ -65,6 +144,12 @@ class Channel:
 
     Methods
     -------
+    async create(...) -> Channel
+        The same as the constructor with restore_values=True, for running coroutines.
+    from_record(record: ChannelRecord, ...) -> Channel
+        A channel with the cached fields, without any parsing or restoring.
+    async restore()
+        Restores channel information from the cache and, if needed, via requests (see `resolve_channels`).
     async _restore_via_request()
         Restores channel information by making API requests.
     get_input_entity_offline(peer: EntityLike) -> InputPeerChannel
@@ -73,6 +158,9 @@ class Channel:
         Restores the channel information from a local cache.
     """
 
+    __slots__ = ('_client', 'parsable', 'id', 'name', 'link', 'input_entity', 'is_public', 'restore_values',
+                 'force_update')
+
     def __init__(self, parsable=None, channel_id=None, channel_name=None, channel_link=None,
                  is_public=None, restore_values=True, force_update=False, client: TelegramClient=None):
 
@@ -93,28 +181,10 @@ class Channel:
             self.initialize_from_parsable()
 
         if restore_values:
-            if not (self.id is None and self.link is None):  # here we do not do any difference for public and private
-                # old values may still be useful. Example: we knew link and ID but session got lost. The session can
-                # be refreshed if link is still working
-                asyncio.get_event_loop().run_until_complete(self._restore_from_cache())
-
-            # TODO: maybe launch once in a while to refresh values if there are remaining calls for today?
+            # the cached values are refreshed in the background by `ChannelRefresher`
             # TODO: let get_entity work with any input and extract id, link and name after?
-            # TODO: optimize
-            # TODO: add 'update_date' to the storage
-            # no link and public=True - infer
-            # no link and private=False - no infer
-            # no link and unk=None - infer
-            random_float = random.random()
-            if random_float < CHANNEL_RESTORE_REQUEST_PROB:
-                logger.info(f"Performing a random channel restoration with a probability of {CHANNEL_RESTORE_REQUEST_PROB}")
-                asyncio.get_event_loop().run_until_complete(self._restore_via_request())
-            else:
-                if self.force_update \
-                        or self.id is None \
-                        or self.name is None \
-                        or (self.link is None and (self.is_public != False)):
-                    asyncio.get_event_loop().run_until_complete(self._restore_via_request())
+            # inside running coroutines use `Channel.create` or `resolve_channels` instead
+            asyncio.get_event_loop().run_until_complete(self.restore())
 
         # if self.id is None and self.link is None:
             # raise ValueError(f'Either id or link has to be provided to specify a channel\n{self}')
@@ -127,6 +197,59 @@ class Channel:
 
     # await self._client._get_entity_from_string(x)
 
+    @classmethod
+    async def create(cls, parsable=None, channel_id=None, channel_name=None, channel_link=None, is_public=None,
+                     force_update=False, client: TelegramClient = None) -> 'Channel':
+        """The same as the constructor with ``restore_values=True``, but doesn't block the running event loop"""
+        channel = cls(parsable=parsable, channel_id=channel_id, channel_name=channel_name, channel_link=channel_link,
+                      is_public=is_public, restore_values=False, force_update=force_update, client=client)
+        channel.restore_values = True
+        await channel.restore()
+        return channel
+
+    @classmethod
+    def from_record(cls, record: ChannelRecord, client: TelegramClient = None, force_update=False) -> 'Channel':
+        """A channel with the fields of the cached record. The link of a record is already checked"""
+        channel = cls.__new__(cls)
+        channel._client = client
+        channel.parsable = None
+        channel.input_entity = None
+        channel.restore_values = False
+        channel.force_update = force_update
+        channel._apply_record(record)
+        return channel
+
+    def _apply_record(self, record: ChannelRecord):
+        self.id = record.id
+        self.name = record.name
+        self.link = record.link
+        self.is_public = record.is_public
+
+    async def restore(self):
+        """Restores the fields from the cache and requests them if they are still missing"""
+        await resolve_channels([self], self._client)
+
+    def _is_identifiable(self) -> bool:
+        return not (self.id is None and self.link is None and self.input_entity is None and not self.parsable)
+
+    def _needs_request(self) -> bool:
+        # no link and public=True - infer
+        # no link and private=False - no infer
+        # no link and unk=None - infer
+        return self.force_update \
+            or self.id is None \
+            or self.name is None \
+            or (self.link is None and (self.is_public != False))
+
+    def _apply_entity(self, entity):
+        """Takes the fields from a channel entity"""
+        self.id = int('-100' + str(entity.id))
+        self.name = tutils.get_display_name(entity)
+        username = getattr(entity, 'username', None)
+        self.link = f"https://t.me/{username}" if username else None
+        self.is_public = self.link is not None
+        logger.info(f"Restored {self!r} via a batch request")
+
     def initialize_from_parsable(self):
         # here entity may be already in the cache but of not known type (ID, link) so the goal here is to define
         # the entity type and decide what kind of processing is needed. Instead of parsing ourselves, we can get
@@ -178,8 +301,7 @@ class Channel:
                 self.is_public = True
 
             logger.info(f"Restored {self. __repr__()} via request for client with ID: {self._client._self_id}")
-            channels = get_channels(restore_values=False)
-            update_channels(channels, self)
+            channel_registry.update(self, requested=True)
 
     def get_input_entity_offline(self, peer: EntityLike) -> InputPeerChannel:
         """
@@ -244,25 +366,13 @@ class Channel:
         -------
 
         """
-        channels = get_channels(restore_values=False)
-
-        id_match, link_match = [], []
-        for ch in channels:
-            if self.id is not None and ch.id == self.id:
-                id_match.append(ch)
-            elif self.link is not None and ch.link == self.link:  # for private channels link is None
-                logger.info(f'Found cached link while not having ID passed: {ch}')
-                link_match.append(ch)
-
-        matches = id_match + link_match
-        if len(matches) == 0:
+        cached_channel = channel_registry.find(channel_id=self.id, channel_link=self.link)
+        if cached_channel is None:
             logger.error(f"{self!r} not found in cache")
         else:
-            cached_channel = matches[0]
-            self.id = cached_channel.id
-            self.name = cached_channel.name
-            self.link = cached_channel.link
-            self.is_public = cached_channel.is_public  # we may not know if the channel if public knowing only fragments
+            if cached_channel.id != self.id:
+                logger.info(f'Found cached link while not having ID passed: {cached_channel}')
+            self._apply_record(cached_channel)  # we may not know if the channel if public knowing only fragments
             logger.log(5, f"Restored {self!r} from cache")
 
     def __eq__(self, other):
@@ -275,12 +385,7 @@ class Channel:
     def __str__(self):
         # TODO: consider something more readable. To show to user?
         # return f"""Channel(id={self.id}, name="{self.name}", link="{self.link}", public={self.is_public})"""
-        if self.link is not None:
-            return self.link.replace('https://t.me/', '@')
-        elif self.name is not None:
-            return self.name
-        else:
-            return str(self.id)
+        return _channel_str(self)
 
     def __repr__(self):
         return f"""Channel(id={self.id}, name="{self.name}", link="{self.link}", public={self.is_public}, parsable={self.parsable})"""
@@ -289,6 +394,16 @@ class Channel:
         return hash(self.id)
 
 
+def _channel_str(channel) -> str:
+    """Readable name of a `Channel` or a `ChannelRecord`"""
+    if channel.link is not None:
+        return channel.link.replace('https://t.me/', '@')
+    elif channel.name is not None:
+        return channel.name
+    else:
+        return str(channel.id)
+
+
 # TODO: check that it's a link
 def check_channel_link_correctness(channel_link: str) -> str:
     """
@@ -411,15 +526,448 @@ async def get_channel_id(client: TelegramClient, entity) -> int:
     return int('-100' + str(entity.channel_id))
 
 
-def save_channels(channels_list: List[Channel]):
-    root = get_project_root()
-    path = os.path.join(root, CHANNEL_CACHE_FILEPATH)
+def normalize_channel_link(channel_link: Optional[str]) -> Optional[str]:
+    """Usernames are case-insensitive, so are the links to them. Hashes of the invite links are not"""
+    if channel_link is None:
+        return None
+    channel_link = channel_link.rstrip('/')
+    match = _CHANNEL_LINK_RE.match(channel_link)
+    if match is None:
+        return channel_link.lower()
+    prefix, path = match.group('prefix').lower(), match.group('path')
+    if path.startswith('+'):
+        return prefix + path
+    if path.lower().startswith('joinchat/'):
+        return prefix + 'joinchat/' + path[len('joinchat/'):]
+    return channel_link.lower()
+
+
+def _write_atomically(path: str, text: str):
+    """Writes a temporary file next to ``path`` and renames it, so ``path`` is never left truncated"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'  # another process may be writing the same path
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _get_file_signature(path: str) -> Optional[tuple]:
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except FileNotFoundError:
+        return None
+
+
+class ChannelRegistry:
+    """
+    Process-wide copy of the channels cache indexed by channel ID and by normalized link, so restoring a `Channel`
+    from the cache is a dict lookup.
+
+    The cache is a snapshot file and an append-only journal of the later changes. Changes are applied in memory at
+    once and written behind: `flush` appends them to the journal, one line per changed channel however many times it
+    changed. Once `start` is awaited, a background task flushes every ``flush_interval`` seconds and folds the
+    journal into the snapshot when it has ``compact_entries`` lines. Without it every change is flushed right away.
+    The snapshot is only ever replaced atomically, and a torn last journal line is skipped on load, so a crash loses
+    at most the unflushed changes.
+
+    Another process (e.g. the bot) may change the cache as well. The files are checked for that at most every
+    ``check_interval`` seconds and before every write, and reloaded if they were changed. Appends, compactions and
+    saves hold an exclusive lock of a file next to the journal, so no process appends to a journal being folded.
 
-    with open(path, 'w') as f:
-        json.dump({str(ch.id): {"username": ch.name, "invite_link": ch.link, 'is_public': ch.is_public} for ch in
-                   channels_list}, f)
+    Parameters
+    ----------
+    path : str
+        Path to the snapshot file. The journal is next to it.
+    check_interval : float
+        Seconds between checks of the files for the changes of other processes.
+    flush_interval : float
+        Seconds between flushes of the background task.
+    compact_entries : int
+        Journal lines after which the journal is folded into the snapshot.
+    """
+
+    def __init__(self, path: str = None, check_interval=CHANNEL_REGISTRY_CHECK_INTERVAL_SEC,
+                 flush_interval=CHANNEL_JOURNAL_FLUSH_INTERVAL_SEC, compact_entries=CHANNEL_JOURNAL_COMPACT_ENTRIES):
+        self.path = path or os.path.join(get_project_root(), CHANNEL_CACHE_FILEPATH)
+        self.journal_path = f'{os.path.splitext(self.path)[0]}{CHANNEL_CACHE_JOURNAL_SUFFIX}'
+        # the journal being folded into the snapshot. Replayed as well if a compaction was interrupted
+        self.compacting_journal_path = f'{self.journal_path}.compacting'
+        self.lock_path = f'{self.journal_path}.lock'  # never renamed, unlike the journal
+        self.check_interval = check_interval
+        self.flush_interval = flush_interval
+        self.compact_entries = compact_entries
+        self._by_id: Dict[int, ChannelRecord] = {}
+        self._by_link: Dict[str, int] = {}  # normalized link -> channel ID
+        # channel ID -> record (None if removed) not in the journal yet
+        self._dirty: Dict[int, Optional[ChannelRecord]] = {}
+        self._journal_entries = 0
+        self._signature = None  # of the files as they were loaded or written by this process
+        self._checked_at = None
+        self._flush_task = None
+        self._compacting = False  # the lock is held by `compact` of this process
+        self.exists = False  # whether the cache files exist
+        atexit.register(self.flush)
+
+    @contextmanager
+    def _lock(self):
+        """Exclusive lock of the journal between the processes"""
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _get_signature(self) -> tuple:
+        return tuple(_get_file_signature(path) for path in (self.path, self.compacting_journal_path,
+                                                            self.journal_path))
+
+    def _ensure_loaded(self, force_check=False):
+        now = time.monotonic()
+        if not force_check and self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        signature = self._get_signature()
+        if signature != self._signature:
+            self._load(signature)
+
+    def _load(self, signature: tuple):
+        self._by_id, self._by_link = {}, {}
+        self._journal_entries = 0
+        self._signature = signature
+        self.exists = any(file_signature is not None for file_signature in signature)
+        if signature[0] is not None:
+            with open(self.path, 'r', encoding='utf-8-sig') as f:
+                # "id" : {"username": username, "invite_link": invite_link}.
+                data = json.load(f)
+            for ch_id, v in data.items():
+                self._index(ChannelRecord.from_dict(int(ch_id), v))  # a la deserializer
+        for journal_path in (self.compacting_journal_path, self.journal_path):
+            if os.path.exists(journal_path):
+                self._replay(journal_path)
+        for ch_id, record in self._dirty.items():  # not written yet, so newer than anything in the files
+            if record is None:
+                self._unindex(ch_id)
+            else:
+                self._index(record)
+        logger.log(7, f"Channel registry is loaded with {len(self._by_id)} channel(s), "
+                      f"{self._journal_entries} journal entries")
+
+    def _replay(self, journal_path: str):
+        with open(journal_path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # the last line may be torn by a crash
+                    logger.warning(f"Skipped a broken line of {journal_path}: {line!r}")
+                    continue
+                if entry.get('removed'):
+                    self._unindex(entry['id'])
+                else:
+                    self._index(ChannelRecord.from_dict(entry['id'], entry))
+                self._journal_entries += 1
+
+    def _index(self, record: ChannelRecord) -> ChannelRecord:
+        """Puts the record instead of the one with its ID. Returns the indexed record: the old one if it is the same"""
+        old = self._by_id.get(record.id)
+        if old == record:  # e.g. replayed over the snapshot. Not to keep two equal records alive
+            return old
+        if old is not None and old.link is not None:
+            self._by_link.pop(normalize_channel_link(old.link), None)
+        self._by_id[record.id] = record
+        if record.link is not None:  # for private channels link is None
+            self._by_link[normalize_channel_link(record.link)] = record.id
+        return record
+
+    def _unindex(self, ch_id: int):
+        old = self._by_id.pop(ch_id, None)
+        if old is not None and old.link is not None:
+            if self._by_link.get(normalize_channel_link(old.link)) == ch_id:
+                del self._by_link[normalize_channel_link(old.link)]
+
+    def find(self, channel_id: int = None, channel_link: str = None) -> Optional[ChannelRecord]:
+        """Cached fields of the channel with the ID or, if there is no such ID, with the link. None if not found"""
+        self._ensure_loaded()
+        if channel_id is not None and channel_id in self._by_id:
+            return self._by_id[channel_id]
+        if channel_link is not None:
+            ch_id = self._by_link.get(normalize_channel_link(channel_link))
+            if ch_id is not None:
+                return self._by_id[ch_id]
+        return None
+
+    def flush(self):
+        """Appends the changes made since the last flush to the journal"""
+        if not self._dirty or self._compacting:  # the changes are flushed after the compaction
+            return
+        try:
+            # the journal is opened under the lock: a compaction may have just moved it aside
+            with self._lock():
+                self._ensure_loaded(force_check=True)  # keeps the changes of another process
+                lines = ''.join(json.dumps({'id': ch_id, 'removed': True} if record is None else record.to_dict())
+                                + '\n' for ch_id, record in self._dirty.items())
+                with open(self.journal_path, 'ab+') as f:
+                    if f.tell() > 0:
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b'\n':  # torn by a crash. Not to glue the first line to it
+                            lines = '\n' + lines
+                    f.write(lines.encode('utf-8'))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._signature = self._get_signature()  # our own write doesn't need a reload
+        except:
+            logger.error(f"Failed to flush {len(self._dirty)} channel(s) to the journal", exc_info=True)
+            return
+        self._journal_entries += len(self._dirty)
+        logger.log(5, f"Flushed {len(self._dirty)} channel(s) to the journal")
+        self._dirty = {}
+        self.exists = True
+
+    def _dump_snapshot(self) -> str:
+        return json.dumps({str(ch_id): {"username": r.name, "invite_link": r.link, 'is_public': r.is_public,
+                                        'updated_at': r.updated_at}
+                           for ch_id, r in self._by_id.items()})
+
+    async def compact(self):
+        """
+        Folds the journal into the snapshot. The snapshot is written outside of the event loop, the other processes
+        wait for the lock to append meanwhile
+        """
+        self.flush()
+        if self._compacting:
+            return
+        self._compacting = True
+        try:
+            with self._lock():
+                if not os.path.exists(self.journal_path) and not os.path.exists(self.compacting_journal_path):
+                    return
+                if not os.path.exists(self.compacting_journal_path):  # otherwise a compaction was interrupted
+                    os.replace(self.journal_path, self.compacting_journal_path)
+                self._ensure_loaded(force_check=True)  # the entries appended by others since the last load
+                snapshot = self._dump_snapshot()
+                await asyncio.get_running_loop().run_in_executor(None, _write_atomically, self.path, snapshot)
+                os.remove(self.compacting_journal_path)
+                self._signature = None
+                self._ensure_loaded(force_check=True)
+        finally:
+            self._compacting = False
+        logger.debug(f'compacted channels cache: {len(self._by_id)} channel(s)')
+        self.flush()  # the changes made during the compaction
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if self._journal_entries >= self.compact_entries:
+                    await self.compact()
+            except:
+                logger.error("Failed to write the channels cache", exc_info=True)
+
+    async def start(self):
+        """Starts writing the changes behind in the background"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        self.flush()
+
+    def save(self):
+        """Writes all the channels as a new snapshot and drops the journal"""
+        if self._compacting:  # the lock is held by this process until the compaction ends
+            raise RuntimeError("Can't save the channels cache while it is being compacted")
+        with self._lock():
+            _write_atomically(self.path, self._dump_snapshot())
+            for journal_path in (self.compacting_journal_path, self.journal_path):
+                if os.path.exists(journal_path):
+                    os.remove(journal_path)
+            self._signature = self._get_signature()
+        self._dirty = {}
+        self._journal_entries = 0
+        self.exists = True
         logger.debug('saved channels cache')
 
+    def set_channels(self, channels_list: List['Channel']):
+        """Replaces all the channels and saves them"""
+        self._by_id, self._by_link = {}, {}
+        for ch in channels_list:
+            self._index(ChannelRecord(ch.id, ch.name, ch.link, ch.is_public))
+        self.save()
+
+    def update(self, target_ch: 'Channel', add_not_remove=True, requested=False) -> bool:
+        """
+        Adds, replaces (by ID) or removes the channel. Returns True if anything changed. ``requested`` means the
+        fields were just requested, so the channel is fresh even if they didn't change.
+        """
+        return self.update_many([target_ch], add_not_remove=add_not_remove, requested=requested) > 0
+
+    def update_many(self, channels: List['Channel'], add_not_remove=True, requested=False) -> int:
+        """The same as `update` for several channels. Returns the number of the changed ones"""
+        self._ensure_loaded()
+        changed = sum(self._update(target_ch, add_not_remove, requested) for target_ch in channels)
+        if changed and self._flush_task is None:  # nothing would write them behind
+            self.flush()
+        return changed
+
+    def _update(self, target_ch: 'Channel', add_not_remove: bool, requested: bool) -> bool:
+        old = self._by_id.get(target_ch.id)
+        if add_not_remove:
+            fields_are_same = old is not None and (old.name, old.link, old.is_public) == \
+                (target_ch.name, target_ch.link, target_ch.is_public)
+            if fields_are_same and not requested:
+                logger.log(7, f'Tried to cache already cached {target_ch}')
+                return False
+            updated_at = time.time() if requested else (old.updated_at if old is not None else None)
+            record = self._index(ChannelRecord(target_ch.id, target_ch.name, target_ch.link, target_ch.is_public,
+                                               updated_at))
+            if fields_are_same:
+                logger.log(7, f'Refreshed cached {target_ch}')
+            elif old is not None:
+                logger.info(f'Cached {target_ch}\ninstead of outdated {old}\nNow have {len(self)} channels cached')
+            else:
+                logger.info(f'Cached a new {target_ch}. Now have {len(self)} channels cached')
+            self._dirty[target_ch.id] = record
+        else:
+            if old is None:
+                return False
+            self._unindex(target_ch.id)
+            self._dirty[target_ch.id] = None
+        return True
+
+    def get_stalest(self, n: int, older_than: float = None) -> List[ChannelRecord]:
+        """
+        Up to ``n`` cached channels requested the longest time ago (never requested first), only the ones requested
+        more than ``older_than`` seconds ago if given
+        """
+        self._ensure_loaded()
+        candidates = self._by_id.values()
+        if older_than is not None:
+            threshold = time.time() - older_than
+            candidates = [r for r in candidates if (r.updated_at or 0) < threshold]
+        return heapq.nsmallest(n, candidates, key=lambda r: r.updated_at or 0)
+
+    def get_records(self) -> List[ChannelRecord]:
+        """All the cached channels as the shared immutable records"""
+        self._ensure_loaded()
+        return list(self._by_id.values())
+
+    def get_channels(self, restore_values=False) -> List['Channel']:
+        channels = [Channel.from_record(record) for record in self.get_records()]
+        if restore_values:  # the fields come from the cache already. Only the incomplete ones are requested
+            asyncio.get_event_loop().run_until_complete(resolve_channels(channels, None))
+        return channels
+
+    def __contains__(self, ch_id: int):
+        self._ensure_loaded()
+        return ch_id in self._by_id
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._by_id)
+
+
+async def resolve_channels(channels: List[Channel], client: TelegramClient,
+                           batch_size=CHANNEL_RESOLVE_BATCH_SIZE) -> List[Channel]:
+    """
+    Restores the fields of the channels from the cache and requests the rest at once. Channels whose input entity is
+    known (from the session, without a request) are requested with one GetChannelsRequest per ``batch_size`` of
+    them, each ID once. Only the others, e.g. known by a link only, are requested one by one. A channel which fails
+    to be requested (e.g. its link is dead) is logged and left as it is, only FloodWaitError is raised.
+    Safe to call from running coroutines. Returns ``channels``.
+    """
+    to_request = []
+    for ch in channels:
+        if not (ch.id is None and ch.link is None):  # here we do not do any difference for public and private
+            # old values may still be useful. Example: we knew link and ID but session got lost. The session can
+            # be refreshed if link is still working
+            await ch._restore_from_cache()
+        if ch._is_identifiable() and ch._needs_request():
+            to_request.append(ch)
+    if not to_request:
+        return channels
+    if client is None:
+        raise ValueError(f'TelegramClient has to be passed to perform a force update. {to_request[0]!r}')
+
+    by_channel_id: Dict[int, tuple] = {}  # channel ID without -100 -> (input peer, channels)
+    one_by_one = []
+    for ch in to_request:
+        input_peer = ch.input_entity
+        if input_peer is None and ch.id is not None:
+            try:
+                input_peer = await client.get_input_entity(ch.id)  # from the session
+            except ValueError:
+                pass
+        if isinstance(input_peer, InputPeerChannel):
+            by_channel_id.setdefault(input_peer.channel_id, (input_peer, []))[1].append(ch)
+        else:
+            one_by_one.append(ch)
+
+    channel_ids = list(by_channel_id)
+    for start in range(0, len(channel_ids), batch_size):
+        chunk = channel_ids[start:start + batch_size]
+        try:
+            result = await client(GetChannelsRequest(id=[InputChannel(by_channel_id[channel_id][0].channel_id,
+                                                                      by_channel_id[channel_id][0].access_hash)
+                                                         for channel_id in chunk]))
+        except FloodWaitError as e:
+            logger.info(f'Got FloodWaitError caused by GetChannelsRequest. Have to sleep {e.seconds} seconds')
+            raise
+        except:
+            logger.error(f'Failed to request {len(chunk)} channel(s) at once. Requesting them one by one',
+                         exc_info=True)
+            one_by_one.extend(ch for channel_id in chunk for ch in by_channel_id[channel_id][1])
+            continue
+        logger.debug(f'Requested {len(chunk)} channel(s) at once, got {len(result.chats)}')
+        restored = []
+        for entity in result.chats:
+            for ch in by_channel_id.get(entity.id, (None, []))[1]:
+                ch._apply_entity(entity)
+                restored.append(ch)
+        channel_registry.update_many(restored, requested=True)
+
+    for ch in one_by_one:
+        try:
+            await ch._restore_via_request()
+        except FloodWaitError as e:
+            logger.info(f'Got FloodWaitError while restoring {ch!r}. Have to sleep {e.seconds} seconds')
+            raise
+        except:
+            logger.error(f'Failed to restore {ch!r} via request', exc_info=True)
+    return channels
+
+
+async def resolve_channel_records(channel_ids: Iterable[int], client: TelegramClient) -> Dict[int, ChannelRecord]:
+    """
+    Cached records of the channels by their IDs, shared with the cache. Only the channels missing in the cache (or
+    with missing fields) are built and requested, at once with `resolve_channels`. A channel which couldn't be
+    requested gets an uncached record of what is known about it. Build a `Channel` from a record only to change it.
+    """
+    records, to_request = {}, []
+    for ch_id in dict.fromkeys(channel_ids):
+        record = channel_registry.find(channel_id=ch_id)
+        if record is not None and record._is_complete():
+            records[ch_id] = record
+        else:
+            to_request.append((ch_id, Channel(channel_id=ch_id, client=client, restore_values=False)))
+    if to_request:
+        await resolve_channels([ch for _, ch in to_request], client)
+        for ch_id, ch in to_request:  # the ID of a channel which failed to be requested may be reset
+            records[ch_id] = channel_registry.find(channel_id=ch_id) \
+                or ChannelRecord(ch.id, ch.name, ch.link, ch.is_public)
+    return records
+
+
+def save_channels(channels_list: List[Channel]):
+    channel_registry.set_channels(channels_list)
+
 
 def update_channels(channels_list: List[Channel], target_ch: Channel, add_not_remove=True):
     """
@@ -435,26 +983,12 @@ def update_channels(channels_list: List[Channel], target_ch: Channel, add_not_re
     -------
 
     """
-    # TODO: simplify logic
-    if add_not_remove:
-        if target_ch not in channels_list:  # firstly, check by full match
-            if target_ch.id in [ch.id for ch in channels_list]:
-                old_ch = [ch for ch in channels_list if ch.id == target_ch.id][0]
-                channels_list.remove(old_ch)
-                channels_list.append(target_ch)
-                logger.info(
-                    f'Cached {target_ch}\ninstead of outdated {old_ch}\nNow have {len(channels_list)} channels cached')
-            else:
-                channels_list.append(target_ch)
-                logger.info(
-                    f'Cached a new {target_ch}. Now have {len(channels_list)} channels cached')
-            save_channels(channels_list)
+    # the registry writes the change. The list is only kept in line for the callers which hold it
+    if channel_registry.update(target_ch, add_not_remove=add_not_remove):
+        if add_not_remove:
+            channels_list[:] = [ch for ch in channels_list if ch.id != target_ch.id] + [target_ch]
         else:
-            logger.log(7, f'Tried to cache already cached {target_ch}')
-    else:
-        channels_list = [c for c in channels_list if c != target_ch]
-        save_channels(channels_list)
-
+            channels_list = [c for c in channels_list if c != target_ch]
     return channels_list
 
 
@@ -466,17 +1000,14 @@ def get_channels(restore_values=True):
     You need to have the access_hash stored by yourself if you must delete session file, you can also pass
     get_entity(inputChannel(id, hash)) to skip session check
 
+    The channels come from `channel_registry`, so the file is not read again.
+
     :return:
     """
-    root = get_project_root()
-    path = os.path.join(root, CHANNEL_CACHE_FILEPATH)
-    if os.path.exists(path):
-        with open(path, 'r', encoding='utf-8-sig') as f:
-            # "id" : {"username": username, "invite_link": invite_link}.
-            data = {int(ch_id): v for ch_id, v in json.load(f).items()}  # a la deserializer
-    else:
+    channels = channel_registry.get_channels(restore_values=restore_values)
+    if not channel_registry.exists:
         return None
-
-    channels = [Channel(channel_id=ch_id, channel_name=v['username'], channel_link=v['invite_link'],
-                        is_public=v['is_public'], restore_values=restore_values) for ch_id, v in data.items()]
     return channels
+
+
+channel_registry = ChannelRegistry()
@@ -0,0 +1,146 @@
+import asyncio
+import math
+import time
+from datetime import datetime, timezone
+from typing import List, Set, Tuple
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+from telethon.tl.types import InputPeerChannel
+
+import logging
+
+from src.common.channel import Channel, ChannelRegistry, channel_registry as default_channel_registry, \
+    resolve_channels, CHANNEL_RESOLVE_BATCH_SIZE
+from src.common.client_manager import borrow_client
+from src.common.request_governor import RequestGovernor
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_REFRESH_DAILY_REQUESTS = 200
+CHANNEL_REFRESH_INTERVAL_SEC = 15 * 60
+CHANNEL_REFRESH_MIN_AGE_SEC = 7 * 24 * 60 * 60  # fresher channels are not requested at all
+
+
+class ChannelRefresher:
+    """
+    Requests the cached fields of the channels again in the background, the ones requested the longest time ago
+    first, so names and links don't go stale while message processing only reads the cache.
+    At most ``daily_requests`` requests are made per (UTC) day, spread evenly over the day: every ``interval``
+    seconds only its share of the budget is spent. Channels known to the session are requested by 100 per request,
+    the others by their link one by one. Private channels unknown to the session can't be refreshed and are skipped.
+
+    Parameters
+    ----------
+    client : TelegramClient
+    registry : ChannelRegistry, optional
+        The process-wide registry by default.
+    daily_requests : int
+    interval : float
+        Seconds between the refreshes.
+    min_age : float
+        Channels requested less than ``min_age`` seconds ago are not refreshed.
+    governor : RequestGovernor, optional
+        Flood waits of the refresh requests are recorded there and respected.
+    """
+
+    def __init__(self, client: TelegramClient, registry: ChannelRegistry = None,
+                 daily_requests=CHANNEL_REFRESH_DAILY_REQUESTS, interval=CHANNEL_REFRESH_INTERVAL_SEC,
+                 min_age=CHANNEL_REFRESH_MIN_AGE_SEC, governor: RequestGovernor = None):
+        self.client = client
+        self.registry = registry or default_channel_registry
+        self.daily_requests = daily_requests
+        self.interval = interval
+        self.min_age = min_age
+        self.governor = governor or RequestGovernor()
+        self._day = None
+        self.requests_today = 0
+        self._unrefreshable: Set[int] = set()  # channel IDs skipped until a restart
+        self._task = None
+
+    def get_budget(self) -> int:
+        """Requests which may be made now"""
+        today = datetime.now(timezone.utc).date()
+        if today != self._day:
+            self._day = today
+            self.requests_today = 0
+        per_refresh = math.ceil(self.daily_requests * self.interval / (24 * 60 * 60))
+        return max(0, min(per_refresh, self.daily_requests - self.requests_today))
+
+    async def _select(self, budget: int) -> Tuple[List[Channel], int]:
+        """The stalest channels which can be refreshed with ``budget`` requests and the number of the requests"""
+        batched, one_by_one = [], []
+        stalest = self.registry.get_stalest(budget * CHANNEL_RESOLVE_BATCH_SIZE + len(self._unrefreshable),
+                                            older_than=self.min_age)
+        for record in stalest:
+            if record.id in self._unrefreshable:
+                continue
+            try:
+                input_peer = await self.client.get_input_entity(record.id)  # from the session
+            except ValueError:
+                input_peer = None
+            if isinstance(input_peer, InputPeerChannel):
+                queue = batched
+            elif record.link is not None:
+                queue = one_by_one
+            else:
+                logger.log(7, f"Channel {record.id} is not known to the session and has no link. Not refreshed")
+                self._unrefreshable.add(record.id)
+                continue
+            queue.append(Channel.from_record(record, client=self.client, force_update=True))
+            if self._count_requests(batched, one_by_one) > budget:
+                queue.pop()
+                if len(batched) % CHANNEL_RESOLVE_BATCH_SIZE == 0:
+                    break  # the budget is spent, only a started batch could take more channels
+        return batched + one_by_one, self._count_requests(batched, one_by_one)
+
+    @staticmethod
+    def _count_requests(batched: List[Channel], one_by_one: List[Channel]) -> int:
+        return math.ceil(len(batched) / CHANNEL_RESOLVE_BATCH_SIZE) + len(one_by_one)
+
+    async def refresh(self) -> int:
+        """Refreshes the stalest channels within the remaining budget. Returns the number of refreshed channels"""
+        budget = self.get_budget()
+        if budget == 0 or self.governor.is_deferred('GetChannelsRequest'):
+            return 0
+        channels, requests = await self._select(budget)
+        if not channels:
+            return 0
+        # counted as planned: a failed request is not repeated until the budget allows
+        self.requests_today += requests
+        channel_ids = [ch.id for ch in channels]  # a failed request may reset the ID of the channel
+        start = time.time()
+        try:
+            async with borrow_client(self.client):
+                await resolve_channels(channels, self.client)
+        except FloodWaitError as e:
+            self.governor.record_error(e)
+            return 0
+        # e.g. deleted channels. Otherwise they would stay the stalest and take the budget every time
+        failed = []
+        for ch_id in channel_ids:
+            record = self.registry.find(channel_id=ch_id)
+            if record is None or (record.updated_at or 0) < start:
+                failed.append(ch_id)
+        self._unrefreshable.update(failed)
+        logger.info(f"Refreshed {len(channels) - len(failed)} of {len(channels)} cached channel(s) in "
+                    f"{time.time() - start:.1f} sec. {self.requests_today} of {self.daily_requests} requests are "
+                    f"spent today")
+        return len(channels) - len(failed)
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except:
+                logger.error("Failed to refresh the cached channels", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
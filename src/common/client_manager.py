@@ -0,0 +1,104 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from telethon import TelegramClient
+from telethon.tl.functions.updates import GetStateRequest
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+HEALTH_CHECK_INTERVAL_SEC = 60
+HEALTH_CHECK_TIMEOUT_SEC = 30
+RECONNECT_DELAYS_SEC = (1, 5, 30, 120)  # the last one is repeated until the connection is back
+
+
+class ClientManager:
+    """
+    Keeps TelegramClients connected for the whole life of the process. Unlike ``async with client``, borrowing
+    a client never disconnects it, so the connection handshake is not repeated for every call and coroutines
+    sharing a client concurrently do not disconnect each other. Registered clients are health-checked in the
+    background and reconnected if the check fails.
+    """
+
+    def __init__(self, health_check_interval=HEALTH_CHECK_INTERVAL_SEC):
+        self.health_check_interval = health_check_interval
+        self._clients = []
+        self._locks = {}  # client -> asyncio.Lock, not to connect the same client twice at once
+        self._connections = {}  # client -> number of connections made by the manager
+        self._health_check_task = None
+
+    def register(self, client: TelegramClient):
+        if client not in self._clients:
+            self._clients.append(client)
+
+    def _get_lock(self, client: TelegramClient) -> asyncio.Lock:
+        lock = self._locks.get(client)
+        if lock is None:
+            lock = self._locks[client] = asyncio.Lock()
+        return lock
+
+    async def ensure_connected(self, client: TelegramClient):
+        if client.is_connected():
+            return
+        async with self._get_lock(client):
+            attempt = 0
+            while not client.is_connected():
+                try:
+                    await client.connect()
+                except (OSError, ConnectionError):
+                    delay = RECONNECT_DELAYS_SEC[min(attempt, len(RECONNECT_DELAYS_SEC) - 1)]
+                    attempt += 1
+                    logger.error(f"Connection attempt {attempt} failed. Retrying in {delay} sec", exc_info=True)
+                    await asyncio.sleep(delay)
+            self._connections[client] = self._connections.get(client, 0) + 1
+            if attempt:
+                logger.info(f"Reconnected after {attempt} failed attempt(s)")
+
+    def get_connection_count(self, client: TelegramClient) -> int:
+        """How many times the manager (re)connected the client. Updates may be lost while it was disconnected"""
+        return self._connections.get(client, 0)
+
+    @asynccontextmanager
+    async def borrow(self, client: TelegramClient):
+        """Yields the connected client. The connection stays open after the block."""
+        self.register(client)
+        await self.ensure_connected(client)
+        yield client
+
+    async def check_health(self, client: TelegramClient) -> bool:
+        try:
+            await asyncio.wait_for(client(GetStateRequest()), timeout=HEALTH_CHECK_TIMEOUT_SEC)
+            return True
+        except:
+            logger.error("Health check failed. Reconnecting", exc_info=True)
+            await client.disconnect()
+            await self.ensure_connected(client)
+            return False
+
+    async def _health_check_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            for client in list(self._clients):
+                await self.check_health(client)
+
+    async def start(self):
+        for client in self._clients:
+            await self.ensure_connected(client)
+        if self._health_check_task is None:
+            self._health_check_task = asyncio.create_task(self._health_check_loop())
+
+    async def close(self):
+        if self._health_check_task is not None:
+            self._health_check_task.cancel()
+            self._health_check_task = None
+        for client in self._clients:
+            await client.disconnect()
+
+
+client_manager = ClientManager()
+
+
+def borrow_client(client: TelegramClient):
+    """Shortcut for `ClientManager.borrow` of the process-wide manager: ``async with borrow_client(client):``"""
+    return client_manager.borrow(client)
@@ -1,6 +1,6 @@
 import nest_asyncio
 
-from src.common.channel import Channel
+from src.common.channel import Channel, ChannelRecord, resolve_channel_records
 
 nest_asyncio.apply()
 
@@ -22,6 +22,7 @@ from telethon.tl.functions.messages import ExportChatInviteRequest
 import emoji
 
 from src.common.utils import (list_to_str_newline, extract_msg_features)
+from src.common.client_manager import borrow_client
 from src.common.get_project_root import get_project_root
 
 import logging
@@ -32,6 +33,9 @@ USERS_FILEPATH = "src/data/users.json"
 FEEDS_FILEPATH = "src/data/feeds.json"
 LAST_CHANNEL_MESSAGE_ID_FILEPATH = 'src/data/last_channel_message_id.json'
 LAST_BOT_MESSAGE_ID_FILEPATH = 'src/data/last_bot_message_id.json'
+CHANNEL_POLL_STATS_FILEPATH = 'src/data/channel_poll_stats.json'
+CHANNEL_BACKFILL_CAPS_FILEPATH = 'src/data/channel_backfill_caps.json'
+NEAR_DUPLICATE_THRESHOLDS_FILEPATH = 'src/data/near_duplicate_thresholds.json'
 RB_FILTER_LISTS_FILEPATH = 'src/data/rule_based_filter_lists.json'
 TRANSACTIONS_FILEPATH = 'src/data/transactions.csv'
 
@@ -69,6 +73,12 @@ def get_last_channel_ids():
     return data
 
 
+def get_last_channel_ids_time():
+    """Unix time of the last update of the last channel message IDs. None if they were never saved"""
+    path = os.path.join(get_project_root(), LAST_CHANNEL_MESSAGE_ID_FILEPATH)
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
 def save_last_channel_ids(channels: dict):
     root = get_project_root()
     path = os.path.join(root, LAST_CHANNEL_MESSAGE_ID_FILEPATH)
@@ -91,6 +101,69 @@ def update_last_channel_ids(ch_id: int, last_msg_id: int):
     return channels
 
 
+def get_channel_poll_stats():
+    root = get_project_root()
+    path = os.path.join(root, CHANNEL_POLL_STATS_FILEPATH)
+
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            data = {int(k): v for k, v in json.load(f).items()}  # a la deserializer
+    else:
+        data = {}
+    return data
+
+
+def save_channel_poll_stats(stats: dict):
+    root = get_project_root()
+    path = os.path.join(root, CHANNEL_POLL_STATS_FILEPATH)
+
+    with open(path, 'w') as f:
+        json.dump({str(k): v for k, v in stats.items()}, f)
+    logger.log(5, 'saved channel poll stats')
+
+
+def get_channel_backfill_caps():
+    """Source channel ID -> max number of messages read from its history per pass. Overrides the default cap."""
+    root = get_project_root()
+    path = os.path.join(root, CHANNEL_BACKFILL_CAPS_FILEPATH)
+
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            data = {int(k): v for k, v in json.load(f).items()}  # a la deserializer
+    else:
+        data = {}
+    return data
+
+
+_near_duplicate_thresholds = {'stat': None, 'data': {}}  # read again only when the file changes
+
+
+def get_near_duplicate_thresholds():
+    """
+    Destination channel ID -> similarity threshold of the near duplicate check. The file is read again only when its
+    modification time or size changes, as it's asked for on every construction of `Filter`.
+    """
+    root = get_project_root()
+    path = os.path.join(root, NEAR_DUPLICATE_THRESHOLDS_FILEPATH)
+
+    try:
+        stat = os.stat(path)
+        stat = (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        stat = None
+    if stat != _near_duplicate_thresholds['stat']:
+        data = {}
+        if stat is not None:
+            try:
+                with open(path, 'r', encoding='utf-8-sig') as f:
+                    data = {int(k): v for k, v in json.load(f).items()}  # a la deserializer
+            except ValueError:  # e.g. the file is being written right now. The previous thresholds stay
+                logger.error(f"Unable to parse near duplicate thresholds from {path}", exc_info=True)
+                return dict(_near_duplicate_thresholds['data'])
+        _near_duplicate_thresholds.update(stat=stat, data=data)
+    return dict(_near_duplicate_thresholds['data'])
+
+
 def get_users():
     root = get_project_root()
     path = os.path.join(root, USERS_FILEPATH)
@@ -195,14 +268,16 @@ def save_feeds(data):
         logger.debug('saved feeds')
 
 
-async def invert_feeds(feeds: Dict[int, List[int]], client: TelegramClient) -> Dict[int, List[int]]:
+async def invert_feeds(feeds: Dict[int, List[int]],
+                       client: TelegramClient) -> Dict[ChannelRecord, List[ChannelRecord]]:
+    # the records are shared with the cache. Only the channels missing there are built and requested together
+    async with borrow_client(client):
+        records = await resolve_channel_records((ch_id for dst_ch_id, src_ch_id_list in feeds.items()
+                                                 for ch_id in [dst_ch_id] + src_ch_id_list), client)
     scr2dst = {}
     for dst_ch_id, src_ch_id_list in feeds.items():
         for src_ch_id in src_ch_id_list:
-            async with client:
-                src_ch = Channel(channel_id=src_ch_id, client=client)
-                dst_ch = Channel(channel_id=dst_ch_id, client=client)
-            scr2dst.setdefault(src_ch, []).append(dst_ch)
+            scr2dst.setdefault(records[src_ch_id], []).append(records[dst_ch_id])
     return scr2dst
 
 
@@ -291,8 +366,12 @@ async def dict_to_csv_async(d: List[dict], filepath: str):
 
 
 async def log_messages(client: TelegramClient, msg_list_before: List[Message],
-                       filtering_details: dict,
+                       filtering_details: dict, batch_context=None,
                        **kwargs):
+    """
+    ``batch_context`` is a `BatchContext` of ``msg_list_before``. If given, message features are taken from it
+    instead of being extracted again.
+    """
     assert len(msg_list_before) == len(filtering_details)
 
     rows = []
@@ -300,7 +379,10 @@ async def log_messages(client: TelegramClient, msg_list_before: List[Message],
         row_dict = get_transaction_template()  # and update it with extract_msg_features
         row_dict['processing_timestamp'] = datetime.datetime.now()
 
-        msg_features = await extract_msg_features(msg, client)
+        if batch_context is not None and msg.id in batch_context:
+            msg_features = dict(batch_context[msg.id].features)  # shared with other destinations
+        else:
+            msg_features = await extract_msg_features(msg, client)
         # msg_features.pop('media')
         # msg_features.pop('entities')
         for k in list(msg_features):
@@ -313,7 +395,7 @@ async def log_messages(client: TelegramClient, msg_list_before: List[Message],
         elif filtering_details[msg.id] == 'rb':
             row_dict['action'] = 'filter'
             row_dict['filtered_by_personal_rb'] = True
-        elif filtering_details[msg.id] == 'hist':
+        elif filtering_details[msg.id] in ('hist', 'near_dup', 'img', 'seen'):  # all kinds of duplicates
             row_dict['action'] = 'filter'
             row_dict['filtered_by_hist'] = True
         elif 'recommender_' in filtering_details[msg.id]:
@@ -351,7 +433,7 @@ async def delete_users_channel(event, channel: Channel, clients: List[TelegramCl
     # remove bot from the channel. but the bot may be even not added
     try:
         for client in clients:
-            async with client:
+            async with borrow_client(client):
                 # Deletes a dialog (leaves a chat or channel).
                 await client.delete_dialog(channel.id)
                 # notify the user
@@ -0,0 +1,152 @@
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEASE_SEC = 600  # a taken item is given to another worker if not acknowledged in time
+MAX_ATTEMPTS = 5
+
+
+class DurableQueue:
+    """
+    SQLite-backed queue shared by processes. An item taken with `get` is leased, not removed: it's deleted only by
+    `ack`. If the worker dies or calls `nack`, the item becomes available again, so a restarted stage continues
+    where it stopped. Items which failed ``max_attempts`` times are kept with the 'dead' status for inspection.
+    The methods block on SQLite. They may be called from executor threads, one call at a time.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite file. Several queues may share one file.
+    name : str
+        Name of the queue within the file.
+    max_attempts : int
+    """
+
+    def __init__(self, path: str, name: str, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.name = name
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # autocommit mode, transactions are opened explicitly
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS queue_items ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'queue TEXT NOT NULL, '
+                           'payload BLOB NOT NULL, '
+                           "status TEXT NOT NULL DEFAULT 'ready', "
+                           'leased_until REAL, '
+                           'attempts INTEGER NOT NULL DEFAULT 0, '
+                           'created_at REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS queue_items_lookup ON queue_items (queue, status, id)')
+
+    def _put(self, queue: str, item: Any):
+        self._conn.execute('INSERT INTO queue_items (queue, payload, created_at) VALUES (?, ?, ?)',
+                           (queue, pickle.dumps(item), time.time()))
+
+    def put(self, item: Any):
+        with self._lock:
+            self._put(self.name, item)
+
+    def update(self, item_id: int, item: Any, next_queue: str = None, next_item: Any = None):
+        """
+        Replaces a leased item, e.g. to record the progress of its processing, so a retry continues from there.
+        If ``next_queue`` is given, ``next_item`` is put to that queue of the same file in the same transaction.
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('UPDATE queue_items SET payload = ? WHERE id = ?', (pickle.dumps(item), item_id))
+                if next_queue is not None:
+                    self._put(next_queue, next_item)
+                self._conn.execute('COMMIT')
+            except:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def get(self, lease_sec=DEFAULT_LEASE_SEC) -> Optional[Tuple[int, Any]]:
+        """Leases the oldest available item. Returns (item ID, item) or None if the queue is empty."""
+        with self._lock:
+            return self._get(lease_sec)
+
+    def _get(self, lease_sec: float) -> Optional[Tuple[int, Any]]:
+        now = time.time()
+        self._conn.execute('BEGIN IMMEDIATE')  # one writer at a time, so two workers never lease the same item
+        try:
+            # expired leases of dead workers
+            self._conn.execute("UPDATE queue_items SET status = CASE WHEN attempts >= ? THEN 'dead' ELSE 'ready' END "
+                               "WHERE queue = ? AND status = 'leased' AND leased_until < ?",
+                               (self.max_attempts, self.name, now))
+            row = self._conn.execute("SELECT id, payload FROM queue_items WHERE queue = ? AND status = 'ready' "
+                                     "ORDER BY id LIMIT 1", (self.name,)).fetchone()
+            if row is None:
+                self._conn.execute('COMMIT')
+                return None
+            item_id, payload = row
+            self._conn.execute("UPDATE queue_items SET status = 'leased', leased_until = ?, attempts = attempts + 1 "
+                               "WHERE id = ?", (now + lease_sec, item_id))
+            self._conn.execute('COMMIT')
+        except:
+            self._conn.execute('ROLLBACK')
+            raise
+        return item_id, pickle.loads(payload)
+
+    def ack(self, item_id: int):
+        with self._lock:
+            self._conn.execute('DELETE FROM queue_items WHERE id = ?', (item_id,))
+
+    def nack(self, item_id: int):
+        """Returns the item to the queue or marks it as dead after too many attempts."""
+        with self._lock:
+            self._conn.execute("UPDATE queue_items SET status = CASE WHEN attempts >= ? THEN 'dead' ELSE 'ready' END, "
+                               "leased_until = NULL WHERE id = ?", (self.max_attempts, item_id))
+        logger.warning(f"Item {item_id} of the '{self.name}' queue is returned after a failure")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM queue_items WHERE queue = ? AND status != 'dead'",
+                                      (self.name,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class DeliveryLog:
+    """
+    Time of the last delivery to every destination channel, shared by processes through an SQLite file (e.g. the one
+    of the queues). Lets the processes keeping the recent posts of the destinations in memory notice the posts sent
+    by another process.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite file.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS deliveries (channel_id INTEGER PRIMARY KEY, '
+                           'delivered_at REAL NOT NULL)')
+
+    def record(self, channel_id: int, delivered_at: float = None):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO deliveries (channel_id, delivered_at) VALUES (?, ?)',
+                               (channel_id, time.time() if delivered_at is None else delivered_at))
+
+    def get_delivery_times(self) -> Dict[int, float]:
+        """Channel ID -> unix time of the last delivery"""
+        with self._lock:
+            return dict(self._conn.execute('SELECT channel_id, delivered_at FROM deliveries').fetchall())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,120 @@
+import time
+from collections import OrderedDict, Counter
+from typing import Hashable, Optional, Tuple
+
+from telethon.tl.patched import Message
+
+import logging
+
+from src.common.message_context import message_fingerprint
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_WINDOW_SEC = 24 * 60 * 60
+FINGERPRINT_STORE_MAX_ENTRIES = 200000
+PENDING_DECISION = 'pending'  # the message is being processed, the decision is not known yet
+
+
+class FingerprintStore:
+    """
+    Decisions about the content already processed for each destination channel in the last ``window`` seconds,
+    across all the source channels. A story reposted by several sources is selected only once per destination:
+    the later copies are dropped before the filter and the recommender. A lookup which finds nothing may reserve
+    the content right away, so copies processed concurrently (e.g. from sources polled at once) are dropped too.
+    Entries are evicted by age and, if there are more than ``max_entries``, starting from the oldest.
+
+    Parameters
+    ----------
+    window : float
+        Seconds an entry is kept.
+    max_entries : int
+    """
+
+    def __init__(self, window=FINGERPRINT_WINDOW_SEC, max_entries=FINGERPRINT_STORE_MAX_ENTRIES):
+        self.window = window
+        self.max_entries = max_entries
+        # (destination ID, fingerprint) -> (recorded at, (source chat ID, message ID), decision). The oldest first
+        self._entries: 'OrderedDict[Tuple[int, str], Tuple[float, Tuple[int, int], Optional[str]]]' = OrderedDict()
+        self.lookups = 0
+        self.hits = 0
+        self.evicted_by_age = 0
+        self.evicted_by_cap = 0
+        self.hit_ages = Counter()  # age of the hit entry in full hours -> number of hits. Helps to size the window
+
+    def _evict(self, now: float):
+        while self._entries:
+            recorded_at = next(iter(self._entries.values()))[0]
+            if now - recorded_at < self.window:
+                break
+            self._entries.popitem(last=False)
+            self.evicted_by_age += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evicted_by_cap += 1
+
+    def lookup(self, dst_ch_id: int, msg: Message, fingerprint: Hashable = None, now: float = None, reserve=False):
+        """
+        Returns the entry (recorded at, source message, decision) if the content of ``msg`` was already decided
+        for the destination or is being decided, otherwise None. The decision about ``msg`` itself doesn't count,
+        so a retried batch is not dropped. If ``reserve``, a pending entry of ``msg`` is added when nothing is
+        found. It has to be replaced with `record` or dropped with `release`.
+        """
+        now = now or time.time()
+        self._evict(now)
+        fingerprint = fingerprint or message_fingerprint(msg)
+        if fingerprint is None:
+            return None
+        self.lookups += 1
+        entry = self._entries.get((dst_ch_id, fingerprint))
+        if entry is None or entry[1] == (msg.chat_id, msg.id):
+            if entry is None and reserve:
+                self._entries[(dst_ch_id, fingerprint)] = (now, (msg.chat_id, msg.id), PENDING_DECISION)
+            return None
+        self.hits += 1
+        self.hit_ages[int((now - entry[0]) // 3600)] += 1
+        return entry
+
+    def record(self, dst_ch_id: int, msg: Message, decision: Optional[str], fingerprint: Hashable = None,
+               now: float = None):
+        """Remembers the decision about ``msg`` for the destination. None means the message was selected."""
+        fingerprint = fingerprint or message_fingerprint(msg)
+        if fingerprint is None:
+            return
+        key = (dst_ch_id, fingerprint)
+        source = (msg.chat_id, msg.id)
+        entry = self._entries.pop(key, None)
+        # the first decision stays, but the window is counted from the last sighting
+        if entry is not None and not (entry[2] == PENDING_DECISION and entry[1] == source):
+            _, source, decision = entry
+        self._entries[key] = (now or time.time(), source, decision)
+        self._evict(now or time.time())
+
+    def release(self, dst_ch_id: int, msg: Message, fingerprint: Hashable = None):
+        """Drops the pending entry of ``msg`` if it was never decided, e.g. its processing failed"""
+        fingerprint = fingerprint or message_fingerprint(msg)
+        key = (dst_ch_id, fingerprint)
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] == PENDING_DECISION and entry[1] == (msg.chat_id, msg.id):
+            del self._entries[key]
+
+    def get_stats(self) -> dict:
+        return {'size': len(self._entries), 'lookups': self.lookups, 'hits': self.hits,
+                'hit_rate': self.hits / self.lookups if self.lookups else 0.,
+                'evicted_by_age': self.evicted_by_age, 'evicted_by_cap': self.evicted_by_cap,
+                'hit_age_hours': dict(sorted(self.hit_ages.items()))}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def message_is_seen(msg: Message, store: FingerprintStore, dst_ch_id: int, batch_context=None) -> bool:
+    fingerprint = batch_context.get_fingerprint(msg) if batch_context is not None else None
+    entry = store.lookup(dst_ch_id, msg, fingerprint=fingerprint, reserve=True)
+    if entry is not None:
+        logger.log(7, f"Message {msg.id} of {msg.chat_id} was already decided for {dst_ch_id} as message "
+                      f"{entry[1][1]} of {entry[1][0]}: {entry[2] or 'selected'}")
+        return True
+    return False
+
+
+seen_fingerprints = FingerprintStore()
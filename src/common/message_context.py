@@ -0,0 +1,102 @@
+import hashlib
+from typing import Dict, List, Optional
+
+from telethon import TelegramClient
+from telethon.tl.patched import Message
+from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto, MessageMediaWebPage, MessageMediaPoll
+
+import logging
+
+from src.common.utils import get_message_origins, extract_msg_features
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    if text is None:
+        return ''
+    return ' '.join(text.lower().split())
+
+
+def message_fingerprint(msg: Message) -> Optional[str]:
+    """
+    Hash of what `message_is_same` compares: the text with its entities for messages without media, the ID of the
+    document, photo or poll or the URL of the webpage otherwise. Messages with equal fingerprints are most probably
+    the same, different fingerprints mean different messages. None if the media can't be compared at all.
+    """
+    media = msg.media
+    if media is None:
+        entities = [entity.to_dict() for entity in msg.entities or []]
+        key = f"text\x00{msg.message}\x00{entities!r}"
+    elif isinstance(media, MessageMediaDocument) and media.document is not None:
+        key = f"document\x00{media.document.id}"
+    elif isinstance(media, MessageMediaPhoto) and media.photo is not None:
+        key = f"photo\x00{media.photo.id}"
+    elif isinstance(media, MessageMediaWebPage):
+        key = f"webpage\x00{getattr(media.webpage, 'url', None) or media.webpage.id}"
+    elif isinstance(media, MessageMediaPoll):
+        key = f"poll\x00{media.poll.id}"
+    else:
+        return None
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class MessageContext:
+    """
+    Everything derived from a source message which doesn't depend on the destination channel. Computed once per
+    source batch and shared by all the destinations.
+
+    Attributes
+    ----------
+    msg : Message
+    origins : tuple
+        Result of `get_message_origins`: orig_channel, orig_date, orig_post_id, fwd_to_channel, fwd_date,
+        fwd_to_post_id.
+    features : dict
+        Result of `extract_msg_features`. Has to be copied before modification.
+    fingerprint : str or None
+        Result of `message_fingerprint`.
+    """
+
+    def __init__(self, msg: Message, origins: tuple, features: dict):
+        self.msg = msg
+        self.origins = origins
+        self.features = features
+        self.fingerprint = message_fingerprint(msg)
+
+
+class BatchContext:
+    """Message contexts of one source batch accessible by message ID."""
+
+    def __init__(self, contexts: Dict[int, MessageContext]):
+        self._contexts = contexts
+
+    @classmethod
+    async def build(cls, msg_list: List[Message], client: TelegramClient) -> 'BatchContext':
+        contexts = {}
+        for msg in msg_list:
+            origins = await get_message_origins(client, msg)
+            features = await extract_msg_features(msg, client, origins=origins)
+            contexts[msg.id] = MessageContext(msg, origins=origins, features=features)
+        logger.log(5, f"Built context for {len(contexts)} message(s)")
+        return cls(contexts)
+
+    def __getitem__(self, msg_id: int) -> MessageContext:
+        return self._contexts[msg_id]
+
+    def __contains__(self, msg_id: int):
+        return msg_id in self._contexts
+
+    def get_fingerprint(self, msg: Message) -> Optional[str]:
+        """Fingerprint of ``msg``. Computed if it doesn't belong to the batch."""
+        context = self._contexts.get(msg.id)
+        if context is None or context.msg.chat_id != msg.chat_id:
+            return message_fingerprint(msg)
+        return context.fingerprint
+
+    def get_origins(self, msg: Message):
+        """Origins of ``msg`` if it belongs to the batch, otherwise None."""
+        context = self._contexts.get(msg.id)
+        if context is None or context.msg.chat_id != msg.chat_id:
+            return None
+        return context.origins
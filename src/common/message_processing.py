@@ -12,6 +12,7 @@ from telethon.tl.types import MessageActionGroupCall, MessageActionPinMessage, M
 from src import config
 from src.common.channel import Channel
 from src.common.database_utils import get_last_bot_id, save_last_bot_ids
+from src.common.client_manager import borrow_client
 
 logger = logging.getLogger(__name__)
 
@@ -173,10 +174,10 @@ async def ensure_media_access(msg, user_client, bot_client, orig_channel_id):
         return last_msg, last_actual_id
 
     if msg.media is not None:
-        async with user_client:
+        async with borrow_client(user_client):
             bot_entity = await user_client.get_input_entity(config.bot_id)
             await user_client.forward_messages(entity=bot_entity, messages=msg, from_peer=orig_channel_id)
-        async with bot_client:
+        async with borrow_client(bot_client):
             # bot_last_id = get_last_bot_id() + 1  # as we have just sent another one
             # msg = await bot_client.get_messages(config.my_id, ids=bot_last_id)
             # if msg:
@@ -189,7 +190,7 @@ async def ensure_media_access(msg, user_client, bot_client, orig_channel_id):
 
 async def msg_is_action(msg, client, from_peer, peer_to_forward_to):
     try:
-        async with client:
+        async with borrow_client(client):
             # TODO: check if regular messages have action. Looks like not
             if isinstance(msg.action, (MessageActionGroupCall, MessageActionGroupCall)):
                 if msg.action.duration is None:
@@ -215,7 +216,7 @@ async def msg_is_action(msg, client, from_peer, peer_to_forward_to):
 
 async def msg_is_invoice(msg, client, from_peer, peer_to_forward_to):
     try:
-        async with client:
+        async with borrow_client(client):
             if isinstance(msg.invoice, MessageMediaInvoice):
                 logger.info(f"{from_peer!r} posten an invoice")
                 await client.send_message(peer_to_forward_to, f"{from_peer} requests money with the following title: "
@@ -0,0 +1,150 @@
+import heapq
+import time
+from typing import Dict, Iterable, List
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL_SEC = 1800  # for channels without a posting rate estimate yet
+MIN_POLL_INTERVAL_SEC = 120
+MAX_POLL_INTERVAL_SEC = 6 * 60 * 60
+TARGET_MESSAGES_PER_POLL = 3  # a channel is polled when this many new posts are expected
+RATE_SMOOTHING = 0.3  # weight of the latest observation in the exponentially weighted posting rate
+POLL_BUDGET_PER_HOUR = 4000  # get_history requests for all the channels together
+
+
+class PollingScheduler:
+    """
+    Priority-queue scheduler of source channel polls. The posting rate of each channel is estimated from the growth
+    of its last message ID between polls (channel post IDs are sequential). Busy channels are polled often and quiet
+    ones rarely. If the total demand exceeds ``budget_per_hour``, all the intervals are stretched proportionally.
+
+    Parameters
+    ----------
+    budget_per_hour : int
+        Maximum number of polls per hour for all the channels together.
+    state : Dict[int, dict], optional
+        Previously saved state as returned by `get_state`.
+    """
+
+    def __init__(self, budget_per_hour=POLL_BUDGET_PER_HOUR, state: Dict[int, dict] = None):
+        self.budget_per_hour = budget_per_hour
+        # channel ID -> {'rate': posts per second or None, 'last_msg_id': int, 'last_poll': unix time}
+        self._stats = {}
+        self._next_poll = {}  # channel ID -> unix time
+        self._heap = []  # (unix time, channel ID). Outdated entries are skipped lazily
+        self._demand = {}  # channel ID -> desired polls per hour
+        self._total_demand = 0
+
+        for ch_id, ch_stats in (state or {}).items():
+            self._stats[ch_id] = dict(ch_stats)
+            self._update_demand(ch_id)
+            self._schedule(ch_id, ch_stats['last_poll'] + self._interval(ch_id))
+
+    def _base_interval(self, ch_id) -> float:
+        rate = self._stats.get(ch_id, {}).get('rate')
+        if rate is None:
+            return DEFAULT_POLL_INTERVAL_SEC
+        if rate <= 0:
+            return MAX_POLL_INTERVAL_SEC
+        return min(max(TARGET_MESSAGES_PER_POLL / rate, MIN_POLL_INTERVAL_SEC), MAX_POLL_INTERVAL_SEC)
+
+    def _interval(self, ch_id) -> float:
+        stretch = max(1, self._total_demand / self.budget_per_hour)
+        return self._base_interval(ch_id) * stretch
+
+    def _update_demand(self, ch_id):
+        demand = 3600 / self._base_interval(ch_id)
+        self._total_demand += demand - self._demand.get(ch_id, 0)
+        self._demand[ch_id] = demand
+
+    def _schedule(self, ch_id, poll_time):
+        self._next_poll[ch_id] = poll_time
+        heapq.heappush(self._heap, (poll_time, ch_id))
+
+    def seed(self, last_msg_ids: Dict[int, int], as_of: float):
+        """
+        Takes the last message IDs known at ``as_of`` (e.g. from the last processed IDs of the channels) as the
+        previous poll of the channels without saved stats, so the first poll already gives a posting rate.
+        """
+        for ch_id, last_msg_id in last_msg_ids.items():
+            if ch_id not in self._stats and last_msg_id:
+                self._stats[ch_id] = {'rate': None, 'last_msg_id': last_msg_id, 'last_poll': as_of}
+
+    def sync_channels(self, channel_ids: Iterable[int], now=None):
+        """Starts tracking new source channels (due immediately) and forgets the removed ones."""
+        now = time.time() if now is None else now
+        channel_ids = set(channel_ids)
+        for ch_id in channel_ids - self._demand.keys():  # every tracked channel has a demand
+            self._update_demand(ch_id)
+            self._schedule(ch_id, now)
+        for ch_id in self._demand.keys() - channel_ids:
+            self._next_poll.pop(ch_id, None)
+            self._total_demand -= self._demand.pop(ch_id)
+        for ch_id in self._stats.keys() - channel_ids:  # also the seeded ones which were never tracked
+            del self._stats[ch_id]
+
+    def pop_due(self, now=None) -> List[int]:
+        """
+        Returns IDs of the channels which have to be polled now, the most overdue first. They are not scheduled until
+        `record_poll` or `reschedule_unpolled` is called for them.
+        """
+        now = time.time() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            poll_time, ch_id = heapq.heappop(self._heap)
+            if self._next_poll.get(ch_id) == poll_time:  # otherwise the entry is outdated
+                del self._next_poll[ch_id]
+                due.append(ch_id)
+        return due
+
+    def reschedule_unpolled(self, channel_ids: Iterable[int], now=None):
+        """Schedules the popped channels which were not recorded as polled (e.g. their poll failed) as if they were"""
+        now = time.time() if now is None else now
+        for ch_id in channel_ids:
+            if ch_id in self._demand and ch_id not in self._next_poll:
+                self._schedule(ch_id, now + self._interval(ch_id))
+
+    def seconds_until_next_poll(self, now=None) -> float:
+        now = time.time() if now is None else now
+        while self._heap and self._next_poll.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return DEFAULT_POLL_INTERVAL_SEC
+        return max(0, self._heap[0][0] - now)
+
+    def record_poll(self, ch_id: int, last_msg_id: int, now=None):
+        """
+        Updates the posting rate estimate of a polled channel and schedules its next poll.
+
+        Parameters
+        ----------
+        ch_id : int
+        last_msg_id : int
+            The last known message ID of the channel after the poll. Zero if unknown.
+        now : float, optional
+            Unix time of the poll.
+        """
+        now = time.time() if now is None else now
+        ch_stats = self._stats.setdefault(ch_id, {'rate': None, 'last_msg_id': 0, 'last_poll': None})
+        # a channel with the unknown previous ID would report its whole history as new
+        if ch_stats['last_poll'] is not None and ch_stats['last_msg_id'] and last_msg_id:
+            elapsed = now - ch_stats['last_poll']
+            if elapsed > 0:
+                observed_rate = max(0, last_msg_id - ch_stats['last_msg_id']) / elapsed
+                if ch_stats['rate'] is None:
+                    ch_stats['rate'] = observed_rate
+                else:
+                    ch_stats['rate'] = RATE_SMOOTHING * observed_rate + (1 - RATE_SMOOTHING) * ch_stats['rate']
+        ch_stats['last_msg_id'] = last_msg_id
+        ch_stats['last_poll'] = now
+
+        self._update_demand(ch_id)
+        interval = self._interval(ch_id)
+        self._schedule(ch_id, now + interval)
+        logger.log(5, f"Channel {ch_id} posts {(ch_stats['rate'] or 0) * 3600:.2f} msg/hour. "
+                      f"Next poll in {interval / 60:.1f} min")
+
+    def get_state(self) -> Dict[int, dict]:
+        return {ch_id: dict(ch_stats) for ch_id, ch_stats in self._stats.items() if ch_stats['last_poll'] is not None}
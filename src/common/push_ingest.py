@@ -0,0 +1,177 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Set
+
+from telethon import TelegramClient, events
+from telethon.tl.patched import Message
+
+import logging
+
+from src.common.client_manager import client_manager
+
+logger = logging.getLogger(__name__)
+
+PUSH_BATCH_DELAY_SEC = 3  # albums come as several updates. Wait for the rest of them before processing
+SUBSCRIPTIONS_REFRESH_SEC = 1800
+
+
+class TelethonUpdateSource:
+    """Delivers new channel posts received by a connected TelegramClient as updates."""
+
+    def __init__(self, client: TelegramClient):
+        self.client = client
+
+    def subscribe(self, callback: Callable[[Message], Awaitable[None]]):
+        async def on_new_message(event):
+            await callback(event.message)
+
+        self.client.add_event_handler(on_new_message, events.NewMessage(func=lambda e: e.is_channel))
+
+    async def get_subscribed_channel_ids(self) -> Set[int]:
+        # dialog.id is already marked, i.e. starts with -100 for channels
+        return {dialog.id async for dialog in self.client.iter_dialogs() if dialog.is_channel}
+
+    def get_connection_count(self) -> int:
+        return client_manager.get_connection_count(self.client)
+
+
+class FakeUpdateSource:
+    """
+    Offline replacement of `TelethonUpdateSource`. Messages passed to `push` are delivered to the subscribers as if
+    they came from Telegram.
+
+    Parameters
+    ----------
+    subscribed_channel_ids : Set[int]
+        IDs of the channels the fake account is subscribed to.
+    """
+
+    def __init__(self, subscribed_channel_ids: Set[int] = None):
+        self.subscribed_channel_ids = set(subscribed_channel_ids or [])
+        self.connection_count = 0  # increment to simulate a reconnect
+        self._callbacks = []
+
+    def subscribe(self, callback: Callable[[Message], Awaitable[None]]):
+        self._callbacks.append(callback)
+
+    async def get_subscribed_channel_ids(self) -> Set[int]:
+        return set(self.subscribed_channel_ids)
+
+    def get_connection_count(self) -> int:
+        return self.connection_count
+
+    async def push(self, msg: Message):
+        if msg.chat_id not in self.subscribed_channel_ids:
+            return
+        for callback in self._callbacks:
+            await callback(msg)
+
+
+class PushIngest:
+    """
+    Event-driven ingest of the source channels the user account is subscribed to. Posts arriving as updates are
+    buffered per channel for ``batch_delay`` seconds (so an album is processed together) and then passed to
+    ``handler`` in the same descending order as `get_history` returns them.
+    Posts published before a channel became pushed or while the client was disconnected don't come as updates. Such
+    channels are returned by `pop_catch_up` to be polled once.
+
+    Parameters
+    ----------
+    update_source : TelethonUpdateSource or FakeUpdateSource
+    handler : Callable
+        ``async handler(route, msg_list)`` where ``route`` is the value given for the channel in `sync_channels`.
+    batch_delay : float
+        Seconds of silence in a channel after which its buffered posts are processed.
+    """
+
+    def __init__(self, update_source, handler: Callable[[Any, List[Message]], Awaitable[None]],
+                 batch_delay=PUSH_BATCH_DELAY_SEC):
+        self.update_source = update_source
+        self.handler = handler
+        self.batch_delay = batch_delay
+        self._routes = {}  # channel ID -> route, only for the channels delivered via push
+        self._subscribed_channel_ids = set()
+        self._subscriptions_refreshed_at = None
+        self._buffers = {}  # channel ID -> List[Message]
+        self._flush_tasks = {}  # channel ID -> asyncio.Task
+        self._channel_locks = {}  # the same channel is never processed concurrently
+        self._catch_up = set()  # channel IDs which may have missed updates
+        self._connection_count = None  # of the update source as of the last sync
+        self.update_source.subscribe(self._on_message)
+
+    async def refresh_subscriptions(self, force=False):
+        now = time.monotonic()
+        if force or self._subscriptions_refreshed_at is None \
+                or now - self._subscriptions_refreshed_at > SUBSCRIPTIONS_REFRESH_SEC:
+            self._subscribed_channel_ids = await self.update_source.get_subscribed_channel_ids()
+            self._subscriptions_refreshed_at = now
+            logger.debug(f"User account is subscribed to {len(self._subscribed_channel_ids)} channels")
+
+    async def sync_channels(self, routes: Dict[int, Any]) -> Set[int]:
+        """
+        Sets the source channels to ingest. Only the subscribed ones may be pushed, the rest has to be polled.
+
+        Parameters
+        ----------
+        routes : Dict[int, Any]
+            Source channel ID -> anything the handler needs to process its posts.
+
+        Returns
+        -------
+        Set[int]
+            IDs of the channels delivered via push.
+        """
+        await self.refresh_subscriptions()
+        routes = {ch_id: route for ch_id, route in routes.items() if ch_id in self._subscribed_channel_ids}
+        connection_count = self.update_source.get_connection_count()
+        if connection_count != self._connection_count:  # reconnected, any channel may have missed updates
+            self._catch_up = set(routes)
+            self._connection_count = connection_count
+        else:
+            self._catch_up = (self._catch_up | (routes.keys() - self._routes.keys())) & routes.keys()
+        self._routes = routes
+        return set(self._routes)
+
+    def pop_catch_up(self) -> Set[int]:
+        """IDs of the pushed channels which have to be polled once as they may have missed updates"""
+        catch_up, self._catch_up = self._catch_up, set()
+        return catch_up
+
+    def get_lock(self, ch_id) -> asyncio.Lock:
+        """Held while the posts of the channel are processed. A catch-up poll has to hold it as well"""
+        return self._channel_locks.setdefault(ch_id, asyncio.Lock())
+
+    async def _on_message(self, msg: Message):
+        if msg.chat_id not in self._routes:
+            return
+        self._buffers.setdefault(msg.chat_id, []).append(msg)
+
+        flush_task = self._flush_tasks.get(msg.chat_id)
+        if flush_task is not None:
+            flush_task.cancel()  # debounce: the channel is still posting
+        self._flush_tasks[msg.chat_id] = asyncio.create_task(self._flush_later(msg.chat_id))
+
+    async def _flush_later(self, ch_id):
+        await asyncio.sleep(self.batch_delay)
+        self._flush_tasks.pop(ch_id, None)
+        await self.flush(ch_id)
+
+    async def flush(self, ch_id):
+        msg_list = self._buffers.pop(ch_id, [])
+        route = self._routes.get(ch_id)
+        if not msg_list or route is None:
+            return
+        msg_list.sort(key=lambda m: m.id, reverse=True)
+        logger.debug(f"Got {len(msg_list)} pushed message(s) from {ch_id}")
+
+        async with self.get_lock(ch_id):
+            try:
+                await self.handler(route, msg_list)
+            except:
+                logger.error(f"Failed to process pushed messages of {ch_id}", exc_info=True)
+
+    async def flush_all(self):
+        for flush_task in self._flush_tasks.values():
+            flush_task.cancel()
+        self._flush_tasks = {}
+        await asyncio.gather(*[self.flush(ch_id) for ch_id in list(self._buffers)])
@@ -0,0 +1,53 @@
+import time
+from typing import Dict, Hashable, Optional, Tuple
+
+from telethon.errors import FloodWaitError
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_flood_wait_request_type(e: FloodWaitError) -> str:
+    """Name of the request which caused the error, e.g. 'GetHistoryRequest'."""
+    request = getattr(e, 'request', None)
+    if request is None:
+        return 'unknown'
+    return type(request).__name__
+
+
+class RequestGovernor:
+    """
+    Keeps track of FloodWaitErrors per request type and per entity. Only the (request type, entity) pairs which got
+    a flood wait are deferred until it expires, everything else keeps being requested. A flood wait recorded without
+    an entity defers the request type for all the entities.
+    """
+
+    def __init__(self):
+        self._deferred_until = {}  # (request type, entity or None) -> unix time
+
+    def record_flood_wait(self, request_type: str, seconds: float, entity: Hashable = None):
+        until = time.time() + seconds
+        key = (request_type, entity)
+        self._deferred_until[key] = max(until, self._deferred_until.get(key, 0))
+        logger.info(f"{request_type} for {entity if entity is not None else 'all the entities'} is deferred for "
+                    f"{seconds} seconds / {seconds / 60:.1f} minutes / {seconds / 60 / 60:.1f} hours")
+
+    def record_error(self, e: FloodWaitError, entity: Hashable = None):
+        self.record_flood_wait(get_flood_wait_request_type(e), e.seconds, entity=entity)
+
+    def remaining_wait(self, request_type: str, entity: Hashable = None) -> float:
+        """Seconds until ``request_type`` may be performed for ``entity``. Zero if it's allowed right now."""
+        now = time.time()
+        until = max(self._deferred_until.get((request_type, entity), 0),
+                    self._deferred_until.get((request_type, None), 0))
+        return max(0, until - now)
+
+    def is_deferred(self, request_type: str, entity: Hashable = None) -> bool:
+        return self.remaining_wait(request_type, entity) > 0
+
+    def get_deferrals(self) -> Dict[Tuple[str, Optional[Hashable]], float]:
+        """Currently active deferrals: (request type, entity) -> remaining seconds. Expired ones are dropped."""
+        now = time.time()
+        self._deferred_until = {key: until for key, until in self._deferred_until.items() if until > now}
+        return {key: until - now for key, until in self._deferred_until.items()}
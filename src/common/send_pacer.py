@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Telegram doesn't publish exact limits. Bots are known to be throttled at around 20 messages per minute to the same
+# channel and 30 messages per second overall
+PER_DESTINATION_RATE = 1 / 5  # sends per second to one destination channel
+PER_DESTINATION_BURST = 3
+PER_CLIENT_RATE = 1  # sends per second from one client to all destinations
+PER_CLIENT_BURST = 5
+
+
+class TokenBucket:
+    """
+    Classic token bucket. Tokens are refilled continuously with ``rate`` per second up to ``capacity``. Waiting for
+    tokens is performed with ``asyncio.sleep`` so the event loop is never blocked.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens added per second.
+    capacity : float
+        Maximum number of tokens which may be accumulated, i.e. the allowed burst.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError(f"rate and capacity have to be positive. Given: rate={rate}, capacity={capacity}")
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = asyncio.Lock()  # waiters are served in the order of arrival
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def acquire(self, tokens: float = 1):
+        """Waits until ``tokens`` are available and takes them. Returns the number of seconds waited."""
+        waited = 0
+        async with self._lock:
+            self._refill()
+            while self._tokens < tokens:
+                delay = (tokens - self._tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+                self._refill()
+            self._tokens -= tokens
+        return waited
+
+
+class SendPacer:
+    """
+    Paces outbound sends with one token bucket per destination channel and one per sending client. A send waits
+    for both buckets, so sends to different destinations proceed in parallel while the total rate of each client
+    stays bounded.
+
+    Parameters
+    ----------
+    per_destination_rate : float
+        Sends per second allowed to one destination.
+    per_destination_burst : float
+        Number of sends to one destination which may go without waiting.
+    per_client_rate : float
+        Sends per second allowed from one client.
+    per_client_burst : float
+        Number of sends from one client which may go without waiting.
+    """
+
+    def __init__(self, per_destination_rate=PER_DESTINATION_RATE, per_destination_burst=PER_DESTINATION_BURST,
+                 per_client_rate=PER_CLIENT_RATE, per_client_burst=PER_CLIENT_BURST):
+        self.per_destination_rate = per_destination_rate
+        self.per_destination_burst = per_destination_burst
+        self.per_client_rate = per_client_rate
+        self.per_client_burst = per_client_burst
+        self._destination_buckets = {}
+        self._client_buckets = {}
+
+    def _get_bucket(self, buckets: dict, key, rate, capacity) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate=rate, capacity=capacity)
+        return bucket
+
+    async def wait(self, client, destination, tokens: float = 1):
+        """
+        Waits until ``client`` is allowed to perform ``tokens`` sends to ``destination``.
+
+        Parameters
+        ----------
+        client : TelegramClient
+            Client performing the send. Used only as a key.
+        destination
+            ID (or any other hashable peer) of the destination channel.
+        tokens : float
+            Number of sends to account for. One request (even an album) counts as one send.
+        """
+        destination_bucket = self._get_bucket(self._destination_buckets, destination,
+                                              self.per_destination_rate, self.per_destination_burst)
+        client_bucket = self._get_bucket(self._client_buckets, client, self.per_client_rate, self.per_client_burst)
+
+        # destination first: a busy destination should not hold tokens of the client shared with other destinations
+        waited = await destination_bucket.acquire(tokens)
+        waited += await client_bucket.acquire(tokens)
+        if waited:
+            logger.log(5, f"Waited {waited:.1f} sec before sending to {destination}")
@@ -0,0 +1,98 @@
+import hashlib
+import time
+from typing import Dict, Iterable, List
+
+from telethon import TelegramClient
+from telethon.errors import AuthKeyUnregisteredError, UserDeactivatedError, UserDeactivatedBanError
+
+import logging
+
+from src.common.channel import Channel
+from src.common.request_governor import RequestGovernor
+
+logger = logging.getLogger(__name__)
+
+# a flood wait longer than this is considered account-wide. The session gives its channels away until it expires
+SESSION_THROTTLE_THRESHOLD_SEC = 600
+
+
+def _rendezvous_weight(session_name: str, channel_id: int) -> int:
+    # hashlib instead of hash() to stay stable between the runs
+    return int.from_bytes(hashlib.md5(f'{session_name}:{channel_id}'.encode()).digest()[:8], 'big')
+
+
+class SessionPool:
+    """
+    Pool of user sessions sharing the ingest of source channels. Channels are assigned with rendezvous hashing:
+    the assignment is stable between the passes, and when a session becomes unavailable only its own channels
+    move to the other sessions. Private channels are always read by the primary session as only the members can
+    read them.
+
+    Parameters
+    ----------
+    clients : Dict[str, TelegramClient]
+        Session name -> user client. The first one is the primary session.
+    governors : Dict[str, RequestGovernor], optional
+        Session name -> request governor of this session. Created if not given.
+    """
+
+    def __init__(self, clients: Dict[str, TelegramClient], governors: Dict[str, RequestGovernor] = None):
+        if not clients:
+            raise ValueError("At least one session has to be given")
+        self.clients = dict(clients)
+        self.primary = next(iter(self.clients))
+        governors = governors or {}
+        self.governors = {name: governors.get(name) or RequestGovernor() for name in self.clients}
+        self._throttled_until = {}  # session name -> unix time
+        self._banned = set()
+
+    def mark_throttled(self, name: str, seconds: float):
+        self._throttled_until[name] = time.time() + seconds
+        logger.warning(f"Session {name} is throttled for {seconds / 60:.1f} minutes. Its channels are rebalanced")
+
+    def mark_banned(self, name: str):
+        self._banned.add(name)
+        logger.error(f"Session {name} is banned or logged out. Its channels are rebalanced")
+
+    async def check_sessions(self):
+        """Marks the sessions which were logged out or banned. Clients have to be connected."""
+        for name, client in self.clients.items():
+            if name in self._banned:
+                continue
+            try:
+                if await client.get_me() is None:  # not authorized
+                    self.mark_banned(name)
+            except (AuthKeyUnregisteredError, UserDeactivatedError, UserDeactivatedBanError):
+                self.mark_banned(name)
+
+    def update_availability(self):
+        """Marks the sessions with long flood waits as throttled."""
+        for name, governor in self.governors.items():
+            deferrals = governor.get_deferrals()
+            longest_wait = max(deferrals.values(), default=0)
+            if longest_wait > SESSION_THROTTLE_THRESHOLD_SEC and not self.is_throttled(name):
+                self.mark_throttled(name, longest_wait)
+
+    def is_throttled(self, name: str) -> bool:
+        return self._throttled_until.get(name, 0) > time.time()
+
+    def available_sessions(self) -> List[str]:
+        available = [name for name in self.clients if name not in self._banned and not self.is_throttled(name)]
+        if not available:  # better to try the throttled ones than to stop completely
+            available = [name for name in self.clients if name not in self._banned] or [self.primary]
+        return available
+
+    def assign(self, channel: Channel, sessions: List[str] = None) -> str:
+        if channel.is_public is False:
+            return self.primary
+        sessions = sessions or self.available_sessions()
+        return max(sessions, key=lambda name: _rendezvous_weight(name, channel.id))
+
+    def shard(self, channels: Iterable[Channel]) -> Dict[str, List[Channel]]:
+        """Splits the source channels between the available sessions."""
+        sessions = self.available_sessions()
+        shards = {}
+        for channel in channels:
+            shards.setdefault(self.assign(channel, sessions), []).append(channel)
+        logger.log(7, "Channels per session: " + ', '.join(f'{name}: {len(share)}' for name, share in shards.items()))
+        return shards
@@ -3,6 +3,8 @@ import os
 import re
 from copy import deepcopy
 
+from typing import AsyncIterator, List
+
 from telethon import TelegramClient
 from telethon.tl.functions.messages import CheckChatInviteRequest, ImportChatInviteRequest
 from telethon.tl.patched import Message
@@ -13,11 +15,13 @@ from src import config
 
 import logging
 
-from src.common.channel import get_display_name, Channel
+from src.common.channel import get_display_name, Channel, ChannelRecord, resolve_channel_records
 from src.common.get_project_root import get_project_root
 
 logger = logging.getLogger(__name__)
 
+HISTORY_PAGE_SIZE = 50  # GetHistoryRequest returns at most 100 messages
+
 
 def get_reactions(msg: Message):
     """
@@ -109,12 +113,67 @@ async def get_history(client: TelegramClient, channel: Channel = None, **get_his
     return messages
 
 
+async def iter_history_pages(client: TelegramClient, channel: Channel, min_id: int, page_size=HISTORY_PAGE_SIZE,
+                             max_messages: int = None) -> AsyncIterator[List[Message]]:
+    """
+    Pages forward through the history of ``channel`` starting right after ``min_id``, so there are no gaps however
+    many messages were posted since then. Only one page is held in memory at a time.
+
+    Parameters
+    ----------
+    client : TelegramClient
+    channel : Channel
+    min_id : int
+        Messages with greater IDs are returned.
+    page_size : int
+    max_messages : int, optional
+        Stops after about this many messages. The caller continues from the last yielded ID later.
+
+    Yields
+    ------
+    List[Message]
+        Chunks of messages (descending, like `get_history` results). Chunks go from the oldest to the newest and an
+        album is never split between two chunks.
+    """
+    cursor = min_id
+    carried = []  # the beginning of an album which may continue on the next page
+    n_yielded = 0
+    while max_messages is None or n_yielded < max_messages:
+        limit = page_size if max_messages is None else min(page_size, max_messages - n_yielded)
+        # reverse=True returns the messages right after offset_id in ascending order
+        page = list(await get_history(client=client, channel=channel, offset_id=cursor, limit=limit, reverse=True))
+        is_last_page = len(page) < limit
+        if page:
+            cursor = page[-1].id
+
+        chunk, carried = carried + page, []
+        if not is_last_page and chunk and chunk[-1].grouped_id is not None:
+            split = len(chunk)
+            while split > 0 and chunk[split - 1].grouped_id == chunk[-1].grouped_id:
+                split -= 1
+            if split > 0:  # otherwise the page is a part of an album, nothing to do about it
+                chunk, carried = chunk[:split], chunk[split:]
+
+        if chunk:
+            n_yielded += len(chunk)
+            yield chunk[::-1]
+        if is_last_page:
+            return
+    logger.debug(f"History of {channel!r} is read up to {max_messages} messages. The rest is left for later")
+
+
+_NO_CHANNEL = ChannelRecord(None, None, None, None)  # the message is not forwarded. Shared as it is immutable
+
+
 # TODO: not use name here at all. Only ID. Everything else is to be found by Channel
 async def get_message_origins(client: TelegramClient, msg: Message):
+    """
+    The channels are the `ChannelRecord` objects shared with the cache and must not be changed. Build a `Channel`
+    from one to change or restore it
+    """
     orig_channel_id = None
     orig_name = None
 
-    fwd_to_name = None
     try:
         if isinstance(msg.fwd_from, MessageFwdHeader):  # if message was forwarded to a place where we got it
             if msg.fwd_from.from_id is not None:
@@ -131,13 +190,19 @@ async def get_message_origins(client: TelegramClient, msg: Message):
             orig_date = msg.date
             orig_channel_id = msg.chat_id
             orig_post_id = msg.id
-            fwd_to_channel_id, fwd_to_name, fwd_date, fwd_to_post_id = None, None, None, None
+            fwd_to_channel_id, fwd_date, fwd_to_post_id = None, None, None
     except:
         logger.error(f"Failed to get source channel name and date\n{msg.stringify()}", exc_info=True)
         return None, None, None, None, None, None
 
-    orig_channel = Channel(channel_id=orig_channel_id, channel_name=orig_name, client=client)
-    fwd_to_channel = Channel(channel_id=fwd_to_channel_id, channel_name=fwd_to_name, client=client)
+    # both in one request if they are not cached
+    records = await resolve_channel_records([ch_id for ch_id in (orig_channel_id, fwd_to_channel_id)
+                                             if ch_id is not None], client)
+    if orig_channel_id is not None:
+        orig_channel = records[orig_channel_id]
+    else:  # hidden author known by the name only
+        orig_channel = ChannelRecord(None, orig_name, None, None)
+    fwd_to_channel = records[fwd_to_channel_id] if fwd_to_channel_id is not None else _NO_CHANNEL
     return orig_channel, orig_date, orig_post_id, fwd_to_channel, fwd_date, fwd_to_post_id
 
 
@@ -242,7 +307,10 @@ template = cleanhtml(MSG_POSTFIX_TEMPLATE)
 postfix_re_pattern = re.sub(r"\{.*?\}", r"(.*)", template)
 
 
-async def extract_msg_features(msg: Message, client: TelegramClient = None, **kwargs):
+async def extract_msg_features(msg: Message, client: TelegramClient = None, origins: tuple = None, **kwargs):
+    """
+    ``origins`` is an already known result of `get_message_origins` for the message. Saves the call if given.
+    """
     result_dict = dict()
     result_dict['src_channel_message_id'] = msg.id  # id of the message where we found it
     result_dict['message_text'] = msg.message
@@ -262,7 +330,9 @@ async def extract_msg_features(msg: Message, client: TelegramClient = None, **kw
         result_dict['src_channel_message_is_grouped'] = True
 
     if client is not None:
-        orig_channel, orig_date, orig_post_id, fwd_to_channel, fwd_date, fwd_to_post_id = await get_message_origins(client, msg)
+        if origins is None:
+            origins = await get_message_origins(client, msg)
+        orig_channel, orig_date, orig_post_id, fwd_to_channel, fwd_date, fwd_to_post_id = origins
 
         result_dict['original_channel_id'] = orig_channel.id  # TODO: check fail with AttributeError: 'NoneType' object has no attribute 'id'
         result_dict['original_channel_link'] = orig_channel.link
@@ -276,10 +346,9 @@ async def extract_msg_features(msg: Message, client: TelegramClient = None, **kw
             if orig_cn_link:  # this message looks like original but it is copypasted by me and this is mentioned in the message
                 # here I stupidly overwrite a lot of fields
                 # our channel becomes source (as it posted the post)
-                src_channel = Channel(channel_id=orig_channel.id, channel_link=orig_channel.link,
-                                      channel_name=orig_channel.name, is_public=orig_channel.is_public)
+                src_channel = Channel.from_record(orig_channel, client=client)  # already resolved, no request
                 # but the creator is the channel from which we got this post
-                orig_channel = Channel(channel_link=orig_cn_link, client=client)
+                orig_channel = await Channel.create(channel_link=orig_cn_link, client=client)
                 result_dict['original_channel_id'] = orig_channel.id
                 result_dict['original_channel_link'] = orig_channel.link
                 result_dict['original_channel_name'] = orig_channel.name
@@ -0,0 +1,349 @@
+"""
+Offline throughput benchmark of the filtering path on synthetic messages, rules and destination histories.
+
+    python -m src.filtering.benchmark --sizes 100 1000 10000
+
+Reports messages per second, the peak memory allocated and the share of the dropped messages by each stage. No client
+or network is used.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from copy import deepcopy
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telethon.tl.patched import Message
+from telethon.tl.types import (PeerChannel, Photo, PhotoSize, Document, DocumentAttributeFilename, WebPage, Poll,
+                               PollAnswer, PollResults, MessageMediaPhoto, MessageMediaDocument, MessageMediaWebPage,
+                               MessageMediaPoll, MessageEntityBold, MessageEntityTextUrl, MessageEntityItalic)
+
+import logging
+
+from src.common.channel import Channel
+from src.common.message_context import BatchContext, MessageContext, message_fingerprint
+from src.common.utils import MSG_POSTFIX_TEMPLATE
+from src.filtering.filter import Filter, filter_messages_with_func, message_is_filtered_by_rules, \
+    message_is_duplicated, _remove_postfix, _postfix_template2pattern
+from src.filtering.history_index import HistoryIndex, HISTORY_INDEX_SIZE
+from src.filtering.image_duplicates import ImageIndex
+from src.filtering.near_duplicates import minhash_signature
+from src.filtering.rule_matcher import RuleMatcher
+from src.filtering.rule_set_cache import RuleSetCache
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_SIZES = (100, 1000, 10000)  # messages per batch
+RULES_COUNT = 500
+DUPLICATE_RATE = 0.1  # of the batch messages repeat the destination history
+AD_RATE = 0.05  # of the batch messages contain a rule phrase
+REPEAT = 3  # the best of the runs is reported
+
+SRC_CH_ID = 1000000001
+DST_CH_ID = 1000000002
+SCRATCH_CH_ID = 1000000003  # the photos of the batch are registered here, so their hashes are known
+VOCABULARY_SIZE = 5000
+
+_DATE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+_KINDS = ('text', 'text', 'text', 'album', 'photo', 'document', 'webpage', 'poll')
+
+
+class SyntheticChannel:
+    """Generator of posts of one channel. IDs grow, the content is random but reproducible by ``seed``."""
+
+    def __init__(self, ch_id: int, seed=0, vocabulary_size=VOCABULARY_SIZE):
+        self.ch_id = ch_id
+        self.rng = random.Random(seed)
+        self.vocabulary = [''.join(self.rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(self.rng.randint(2, 10)))
+                           for _ in range(vocabulary_size)]
+        self.next_id = 1
+        self.next_media_id = ch_id * 10 ** 6
+        self.next_grouped_id = ch_id * 10 ** 6
+
+    def _new_id(self) -> int:
+        self.next_id += 1
+        return self.next_id
+
+    def _new_media_id(self) -> int:
+        self.next_media_id += 1
+        return self.next_media_id
+
+    def text(self, min_words=5, max_words=120) -> str:
+        return ' '.join(self.rng.choice(self.vocabulary) for _ in range(self.rng.randint(min_words, max_words)))
+
+    def _entities(self, text: str) -> list:
+        if len(text) < 20 or self.rng.random() < 0.5:
+            return None
+        return [MessageEntityBold(offset=0, length=10),
+                MessageEntityTextUrl(offset=11, length=5, url=f'https://example.com/{self.rng.randint(0, 10 ** 6)}')]
+
+    def _photo(self) -> Photo:
+        return Photo(id=self._new_media_id(), access_hash=self.rng.getrandbits(63), file_reference=b'\x00',
+                     date=_DATE, sizes=[PhotoSize(type='m', w=320, h=240, size=20000)], dc_id=2)
+
+    def _media(self, kind: str):
+        if kind == 'photo':
+            return MessageMediaPhoto(photo=self._photo())
+        if kind == 'document':
+            return MessageMediaDocument(document=Document(
+                id=self._new_media_id(), access_hash=self.rng.getrandbits(63), file_reference=b'\x00', date=_DATE,
+                mime_type='application/pdf', size=self.rng.randint(10 ** 4, 10 ** 7), dc_id=2,
+                attributes=[DocumentAttributeFilename(file_name='report.pdf')]))
+        if kind == 'webpage':
+            return MessageMediaWebPage(webpage=WebPage(
+                id=self._new_media_id(), url=f'https://example.com/{self.rng.randint(0, 10 ** 9)}',
+                display_url='example.com', hash=0))
+        if kind == 'poll':
+            return MessageMediaPoll(poll=Poll(id=self._new_media_id(), question=self.text(3, 10),
+                                              answers=[PollAnswer(text=self.text(1, 3), option=bytes([i]))
+                                                       for i in range(3)]),
+                                    results=PollResults())
+        return None
+
+    def message(self, text: str = None, media=None, entities=None, grouped_id: int = None) -> Message:
+        return Message(id=self._new_id(), peer_id=PeerChannel(self.ch_id), date=_DATE, message=text or '',
+                       media=media, entities=entities, grouped_id=grouped_id)
+
+    def post(self, kind: str = None) -> List[Message]:
+        """One post, several messages for an album. Descending, as the history comes"""
+        kind = kind or self.rng.choice(_KINDS)
+        if kind == 'album':
+            self.next_grouped_id += 1
+            msg_list = [self.message(text=self.text() if i == 0 else '', media=MessageMediaPhoto(photo=self._photo()),
+                                     grouped_id=self.next_grouped_id) for i in range(self.rng.randint(2, 5))]
+            return msg_list[::-1]
+        text = self.text() if kind in ('text', 'photo', 'document') else ''
+        return [self.message(text=text, media=self._media(kind), entities=self._entities(text))]
+
+    def repost(self, msg: Message, postfix: str = None) -> Message:
+        """The same content under a new ID, optionally with the postfix our bot adds"""
+        text, entities = msg.message, deepcopy(msg.entities)
+        if postfix:
+            entities = (entities or []) + [MessageEntityItalic(offset=len(text) + 3, length=len(postfix) - 3)]
+            text += postfix
+        return self.message(text=text, media=msg.media, entities=entities, grouped_id=msg.grouped_id)
+
+    def messages(self, n: int) -> List[Message]:
+        """``n`` messages, descending. The oldest album may be cut, as it happens to the history pages"""
+        msg_list = []
+        while len(msg_list) < n:
+            msg_list = self.post() + msg_list
+        return msg_list[:n]
+
+
+def generate_rules(channel: SyntheticChannel, n=RULES_COUNT) -> List[str]:
+    """
+    Phrases of 1-3 words of their own vocabulary. The words have digits, which the texts never have, so only the
+    messages the phrases were added to match them
+    """
+    vocabulary = [''.join(channel.rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(channel.rng.randint(3, 8)))
+                  + str(channel.rng.randint(1000, 9999)) for _ in range(n)]
+    return [' '.join(channel.rng.choice(vocabulary) for _ in range(channel.rng.randint(1, 3))) for _ in range(n)]
+
+
+def generate_workload(size: int, seed=0, history_size=HISTORY_INDEX_SIZE):
+    """
+    Source batch of ``size`` messages, the destination history and the rules. ``DUPLICATE_RATE`` of the batch
+    repeats the history, ``AD_RATE`` contains the rule phrases.
+    """
+    src, dst = SyntheticChannel(SRC_CH_ID, seed=seed), SyntheticChannel(DST_CH_ID, seed=seed + 1)
+    dst.vocabulary = src.vocabulary  # so the near duplicate check has something to compare
+    rules = generate_rules(src)
+    postfix = _postfix_example()
+
+    history = dst.messages(history_size)
+    batch = src.messages(size)
+    for i, msg in enumerate(batch):
+        if msg.grouped_id is not None:
+            continue
+        roll = src.rng.random()
+        if roll < DUPLICATE_RATE:
+            batch[i] = src.repost(src.rng.choice(history))
+            batch[i].id = msg.id
+        elif roll < DUPLICATE_RATE + AD_RATE and msg.message:
+            msg.message += ' ' + src.rng.choice(rules)
+    # the bot posts to the destination with the postfix
+    history = [dst.repost(msg, postfix=postfix if msg.message else None) for msg in reversed(history)][::-1]
+    return batch, history, rules
+
+
+def _postfix_example() -> str:
+    from src.filtering.filter import cleanhtml
+
+    return cleanhtml(MSG_POSTFIX_TEMPLATE).format(post_link='https://t.me/c/1/1')
+
+
+class _OfflineHistoryIndex(HistoryIndex):
+    """History index which loads the synthetic histories instead of requesting them"""
+
+    def __init__(self, histories: Dict[int, List[Message]], **kwargs):
+        super().__init__(**kwargs)
+        self.histories = histories
+
+    async def _load(self, client, channel: Channel):
+        history_messages = [self._strip(channel.id, deepcopy(msg)) for msg in self.histories[channel.id]]
+        self._messages[channel.id] = deque(maxlen=self.size)
+        self._fingerprints[channel.id] = {}
+        for msg in reversed(history_messages):
+            self._append(channel.id, msg)
+        self._loaded_at[channel.id] = time.time()
+
+
+def _build_image_index(path: str, batch: List[Message], history: List[Message], rng: random.Random) -> ImageIndex:
+    """Photo hashes are known in advance, so nothing is downloaded. Some batch photos are re-uploads"""
+    image_index = ImageIndex(path=path)
+    history_hashes = []
+    for msg in history:
+        if isinstance(msg.media, MessageMediaPhoto):
+            image_hash = rng.getrandbits(64)
+            history_hashes.append(image_hash)
+            image_index.add(DST_CH_ID, msg.media.photo.id, image_hash)
+    for msg in batch:
+        if isinstance(msg.media, MessageMediaPhoto):
+            if history_hashes and rng.random() < DUPLICATE_RATE:
+                image_hash = rng.choice(history_hashes) ^ (1 << rng.randint(0, 63))  # re-encoded
+            else:
+                image_hash = rng.getrandbits(64)
+            image_index.add(SCRATCH_CH_ID, msg.media.photo.id, image_hash)
+    return image_index
+
+
+def _build_batch_context(batch: List[Message]) -> BatchContext:
+    return BatchContext({msg.id: MessageContext(msg, origins=None, features={}) for msg in batch})
+
+
+def measure(run: Callable, setup: Callable = None, repeat=REPEAT) -> Tuple[float, int, Optional[int]]:
+    """
+    Best wall time of ``run(*setup())`` in seconds, its peak allocated memory in bytes (a separate run) and the
+    number of the dropped messages if ``run`` returns the filtering details
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        run(*args)
+        best = min(best, time.perf_counter() - start)
+    args = setup() if setup is not None else ()
+    tracemalloc.start()
+    result = run(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    dropped = None
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[1], dict):  # (kept, filtering_details)
+        dropped = sum(decision is not None for decision in result[1].values())
+    return best, peak, dropped
+
+
+def benchmark_size(size: int, repeat=REPEAT, seed=0) -> Dict[str, Tuple[float, int, Optional[int]]]:
+    """
+    Stage name -> (best seconds, peak bytes, dropped messages or None) for a batch of ``size`` messages.
+    'rules (compile)' doesn't depend on the batch.
+    """
+    batch, history, rules = generate_workload(size, seed=seed)
+    rng = random.Random(seed)
+    postfix_pattern = _postfix_template2pattern(MSG_POSTFIX_TEMPLATE)
+    dst_ch = Channel(channel_id=DST_CH_ID, channel_name='benchmark', restore_values=False)
+    loop = asyncio.new_event_loop()
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rules_path = os.path.join(tmp_dir, 'rules.json')
+        with open(rules_path, 'w', encoding='utf-8') as f:
+            json.dump({'_common_rb_list': rules}, f)
+        rule_set_cache = RuleSetCache(path=rules_path)
+        image_index = _build_image_index(os.path.join(tmp_dir, 'image_hashes.sqlite'), batch, history, rng)
+
+        history_index = _OfflineHistoryIndex({DST_CH_ID: history})
+        history_messages = loop.run_until_complete(history_index.get_messages(
+            client=None, channel=dst_ch, postfix_re_pattern_to_ignore=postfix_pattern))
+        history_fingerprints = history_index.get_fingerprints(DST_CH_ID)
+
+        def new_filter(**checks):
+            kwargs = dict(rule_base_check=False, history_check=False, near_duplicate_check=False, image_check=False)
+            kwargs.update(checks)
+            return Filter(client=object(), dst_ch=dst_ch, postfix_template_to_ignore=MSG_POSTFIX_TEMPLATE,
+                          history_index=history_index, image_index=image_index, rule_set_cache=rule_set_cache,
+                          **kwargs)
+
+        def details():
+            return ({msg.id: None for msg in batch},)
+
+        rule_matcher = RuleMatcher(rules)
+        results['rules (compile)'] = measure(lambda: RuleMatcher(rules), repeat=repeat)
+        results['rules'] = measure(lambda d: filter_messages_with_func(
+            batch, filter_func=message_is_filtered_by_rules, filtering_details=d, filter_name='rb',
+            rule_matcher=rule_matcher), details, repeat=repeat)
+        results['history (indexed)'] = measure(lambda: [message_is_duplicated(
+            msg, history_messages, history_fingerprints=history_fingerprints) for msg in batch], repeat=repeat)
+        results['history (full scan)'] = measure(lambda: [message_is_duplicated(msg, history_messages)
+                                                          for msg in batch], repeat=repeat)
+        results['fingerprint'] = measure(lambda: [message_fingerprint(msg) for msg in batch], repeat=repeat)
+        # the postfix is removed in place, so every run gets fresh copies
+        reposter, postfix = SyntheticChannel(DST_CH_ID, seed=seed), _postfix_example()
+        results['remove postfix'] = measure(lambda msg_list: [_remove_postfix(msg, postfix_pattern)
+                                                              for msg in msg_list],
+                                            lambda: ([reposter.repost(msg, postfix) for msg in batch],), repeat=repeat)
+
+        def run_filter(filter_component, d):
+            return loop.run_until_complete(filter_component.filter_messages(batch, d, batch_context=batch_context))
+
+        batch_context = _build_batch_context(batch)
+        for name, checks in (('rule stage', dict(rule_base_check=True)),
+                             ('history stage', dict(history_check=True)),
+                             ('near duplicate stage', dict(near_duplicate_check=True)),
+                             ('image stage', dict(image_check=True))):
+            results[name] = measure(run_filter, lambda: (new_filter(**checks),) + details(), repeat=repeat)
+
+        def cold_near_duplicate_setup():
+            minhash_signature.cache_clear()  # as for messages never seen before
+            return (new_filter(near_duplicate_check=True),) + details()
+
+        results['near duplicate stage (cold)'] = measure(run_filter, cold_near_duplicate_setup, repeat=repeat)
+        all_checks = dict(rule_base_check=True, history_check=True, near_duplicate_check=True, image_check=True)
+        results['filter_messages'] = measure(run_filter, lambda: (new_filter(**all_checks),) + details(),
+                                             repeat=repeat)
+
+        def cold_filter_setup():
+            minhash_signature.cache_clear()
+            return (new_filter(**all_checks),) + details()
+
+        results['filter_messages (cold)'] = measure(run_filter, cold_filter_setup, repeat=repeat)
+    loop.close()
+    return results
+
+
+def print_report(size: int, results: Dict[str, Tuple[float, int, Optional[int]]]):
+    # only the messages with text get the phrases, and a duplicated album photo drops the whole album
+    print(f'\n{size} messages. Expected drops: up to {AD_RATE:.0%} by rules, about {DUPLICATE_RATE:.0%} of the texts '
+          f'and photos as duplicates')
+    print(f"{'stage':<30}{'msg/s':>14}{'ms':>12}{'peak KiB':>12}{'dropped':>10}")
+    for name, (seconds, peak, dropped) in results.items():
+        rate = f'{size / seconds:,.0f}' if seconds > 0 and name != 'rules (compile)' else '-'
+        dropped = f'{dropped / size:.1%}' if dropped is not None else '-'
+        print(f'{name:<30}{rate:>14}{seconds * 1000:>12.2f}{peak / 1024:>12,.0f}{dropped:>10}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(BENCHMARK_SIZES),
+                        help='Numbers of messages in the filtered batch')
+    parser.add_argument('--repeat', type=int, default=REPEAT, required=False)
+    parser.add_argument('--seed', type=int, default=0, required=False)
+    parser.add_argument('--log-level', type=str, default='WARNING', required=False,
+                        help='The filter logs every dropped message at INFO, which would be measured as well')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s %(module)s %(levelname)s: %(message)s',
+        level=args.log_level.upper(),
+        datefmt='%a %d.%m.%Y %H:%M:%S',
+        force=True)
+
+    for batch_size in args.sizes:
+        print_report(batch_size, benchmark_size(batch_size, repeat=args.repeat, seed=args.seed))
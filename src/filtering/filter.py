@@ -1,17 +1,23 @@
-import asyncio
 import os
 import re
+from collections import OrderedDict
 from copy import deepcopy
 
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 from telethon.tl.patched import Message
 from telethon.sync import TelegramClient
 from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto, MessageMediaWebPage, MessageMediaPoll
 
-from src.common.utils import get_history, get_message_origins
+from src.common.utils import get_message_origins
 from src.common.get_project_root import get_project_root
-from src.common.database_utils import get_rb_filters
+from src.common.database_utils import get_near_duplicate_thresholds
 from src.common.channel import Channel
+from src.common.message_context import message_fingerprint
+from src.filtering.history_index import HistoryIndex, history_index as default_history_index
+from src.filtering.near_duplicates import message_is_near_duplicated, DEFAULT_NEAR_DUPLICATE_THRESHOLD
+from src.filtering.rule_matcher import RuleMatcher
+from src.filtering.rule_set_cache import RuleSetCache, rule_set_cache as default_rule_set_cache
+from src.filtering.image_duplicates import ImageIndex, image_index as default_image_index, message_image_is_duplicated
 
 import logging
 logger = logging.getLogger(__name__)
@@ -46,6 +52,9 @@ def media_is_duplicated(m1, m2):
     # file reference is different. https://core.telegram.org/api/file_reference
     d1.pop('file_reference', None)
     d2.pop('file_reference', None)
+    # access hash is different for each account. The history index has messages sent by the bot
+    d1.pop('access_hash', None)
+    d2.pop('access_hash', None)
     # drop date as well?
     if d1 == d2:
         return True
@@ -74,56 +83,88 @@ def message_is_same(msg1: Message, msg2: Message):
     return is_duplicated
 
 
-def message_is_duplicated(msg: Message, history_messages: List[Message], client: TelegramClient):
+def find_duplicate(msg: Message, history_messages: List[Message], batch_context=None,
+                   history_fingerprints: Dict[str, List[Message]] = None) -> Optional[Message]:
+    """
+    Returns the history message which is the same as ``msg`` or None.
+    If ``history_fingerprints`` (fingerprint -> history messages) is given, only the history messages with the same
+    fingerprint are compared with ``msg``. Otherwise, all ``history_messages`` are.
+    """
+    if history_fingerprints is not None:
+        try:
+            fingerprint = batch_context.get_fingerprint(msg) if batch_context is not None else message_fingerprint(msg)
+            if fingerprint is None:  # media which can't be compared
+                return None
+            history_messages = history_fingerprints.get(fingerprint, [])
+        except:
+            logger.error(f'Unable to fingerprint a message. Comparing with the whole history\n{msg.stringify()}',
+                         exc_info=True)
     try:
         for history_msg in history_messages:
             if message_is_same(history_msg, msg):  # TODO: check the case where TypeError: 'NoneType' object is not subscriptable (approximately for history_msg)
-                # the rest of the function is for debugging purposes
-                orig_channel1, orig_date1, _, fwd_to_channel1, fwd_date1, _ = asyncio.get_event_loop().run_until_complete(get_message_origins(client, history_msg))
-                orig_channel2, orig_date2, _, fwd_to_channel2, fwd_date2, _ = asyncio.get_event_loop().run_until_complete(get_message_origins(client, msg))
-                if fwd_to_channel1.name is None:  # channel 1 has it's own post
-                    if fwd_to_channel2.name is None:  # channel 2 has it's own post
-                        if orig_date1 > orig_date2:
-                            logger.debug(
-                                f"Message '{history_msg.message[:20]}...' was published by '{orig_channel2.name}' before '{orig_channel1.name}'")
-                        else:
-                            logger.debug(
-                                f"Message '{history_msg.message[:20]}...' was published by '{orig_channel1.name}' before '{orig_channel2.name}'")
-                    else:  # channel 2 has forwarded post
-                        if orig_date1 > fwd_date2:
-                            logger.debug(
-                                f"Message '{history_msg.message[:20]}...' was published by '{fwd_to_channel2.name}' (forwarded from '{orig_channel2.name}') before '{orig_channel1.name}'")
-                        else:
-                            logger.debug(
-                                f"Message '{history_msg.message[:20]}...' was published by '{orig_channel1.name}' before '{fwd_to_channel2.name} (forwarded from '{orig_channel2.name}')")
-                else:  # channel 1 has forwarded post at fwd_date1 date
-                    if fwd_to_channel2.name is None:  # channel 2 has it's own post
-                        if fwd_date1 > orig_date2:
-                            logger.debug(
-                                f"Message '{history_msg.message[:20]}...' was published by '{orig_channel2.name}' before '{fwd_to_channel1.name}' (forwarded from '{orig_channel1.name}')")
-                        else:
-                            logger.debug(
-                                f"Message '{history_msg.message[:20]}...' was published by '{fwd_to_channel1.name}' (forwarded from '{orig_channel1.name}') before '{orig_channel2.name}'")
-                    else:  # channel 2 has forwarded post
-                        if fwd_date1 > fwd_date2:
-                            logger.debug(
-                                f"Message '{history_msg.message[:20]}...' was reposted by '{fwd_to_channel2.name}' at {fwd_date2} (from '{orig_channel2.name}') before '{fwd_to_channel1.name}' at {fwd_date1} (from '{orig_channel1.name}')")
-                        else:
-                            logger.debug(
-                                f"Message '{history_msg.message[:20]}...' was reposted by '{fwd_to_channel1.name}' at {fwd_date1} (from '{orig_channel1.name}') before '{fwd_to_channel2.name}' at {fwd_date2} (from '{orig_channel2.name}')")
-                return True
-        return False
+                return history_msg
+        return None
     except:
-        logger.error(f'unable to run message_is_duplicated\nhistory_msg\n{history_msg.stringify()}\n\nmsg\n{msg.stringify()}', exc_info=True)
-        return False
+        logger.error(f'unable to run find_duplicate\nhistory_msg\n{history_msg.stringify()}\n\nmsg\n{msg.stringify()}', exc_info=True)
+        return None
+
+
+def message_is_duplicated(msg: Message, history_messages: List[Message], batch_context=None,
+                          history_fingerprints: Dict[str, List[Message]] = None) -> bool:
+    return find_duplicate(msg, history_messages, batch_context=batch_context,
+                          history_fingerprints=history_fingerprints) is not None
+
+
+async def log_duplicate_provenance(client: TelegramClient, history_msg: Message, msg: Message, batch_context=None):
+    """Logs which channel published the duplicated content first. Only for debugging: requests the origins"""
+    try:
+        orig_channel1, orig_date1, _, fwd_to_channel1, fwd_date1, _ = await get_message_origins(client, history_msg)
+        origins2 = batch_context.get_origins(msg) if batch_context is not None else None
+        if origins2 is None:
+            origins2 = await get_message_origins(client, msg)
+        orig_channel2, orig_date2, _, fwd_to_channel2, fwd_date2, _ = origins2
+        if fwd_to_channel1.name is None:  # channel 1 has it's own post
+            if fwd_to_channel2.name is None:  # channel 2 has it's own post
+                if orig_date1 > orig_date2:
+                    logger.debug(
+                        f"Message '{history_msg.message[:20]}...' was published by '{orig_channel2.name}' before '{orig_channel1.name}'")
+                else:
+                    logger.debug(
+                        f"Message '{history_msg.message[:20]}...' was published by '{orig_channel1.name}' before '{orig_channel2.name}'")
+            else:  # channel 2 has forwarded post
+                if orig_date1 > fwd_date2:
+                    logger.debug(
+                        f"Message '{history_msg.message[:20]}...' was published by '{fwd_to_channel2.name}' (forwarded from '{orig_channel2.name}') before '{orig_channel1.name}'")
+                else:
+                    logger.debug(
+                        f"Message '{history_msg.message[:20]}...' was published by '{orig_channel1.name}' before '{fwd_to_channel2.name} (forwarded from '{orig_channel2.name}')")
+        else:  # channel 1 has forwarded post at fwd_date1 date
+            if fwd_to_channel2.name is None:  # channel 2 has it's own post
+                if fwd_date1 > orig_date2:
+                    logger.debug(
+                        f"Message '{history_msg.message[:20]}...' was published by '{orig_channel2.name}' before '{fwd_to_channel1.name}' (forwarded from '{orig_channel1.name}')")
+                else:
+                    logger.debug(
+                        f"Message '{history_msg.message[:20]}...' was published by '{fwd_to_channel1.name}' (forwarded from '{orig_channel1.name}') before '{orig_channel2.name}'")
+            else:  # channel 2 has forwarded post
+                if fwd_date1 > fwd_date2:
+                    logger.debug(
+                        f"Message '{history_msg.message[:20]}...' was reposted by '{fwd_to_channel2.name}' at {fwd_date2} (from '{orig_channel2.name}') before '{fwd_to_channel1.name}' at {fwd_date1} (from '{orig_channel1.name}')")
+                else:
+                    logger.debug(
+                        f"Message '{history_msg.message[:20]}...' was reposted by '{fwd_to_channel1.name}' at {fwd_date1} (from '{orig_channel1.name}') before '{fwd_to_channel2.name}' at {fwd_date2} (from '{orig_channel2.name}')")
+    except:
+        logger.error(f'unable to log the provenance of a duplicate\nhistory_msg\n{history_msg.stringify()}\n\n'
+                     f'msg\n{msg.stringify()}', exc_info=True)
 
 
-def message_is_filtered_by_rules(msg: Message, rules_list: List[str]):
+def message_is_filtered_by_rules(msg: Message, rules_list: List[str] = None, rule_matcher: RuleMatcher = None):
     """
     Checks if the message contains content to filter. If fails, returns False (to keep) result.
     Each rule is compared in lowercase against the message
     :param msg:
-    :param rules_list:
+    :param rules_list: compiled into a RuleMatcher on each call. Pass ``rule_matcher`` to check many messages
+    :param rule_matcher: rules compiled once
     :return:
     """
     if msg.message is None:
@@ -131,84 +172,88 @@ def message_is_filtered_by_rules(msg: Message, rules_list: List[str]):
         return False
 
     try:
-        for phrase in rules_list:
-            if msg.message.lower().find(phrase.lower()) != -1:
-                logger.info(f"Message id {msg.id} is filtered according to the rule: {phrase}")
-                return True
+        rule_matcher = rule_matcher or RuleMatcher(rules_list)
+        phrase = rule_matcher.find(msg.message)
+        if phrase is not None:
+            logger.info(f"Message id {msg.id} is filtered according to the rule: {phrase}")
+            return True
         return False
     except:
-        logger.error(f"Failed to check the message against the phrase {phrase}:\n{msg}", exc_info=True)
+        logger.error(f"Failed to check the message against the rules:\n{msg}", exc_info=True)
         return False
 
 
+def _group_key(msg: Message) -> tuple:
+    # an ungrouped message is a group of its own
+    return ('group', msg.grouped_id) if msg.grouped_id is not None else ('msg', msg.id)
+
+
+def group_messages(msg_list: List[Message]) -> 'OrderedDict[tuple, List[Message]]':
+    """
+    Splits a descending list of messages into groups by ``grouped_id``. The groups and the messages inside them go
+    from the oldest, so the first message of a group is the one with the text.
+    """
+    groups = OrderedDict()
+    for msg in reversed(msg_list):
+        groups.setdefault(_group_key(msg), []).append(msg)
+    return groups
+
+
+def _drop_groups(msg_list: List[Message], to_drop_keys: Set[tuple], filtering_details: Dict[int, Optional[str]],
+                 filter_name: str) -> Tuple[List[Message], Dict[int, Optional[str]]]:
+    msg_list_clean = [msg for msg in msg_list if _group_key(msg) not in to_drop_keys]  # msg_list is descending
+    dropped_ids = {msg.id for msg in msg_list if _group_key(msg) in to_drop_keys}
+    logger.log(5, f'to_drop_message_ids: {sorted(dropped_ids)}')
+
+    # None for passing messages, filter_name from the previous or the current step if filtered out
+    filtering_details = {msg_id: (filter_name if v is None and msg_id in dropped_ids else v)
+                         for msg_id, v in filtering_details.items()}
+    return msg_list_clean, filtering_details
+
+
 def filter_messages_with_func(msg_list: List[Message], filter_func, filtering_details,
-                              filter_name, **filter_func_kwargs) -> List[Message]:
+                              filter_name, **filter_func_kwargs) -> Tuple[List[Message], Dict[int, Optional[str]]]:
     """
     From a list of messages which was planned to be sent removes the ones according to the filter_func.
     If at least one of the messages in the group is filtered out, the whole group will be dropped
-    as well. But the decision is based on each messages independently.
+    as well. But the decision is based on each messages independently, starting from the oldest one.
+    The rest of the group is not checked after its first filtered message.
 
     Parameters
     ----------
     msg_list
+        Descending.
     filter_func
+        ``filter_func(msg, **filter_func_kwargs) -> bool``, True to drop the message.
     filtering_details
+        Message ID -> None for the passing messages or the name of the filter which dropped the message.
     filter_name
     filter_func_kwargs
 
     Returns
     -------
-
+    The passed messages in the original order and the updated filtering details.
     """
-    msg_list_clean = []
-    to_drop_group_id = -1
-    to_drop_message_ids = []
-
-    # when a message from a message group to be filtered but some messages from this group have already passed
-    to_drop_groups_after_check = []
-
-    # starting from the oldest. for grouped, the first is text
-    for msg in reversed(msg_list):
-        if filter_func(msg, **filter_func_kwargs):
-            if msg.grouped_id is not None:
-                to_drop_group_id = msg.grouped_id
-                to_drop_groups_after_check.append(to_drop_group_id)
-                to_drop_message = msg.message
-            to_drop_message_ids.append(msg.id)
-        else:
-            if msg.grouped_id != to_drop_group_id:  # no group also counts
-                msg_list_clean.append(msg)
-            else:
-                logger.log(5, f'removed an indirect spam message from to_drop group {to_drop_group_id}. '
-                              f'To_drop message:\n{to_drop_message[:20]}')
-                to_drop_message_ids.append(msg.id)
-    logger.log(5, f'to_drop_message_ids: {to_drop_message_ids}')
-
-    after_check_drop_list = []
-    for msg in msg_list_clean:
-        if msg.grouped_id in to_drop_groups_after_check:
-            after_check_drop_list.append(msg)
-    if after_check_drop_list:
-        logger.info('Some message was filtered in the middle of the group')
-        msg_list_clean = [msg for msg in msg_list_clean if msg not in after_check_drop_list]
-
-    msg_list_clean.reverse()  # for consistency, msg_list is always descending
-
-    # None for passing messages, filter_name from the previous or the current step if filtered out
-    filtering_details = {
-        msg_id: (v if v is not None or msg_id in [m.id for m in msg_list_clean] else filter_name) for
-        msg_id, v in
-        filtering_details.items()}
-
-    return msg_list_clean, filtering_details
+    to_drop_keys = set()
+    for key, group in group_messages(msg_list).items():
+        for i, msg in enumerate(group):
+            if filter_func(msg, **filter_func_kwargs):
+                to_drop_keys.add(key)
+                if i > 0:
+                    logger.info('Some message was filtered in the middle of the group')
+                break
+    return _drop_groups(msg_list, to_drop_keys, filtering_details, filter_name)
 
 
 def filter_groups_with_func(msg_list: List[Message], filter_func, filtering_details,
-                            filter_name, **filter_func_kwargs) -> List[Message]:
-    pass
-    # build a dict for each group and their messages starting from the oldest one (with text)
-    # iterate over the dict and apply the filtering func which works on a group level
-    # concat back the survivors and return
+                            filter_name, **filter_func_kwargs) -> Tuple[List[Message], Dict[int, Optional[str]]]:
+    """
+    The same as ``filter_messages_with_func``, but the decision is made for the whole group at once:
+    ``filter_func(group, **filter_func_kwargs) -> bool`` gets the messages of the group starting from the oldest
+    one (with the text). An ungrouped message comes as a group of one.
+    """
+    to_drop_keys = {key for key, group in group_messages(msg_list).items() if filter_func(group, **filter_func_kwargs)}
+    return _drop_groups(msg_list, to_drop_keys, filtering_details, filter_name)
 
 
 def _remove_postfix(msg: Message, postfix_re_pattern_to_ignore=None):
@@ -242,7 +287,9 @@ def _postfix_template2pattern(postfix_template_to_ignore):
 
 class Filter:
     def __init__(self, rule_base_check=True, history_check=True, client: TelegramClient=None, dst_ch: Channel = None,
-                 use_common_rules=True, postfix_template_to_ignore=None):
+                 use_common_rules=True, postfix_template_to_ignore=None, history_index: HistoryIndex = None,
+                 near_duplicate_check=True, image_check=True, image_index: ImageIndex = None,
+                 rule_set_cache: RuleSetCache = None):
         """
 
         Parameters
@@ -253,61 +300,133 @@ class Filter:
             User client from the main feed. Rich client with long history helps avoiding dead queries.
         dst_ch
         use_common_rules
+        history_index : HistoryIndex, optional
+            Source of the destination channel history. The process-wide index is used by default.
+        near_duplicate_check : bool, default True
+            Drops long texts similar to the recent posts of ``dst_ch``. The similarity threshold may be set per
+            destination channel in the near duplicate thresholds file.
+        image_check : bool, default True
+            Drops photos perceptually similar to the photos posted to ``dst_ch``.
+        image_index : ImageIndex, optional
+            Photo hashes. The process-wide index is used by default.
+        rule_set_cache : RuleSetCache, optional
+            Source of the compiled rules. The process-wide cache is used by default.
         """
         self.rule_base_check = rule_base_check
         self.use_common_rules = use_common_rules
         self.history_check = history_check
+        self.near_duplicate_check = near_duplicate_check
+        self.image_check = image_check
+        self.image_index = image_index or default_image_index
+        self.uses_dst_history = self.history_check or self.near_duplicate_check or self.image_check
         self.client = client
         self.dst_ch = dst_ch
         self.postfix_re_pattern_to_ignore = _postfix_template2pattern(postfix_template_to_ignore)
+        self.history_index = history_index or default_history_index
+        self.rule_set_cache = rule_set_cache or default_rule_set_cache
         # TODO: apart from adapting text, we need to remove the entities we added...
 
+        self.rules_version = None
         if self.rule_base_check:
-            self.checkrules_list = self._get_rb_list()
+            # compiled once per version of the rules file and shared by the filters of the destination
+            self.rule_matcher = self.rule_set_cache.get_matcher(self.dst_ch.id if self.dst_ch is not None else None,
+                                                                use_common_rules=self.use_common_rules)
+            self.rules_version = self.rule_set_cache.version
+            self.checkrules_list = self.rule_matcher.rules
             if self.checkrules_list == []:
                 logger.debug("There are no advertising\\filtering rules to check")
 
-        if self.history_check and (self.client is None):
+        if self.uses_dst_history and (self.client is None):
             raise ValueError("If history check is performed, 'client' parameter has to be provided")
-        if self.history_check and (self.dst_ch is None):
+        if self.uses_dst_history and (self.dst_ch is None):
             raise ValueError("If history check is performed, 'dst_ch' parameter has to be provided")
 
-    def _get_rb_list(self, ) -> List:
-        all_rules = get_rb_filters()
-        rules = []
-        if self.use_common_rules:
-            rules += all_rules['_common_rb_list']
-        if self.dst_ch is not None:
-            rules += all_rules[str(self.dst_ch.id)]  # TODO: serialize during reading above?
-        return rules
+        self.near_duplicate_threshold = None
+        if self.near_duplicate_check:
+            self.near_duplicate_threshold = get_near_duplicate_thresholds().get(self.dst_ch.id,
+                                                                                DEFAULT_NEAR_DUPLICATE_THRESHOLD)
+
+        # TODO: mb split common/personal rb
+        self.stages = []
+        if self.rule_base_check and self.checkrules_list != []:
+            self.stages.append(self._rule_based_stage)
+        if self.history_check:
+            self.stages.append(self._history_stage)
+        if self.near_duplicate_check:
+            self.stages.append(self._near_duplicate_stage)
+        if self.image_check:
+            self.stages.append(self._image_stage)
+
+    def add_stage(self, stage):
+        """
+        Appends a stage. A stage is an async callable
+        ``stage(msg_list, filtering_details, batch_context) -> (msg_list, filtering_details)``.
+        """
+        self.stages.append(stage)
+
+    async def _get_dst_history(self) -> List[Message]:
+        # the history is fetched once and then extended by the sender after every message forwarded to my channel
+        return await self.history_index.get_messages(client=self.client, channel=self.dst_ch,
+                                                     postfix_re_pattern_to_ignore=self.postfix_re_pattern_to_ignore,
+                                                     near_duplicate_threshold=self.near_duplicate_threshold)
+
+    async def _rule_based_stage(self, msg_list: List[Message], filtering_details, batch_context=None):
+        logger.log(5, f"Performing a rule-based filtering for {self.dst_ch!r}")
+        return filter_messages_with_func(msg_list, filter_func=message_is_filtered_by_rules,
+                                         filtering_details=filtering_details, filter_name='rb',
+                                         rule_matcher=self.rule_matcher)
+
+    async def _history_stage(self, msg_list: List[Message], filtering_details, batch_context=None):
+        logger.log(8, f"Performing a history filtering for {self.dst_ch!r}")
+        dst_channel_history_messages = await self._get_dst_history()
+        duplicates = {}  # message ID -> (message, the same history message)
+
+        def is_duplicated(msg: Message) -> bool:
+            history_msg = find_duplicate(msg, dst_channel_history_messages, batch_context=batch_context,
+                                         history_fingerprints=self.history_index.get_fingerprints(self.dst_ch.id))
+            if history_msg is not None:
+                duplicates[msg.id] = (msg, history_msg)
+            return history_msg is not None
+
+        msg_list, filtering_details = filter_messages_with_func(msg_list, filter_func=is_duplicated,
+                                                                filtering_details=filtering_details, filter_name='hist')
+        # the provenance costs requests, so it's found only if it's going to be logged
+        if duplicates and logger.isEnabledFor(logging.DEBUG):
+            for msg, history_msg in duplicates.values():
+                await log_duplicate_provenance(self.client, history_msg, msg, batch_context=batch_context)
+        return msg_list, filtering_details
 
-    def filter_messages(self, msg_list: List[Message], filtering_details) -> List[Message]:
+    async def _near_duplicate_stage(self, msg_list: List[Message], filtering_details, batch_context=None):
+        logger.log(8, f"Performing a near duplicate filtering for {self.dst_ch!r}")
+        await self._get_dst_history()
+        return filter_messages_with_func(msg_list, filter_func=message_is_near_duplicated,
+                                         filtering_details=filtering_details, filter_name='near_dup',
+                                         near_duplicate_index=self.history_index.get_near_duplicate_index(self.dst_ch.id))
+
+    async def _image_stage(self, msg_list: List[Message], filtering_details, batch_context=None):
+        logger.log(8, f"Performing an image filtering for {self.dst_ch!r}")
+        # photos are downloaded only once, later their hashes are taken from the disk
+        await self.image_index.index_channel_messages(self.client, self.dst_ch.id, await self._get_dst_history())
+        image_hashes = await self.image_index.get_hashes(self.client, msg_list)
+        return filter_messages_with_func(msg_list, filter_func=message_image_is_duplicated,
+                                         filtering_details=filtering_details, filter_name='img',
+                                         image_hashes=image_hashes, image_index=self.image_index,
+                                         ch_id=self.dst_ch.id)
+
+    async def filter_messages(self, msg_list: List[Message], filtering_details,
+                              batch_context=None) -> List[Message]:
         """
-        Returns messages in the original order.
+        Returns messages in the original order. The stages run one after another while there are messages left.
 
         :param msg_list:
+        :param batch_context: BatchContext of msg_list shared between the destinations, optional
         :return:
         """
         len_before = len(msg_list)
-
-        # TODO: mb split common/personal rb
-        if self.rule_base_check and self.checkrules_list != []:
-            logger.log(5, f"Performing a rule-based filtering for {self.dst_ch!r}")
-            msg_list, filtering_details = filter_messages_with_func(msg_list, filter_func=message_is_filtered_by_rules,
-                                                                    filtering_details=filtering_details, filter_name='rb',
-                                                                    rules_list=self.checkrules_list)
-        if msg_list and self.history_check:
-            logger.log(8, f"Performing a history filtering for {self.dst_ch!r}")
-            # history has to be more or less global and extended after every message forwarded to my channel
-            # instead of querying every time
-            dst_channel_history_messages = asyncio.get_event_loop().run_until_complete(
-                get_history(client=self.client, channel=self.dst_ch, limit=100))
-            dst_channel_history_messages = [msg for msg in dst_channel_history_messages if msg.action is None]  # filter out channel creation, voice calls, etc.
-            dst_channel_history_messages = [_remove_postfix(msg, self.postfix_re_pattern_to_ignore) for msg in dst_channel_history_messages]
-            msg_list, filtering_details = filter_messages_with_func(msg_list, filter_func=message_is_duplicated,
-                                                                    filtering_details=filtering_details, filter_name='hist',
-                                                                    history_messages=dst_channel_history_messages,
-                                                                    client=self.client)
+        for stage in self.stages:
+            if not msg_list:
+                break
+            msg_list, filtering_details = await stage(msg_list, filtering_details, batch_context)
         if len_before != len(msg_list):
             logger.debug(f'Before filtering: {len_before}. After: {len(msg_list)}')
         return msg_list, filtering_details
@@ -345,6 +464,7 @@ if __name__ == '__main__':
     ))
 
     messages = to_filter_messages.messages
-    messages_checked_list, filtering_details = filtering_component.filter_messages(messages)
+    messages_checked_list, filtering_details = client.loop.run_until_complete(
+        filtering_component.filter_messages(messages, {msg.id: None for msg in messages}))
     print(f'Before {len(messages)}. After {len(messages_checked_list)}')
     print('filtering_details', filtering_details)
@@ -0,0 +1,135 @@
+import asyncio
+import time
+from collections import deque
+from typing import Dict, List, Union
+
+from telethon import TelegramClient
+from telethon.tl.patched import Message
+
+import logging
+
+from src.common.channel import Channel
+from src.common.message_context import message_fingerprint
+from src.common.utils import get_history
+from src.filtering.near_duplicates import NearDuplicateIndex, DEFAULT_NEAR_DUPLICATE_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+HISTORY_INDEX_SIZE = 100  # messages per destination channel
+# posts which were not sent by us (e.g. by the channel owner) get into the index only with a reload
+HISTORY_INDEX_TTL_SEC = 3600
+
+
+class HistoryIndex:
+    """
+    Recent messages of the destination channels used by the history check of `Filter`. The history of a channel is
+    fetched once and then extended by the sender after every post, so a filter run doesn't call the API. Messages
+    are stored with the postfix already removed and are indexed by `message_fingerprint`, so looking for a duplicate
+    is a dict lookup instead of a comparison with every message. Texts are also added to a `NearDuplicateIndex` of
+    the channel which remembers many more posts than ``size``.
+
+    Parameters
+    ----------
+    size : int
+        Number of the most recent messages kept per channel.
+    ttl : float
+        Seconds after which the history of a channel is fetched again.
+    """
+
+    def __init__(self, size=HISTORY_INDEX_SIZE, ttl=HISTORY_INDEX_TTL_SEC):
+        self.size = size
+        self.ttl = ttl
+        self._messages: Dict[int, deque] = {}  # channel ID -> (fingerprint, message), the newest first
+        self._fingerprints: Dict[int, Dict[str, List[Message]]] = {}  # channel ID -> fingerprint -> messages
+        self._loaded_at: Dict[int, float] = {}
+        self._postfix_patterns: Dict[int, str] = {}
+        self._near_duplicates: Dict[int, NearDuplicateIndex] = {}  # kept on reloads
+        self._locks: Dict[int, asyncio.Lock] = {}
+
+    def _strip(self, ch_id: int, msg: Message) -> Message:
+        from src.filtering.filter import _remove_postfix  # the filter module imports this one
+
+        return _remove_postfix(msg, self._postfix_patterns.get(ch_id))
+
+    def _is_fresh(self, ch_id: int) -> bool:
+        return ch_id in self._messages and time.time() - self._loaded_at[ch_id] < self.ttl
+
+    async def get_messages(self, client: TelegramClient, channel: Channel, postfix_re_pattern_to_ignore=None,
+                           near_duplicate_threshold: float = None) -> List[Message]:
+        """Returns the recent messages of ``channel`` (descending). Fetches them if they are not loaded yet."""
+        self._postfix_patterns[channel.id] = postfix_re_pattern_to_ignore
+        near_duplicate_index = self._near_duplicates.get(channel.id)
+        if near_duplicate_index is None:
+            self._near_duplicates[channel.id] = NearDuplicateIndex(
+                threshold=near_duplicate_threshold or DEFAULT_NEAR_DUPLICATE_THRESHOLD)
+        elif near_duplicate_threshold is not None and near_duplicate_threshold != near_duplicate_index.threshold:
+            near_duplicate_index.set_threshold(near_duplicate_threshold)
+        if not self._is_fresh(channel.id):
+            lock = self._locks.setdefault(channel.id, asyncio.Lock())
+            async with lock:
+                if not self._is_fresh(channel.id):  # may have been loaded while waiting for the lock
+                    await self._load(client, channel)
+        return [msg for _, msg in self._messages[channel.id]]
+
+    async def _load(self, client: TelegramClient, channel: Channel):
+        loaded_at = time.time()  # before the request: a post sent during it may be missing
+        history_messages = await get_history(client=client, channel=channel, limit=self.size)
+        # filter out channel creation, voice calls, etc.
+        history_messages = [self._strip(channel.id, msg) for msg in history_messages if msg.action is None]
+        self._messages[channel.id] = deque(maxlen=self.size)
+        self._fingerprints[channel.id] = {}
+        for msg in reversed(history_messages):  # from the oldest, as if they were added one by one
+            self._append(channel.id, msg)
+        self._loaded_at[channel.id] = loaded_at
+        logger.log(7, f"History index of {channel!r} is loaded with {len(history_messages)} message(s)")
+
+    def add(self, ch_id: int, sent: Union[Message, List[Message]]):
+        """
+        Registers messages posted to the channel. Ignored if the channel history is not loaded yet: they will be
+        fetched with it.
+        """
+        if ch_id not in self._messages or sent is None:
+            return
+        sent = sent if isinstance(sent, list) else [sent]
+        for msg in sorted(sent, key=lambda m: m.id):
+            self._append(ch_id, self._strip(ch_id, msg))
+        logger.log(5, f"{len(sent)} message(s) are added to the history index of {ch_id}")
+
+    def _append(self, ch_id: int, msg: Message):
+        messages, fingerprints = self._messages[ch_id], self._fingerprints[ch_id]
+        if len(messages) == messages.maxlen:
+            evicted_fingerprint, evicted = messages.pop()
+            if evicted_fingerprint is not None:
+                remaining = [m for m in fingerprints[evicted_fingerprint] if m is not evicted]
+                if remaining:
+                    fingerprints[evicted_fingerprint] = remaining
+                else:
+                    del fingerprints[evicted_fingerprint]
+        fingerprint = message_fingerprint(msg)  # computed once per message
+        messages.appendleft((fingerprint, msg))
+        if fingerprint is not None:  # such messages are never the same as another one
+            fingerprints.setdefault(fingerprint, []).append(msg)
+        if msg.message:
+            self._near_duplicates[ch_id].add((msg.chat_id, msg.id), msg.message)
+
+    def get_fingerprints(self, ch_id: int) -> Dict[str, List[Message]]:
+        """Fingerprint -> messages of a loaded channel. Has to be called after `get_messages`."""
+        return self._fingerprints[ch_id]
+
+    def get_near_duplicate_index(self, ch_id: int) -> NearDuplicateIndex:
+        """Near duplicate index of a loaded channel. Has to be called after `get_messages`."""
+        return self._near_duplicates[ch_id]
+
+    def invalidate(self, ch_id: int):
+        self._messages.pop(ch_id, None)
+        self._fingerprints.pop(ch_id, None)
+        self._loaded_at.pop(ch_id, None)
+
+    def invalidate_if_older(self, ch_id: int, changed_at: float = None):
+        """Drops the history of the channel if it was loaded before ``changed_at``, e.g. a post by another process"""
+        if changed_at is not None and self._loaded_at.get(ch_id, changed_at) < changed_at:
+            logger.log(5, f"History index of {ch_id} is outdated by a post of another process")
+            self.invalidate(ch_id)
+
+
+history_index = HistoryIndex()
@@ -0,0 +1,246 @@
+import io
+import os
+import sqlite3
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from telethon import TelegramClient
+from telethon.tl.patched import Message
+from telethon.tl.types import MessageMediaPhoto, PhotoStrippedSize, PhotoSizeEmpty
+
+import logging
+
+from src.common.client_manager import borrow_client
+from src.common.get_project_root import get_project_root
+
+logger = logging.getLogger(__name__)
+
+IMAGE_HASHES_FILEPATH = 'src/data/image_hashes.sqlite'
+IMAGE_HASH_MAX_DISTANCE = 8  # of 64 bits. Re-encoded or slightly resized images stay within it
+CHANNEL_IMAGES_LIMIT = 50000  # the most recent images of a channel loaded from the disk
+
+_HASH_SIZE = 8
+_DCT_SIZE = 32
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT = _dct_matrix(_DCT_SIZE)
+
+
+def perceptual_hash(image_bytes: bytes) -> int:
+    """64-bit pHash: signs of the lowest frequencies of the DCT of the downscaled grayscale image."""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        pixels = np.asarray(image.convert('L').resize((_DCT_SIZE, _DCT_SIZE), Image.LANCZOS), dtype=np.float64)
+    low_frequencies = (_DCT @ pixels @ _DCT.T)[:_HASH_SIZE, :_HASH_SIZE].flatten()
+    bits = low_frequencies > np.median(low_frequencies[1:])  # the DC term would shift the median
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+
+def hamming_distance(hash1: int, hash2: int) -> int:
+    return bin(hash1 ^ hash2).count('1')
+
+
+class BKTree:
+    """Burkhard-Keller tree over Hamming distance: finds all the hashes within a distance without a full scan."""
+
+    def __init__(self):
+        self._root = None  # [hash, keys, {distance: child}]
+        self._size = 0
+
+    def add(self, image_hash: int, key: Hashable):
+        self._size += 1
+        if self._root is None:
+            self._root = [image_hash, [key], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(image_hash, node[0])
+            if distance == 0:
+                node[1].append(key)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [image_hash, [key], {}]
+                return
+            node = child
+
+    def search(self, image_hash: int, max_distance: int) -> List[Tuple[Hashable, int]]:
+        """Keys of the hashes within ``max_distance`` with their distances"""
+        found = []
+        to_visit = [self._root] if self._root is not None else []
+        while to_visit:
+            node_hash, keys, children = to_visit.pop()
+            distance = hamming_distance(image_hash, node_hash)
+            if distance <= max_distance:
+                found.extend((key, distance) for key in keys)
+            # the triangle inequality rules out the other subtrees
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    to_visit.append(child)
+        return sorted(found, key=lambda f: f[1])
+
+    def __len__(self):
+        return self._size
+
+
+def _to_signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def _get_smallest_thumb(photo):
+    """The smallest downloadable size. The stripped one is only used if there is nothing else."""
+    sizes = [size for size in photo.sizes if not isinstance(size, PhotoSizeEmpty)]
+    downloadable = [size for size in sizes if not isinstance(size, PhotoStrippedSize)]
+    if downloadable:
+        return min(downloadable, key=lambda size: getattr(size, 'w', 0) * getattr(size, 'h', 0))
+    return sizes[0] if sizes else None
+
+
+class ImageIndex:
+    """
+    Perceptual hashes of photos stored on the disk by photo ID, so each photo is downloaded and hashed only once,
+    and per channel BK-trees of the photos posted there to look for re-uploaded duplicates.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite file.
+    max_distance : int
+        Max Hamming distance between the hashes of duplicated images.
+    """
+
+    def __init__(self, path: str = None, max_distance=IMAGE_HASH_MAX_DISTANCE):
+        self.path = path or os.path.join(get_project_root(), IMAGE_HASHES_FILEPATH)
+        self.max_distance = max_distance
+        self._conn = None
+        self._trees: Dict[int, BKTree] = {}
+        self._channel_photo_ids: Dict[int, set] = {}
+
+    def _get_conn(self) -> sqlite3.Connection:
+        # opened lazily not to create the file for the processes which don't use the image check
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS photo_hashes (photo_id INTEGER PRIMARY KEY, '
+                               'phash INTEGER NOT NULL)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS channel_photos (channel_id INTEGER NOT NULL, '
+                               'photo_id INTEGER NOT NULL, PRIMARY KEY (channel_id, photo_id))')
+            self._conn.commit()
+        return self._conn
+
+    def get_cached_hash(self, photo_id: int) -> Optional[int]:
+        row = self._get_conn().execute('SELECT phash FROM photo_hashes WHERE photo_id = ?', (photo_id,)).fetchone()
+        return _to_unsigned(row[0]) if row is not None else None
+
+    async def get_hash(self, client: TelegramClient, msg: Message) -> Optional[int]:
+        """Hash of the photo of ``msg`` or None if it has no photo. Downloaded only if not known yet."""
+        if not isinstance(msg.media, MessageMediaPhoto) or msg.media.photo is None:
+            return None
+        photo = msg.media.photo
+        image_hash = self.get_cached_hash(photo.id)
+        if image_hash is not None:
+            return image_hash
+
+        thumb = _get_smallest_thumb(photo)
+        if thumb is None:
+            return None
+        try:
+            async with borrow_client(client):
+                image_bytes = await client.download_media(msg, bytes, thumb=thumb)
+            image_hash = perceptual_hash(image_bytes)
+        except:
+            logger.error(f"Unable to hash the photo of message {msg.id} in {msg.chat_id}", exc_info=True)
+            return None
+        self._get_conn().execute('INSERT OR REPLACE INTO photo_hashes (photo_id, phash) VALUES (?, ?)',
+                                 (photo.id, _to_signed(image_hash)))
+        self._get_conn().commit()
+        return image_hash
+
+    async def get_hashes(self, client: TelegramClient, msg_list: List[Message]) -> Dict[int, int]:
+        """Message ID -> photo hash for the messages with photos"""
+        hashes = {}
+        for msg in msg_list:
+            image_hash = await self.get_hash(client, msg)
+            if image_hash is not None:
+                hashes[msg.id] = image_hash
+        return hashes
+
+    def _get_tree(self, ch_id: int) -> BKTree:
+        tree = self._trees.get(ch_id)
+        if tree is None:
+            tree = self._trees[ch_id] = BKTree()
+            self._channel_photo_ids[ch_id] = set()
+            rows = self._get_conn().execute(
+                'SELECT channel_photos.photo_id, phash FROM channel_photos '
+                'JOIN photo_hashes ON channel_photos.photo_id = photo_hashes.photo_id '
+                'WHERE channel_id = ? ORDER BY channel_photos.rowid DESC LIMIT ?',
+                (ch_id, CHANNEL_IMAGES_LIMIT)).fetchall()
+            for photo_id, image_hash in rows:
+                tree.add(_to_unsigned(image_hash), photo_id)
+                self._channel_photo_ids[ch_id].add(photo_id)
+            logger.log(7, f"Image index of {ch_id} is loaded with {len(rows)} photo(s)")
+        return tree
+
+    def add(self, ch_id: int, photo_id: int, image_hash: int):
+        """Registers a photo posted to the channel"""
+        tree = self._get_tree(ch_id)
+        if photo_id in self._channel_photo_ids[ch_id]:
+            return
+        tree.add(image_hash, photo_id)
+        self._channel_photo_ids[ch_id].add(photo_id)
+        self._get_conn().execute('INSERT OR IGNORE INTO photo_hashes (photo_id, phash) VALUES (?, ?)',
+                                 (photo_id, _to_signed(image_hash)))
+        self._get_conn().execute('INSERT OR IGNORE INTO channel_photos (channel_id, photo_id) VALUES (?, ?)',
+                                 (ch_id, photo_id))
+        self._get_conn().commit()
+
+    def add_message(self, ch_id: int, msg: Message):
+        """Registers the photo of a message posted to the channel if its hash is known. Never downloads."""
+        if isinstance(msg.media, MessageMediaPhoto) and msg.media.photo is not None:
+            image_hash = self.get_cached_hash(msg.media.photo.id)
+            if image_hash is not None:
+                self.add(ch_id, msg.media.photo.id, image_hash)
+
+    async def index_channel_messages(self, client: TelegramClient, ch_id: int, msg_list: List[Message]):
+        """Registers the photos of the messages already posted to the channel, downloading the unknown ones"""
+        self._get_tree(ch_id)
+        for msg in msg_list:
+            if not isinstance(msg.media, MessageMediaPhoto) or msg.media.photo is None:
+                continue
+            if msg.media.photo.id in self._channel_photo_ids[ch_id]:
+                continue
+            image_hash = await self.get_hash(client, msg)
+            if image_hash is not None:
+                self.add(ch_id, msg.media.photo.id, image_hash)
+
+    def find_similar(self, ch_id: int, image_hash: int) -> List[Tuple[int, int]]:
+        """IDs of the photos of the channel similar to the hash with their distances, the closest first"""
+        return self._get_tree(ch_id).search(image_hash, self.max_distance)
+
+
+def message_image_is_duplicated(msg: Message, image_hashes: Dict[int, int], image_index: ImageIndex,
+                                ch_id: int) -> bool:
+    image_hash = image_hashes.get(msg.id)
+    if image_hash is None:
+        return False
+    similar = image_index.find_similar(ch_id, image_hash)
+    if similar:
+        logger.debug(f"Photo of message {msg.id} is a duplicate of photo {similar[0][0]} in {ch_id} "
+                     f"(distance {similar[0][1]})")
+        return True
+    return False
+
+
+image_index = ImageIndex()
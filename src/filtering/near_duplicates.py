@@ -0,0 +1,151 @@
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from telethon.tl.patched import Message
+
+import logging
+
+from src.common.message_context import normalize_text
+
+logger = logging.getLogger(__name__)
+
+NUM_PERM = 128
+SHINGLE_SIZE = 5  # characters
+MIN_TEXT_LENGTH = 50  # shorter texts are too often similar by chance. Identical ones are caught by the history check
+DEFAULT_NEAR_DUPLICATE_THRESHOLD = 0.8  # estimated Jaccard similarity of the shingle sets
+NEAR_DUPLICATE_INDEX_CAPACITY = 50000  # posts per destination channel
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# the same permutations for all the indexes and runs, so signatures are comparable and may be cached
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, _MAX_HASH, size=NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.randint(0, _MAX_HASH, size=NUM_PERM, dtype=np.uint64)
+
+
+def get_shingles(text: str, size=SHINGLE_SIZE) -> Set[str]:
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+@lru_cache(maxsize=4096)  # a source message is checked against every destination it goes to
+def minhash_signature(text: str) -> Optional[np.ndarray]:
+    """MinHash signature of the normalized text or None if the text is too short to be compared."""
+    text = normalize_text(text)
+    if len(text) < MIN_TEXT_LENGTH:
+        return None
+    hashes = np.array([zlib.crc32(shingle.encode()) for shingle in get_shingles(text)], dtype=np.uint64)
+    # (a * x + b) mod p for all the permutations at once. Fits uint64 as x, a, b < 2^32
+    permuted = (np.outer(hashes, _PERM_A) + _PERM_B) % _MERSENNE_PRIME
+    signature = (permuted & _MAX_HASH).min(axis=0).astype(np.uint32)
+    signature.flags.writeable = False  # shared through the cache
+    return signature
+
+
+def estimate_similarity(signature1: np.ndarray, signature2: np.ndarray) -> float:
+    return float(np.mean(signature1 == signature2))
+
+
+def get_lsh_params(threshold: float, num_perm=NUM_PERM) -> Tuple[int, int]:
+    """
+    Number of bands and rows per band. Two signatures become candidates with probability 1 - (1 - s^rows)^bands,
+    which steeply grows around (1 / bands)^(1 / rows). The largest such point which doesn't exceed ``threshold``
+    is chosen: missed near duplicates can't be recovered, false candidates are dropped by the verification.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if (1 / bands) ** (1 / rows) <= threshold:
+            best = (bands, rows)
+    return best
+
+
+class NearDuplicateIndex:
+    """
+    Locality-sensitive hashing index of MinHash signatures of the recent posts of one channel. A query is compared
+    only with the posts which share a band with it, not with all of them.
+
+    Parameters
+    ----------
+    threshold : float
+        Minimal estimated Jaccard similarity of the shingles for two texts to be near duplicates.
+    capacity : int
+        Number of the most recent posts kept.
+    """
+
+    def __init__(self, threshold=DEFAULT_NEAR_DUPLICATE_THRESHOLD, capacity=NEAR_DUPLICATE_INDEX_CAPACITY):
+        self.capacity = capacity
+        self._signatures: 'OrderedDict[Hashable, np.ndarray]' = OrderedDict()  # the oldest first
+        self.set_threshold(threshold)
+
+    def set_threshold(self, threshold: float):
+        self.threshold = threshold
+        self.bands, self.rows = get_lsh_params(threshold)
+        self._buckets: List[Dict[bytes, Set[Hashable]]] = [{} for _ in range(self.bands)]
+        for key, signature in self._signatures.items():
+            self._add_to_buckets(key, signature)
+
+    def _band_keys(self, signature: np.ndarray):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def _add_to_buckets(self, key: Hashable, signature: np.ndarray):
+        for band, band_key in self._band_keys(signature):
+            self._buckets[band].setdefault(band_key, set()).add(key)
+
+    def _remove_from_buckets(self, key: Hashable, signature: np.ndarray):
+        for band, band_key in self._band_keys(signature):
+            bucket = self._buckets[band].get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band][band_key]
+
+    def add(self, key: Hashable, text: str) -> bool:
+        """Indexes the text under ``key``. Returns False if it's too short to be indexed or the key is known."""
+        signature = minhash_signature(text)
+        if signature is None or key in self._signatures:
+            return False
+        self._signatures[key] = signature
+        self._add_to_buckets(key, signature)
+        if len(self._signatures) > self.capacity:
+            evicted_key, evicted_signature = self._signatures.popitem(last=False)
+            self._remove_from_buckets(evicted_key, evicted_signature)
+        return True
+
+    def query(self, text: str) -> List[Tuple[Hashable, float]]:
+        """Keys of the indexed texts similar to ``text`` with their estimated similarity, the most similar first."""
+        signature = minhash_signature(text)
+        if signature is None:
+            return []
+        candidates = set()
+        for band, band_key in self._band_keys(signature):
+            candidates |= self._buckets[band].get(band_key, set())
+        matches = [(key, estimate_similarity(signature, self._signatures[key])) for key in candidates]
+        return sorted([match for match in matches if match[1] >= self.threshold], key=lambda m: m[1], reverse=True)
+
+    def __contains__(self, key: Hashable):
+        return key in self._signatures
+
+    def __len__(self):
+        return len(self._signatures)
+
+
+def message_is_near_duplicated(msg: Message, near_duplicate_index: NearDuplicateIndex) -> bool:
+    if not msg.message:
+        return False
+    try:
+        matches = near_duplicate_index.query(msg.message)
+    except:
+        logger.error(f'Unable to check the message for near duplicates\n{msg.stringify()}', exc_info=True)
+        return False
+    if matches:
+        logger.debug(f"Message '{msg.message[:20]}...' is a near duplicate of {matches[0][0]} "
+                     f"(similarity {matches[0][1]:.2f})")
+        return True
+    return False
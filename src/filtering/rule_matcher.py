@@ -0,0 +1,72 @@
+from collections import deque
+from typing import Iterable, List, Optional
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RuleMatcher:
+    """
+    Aho-Corasick automaton over the lowercased rule phrases. Finds whether any of the phrases occurs in a text in one
+    pass over the text, regardless of the number of rules.
+
+    Parameters
+    ----------
+    rules : Iterable[str]
+        Phrases to look for. Compared in lowercase.
+    """
+
+    def __init__(self, rules: Iterable[str]):
+        self.rules: List[str] = list(rules)
+        # the trie. State 0 is the root
+        self._goto: List[dict] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Optional[int]] = [None]  # index of a rule ending in the state (or via its fail links)
+        for rule_index, rule in enumerate(self.rules):
+            self._add(rule.lower(), rule_index)
+        self._build_fail_links()
+
+    def _add(self, phrase: str, rule_index: int):
+        state = 0
+        for char in phrase:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+            state = next_state
+        if self._output[state] is None:  # the first of the equal rules is reported
+            self._output[state] = rule_index
+
+    def _build_fail_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._output[next_state] is None:  # a shorter rule ends here as well
+                    self._output[next_state] = self._output[self._fail[next_state]]
+
+    def find(self, text: str) -> Optional[str]:
+        """Returns the first rule found in the text (the one which ends the earliest) or None"""
+        if self._output[0] is not None:  # an empty rule matches anything
+            return self.rules[self._output[0]]
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for char in text.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] is not None:
+                return self.rules[output[state]]
+        return None
+
+    def __len__(self):
+        return len(self.rules)
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import logging
+
+from src.common.database_utils import RB_FILTER_LISTS_FILEPATH
+from src.common.get_project_root import get_project_root
+from src.filtering.rule_matcher import RuleMatcher
+
+logger = logging.getLogger(__name__)
+
+
+class RuleSetCache:
+    """
+    Rule-based filter lists read from the disk only when the file changes, and their compiled matchers per
+    destination channel. A change is noticed by the modification time and size of the file and confirmed by the hash
+    of its content, so edits apply without a restart while unchanged files are never read again.
+
+    Attributes
+    ----------
+    version : int
+        Incremented every time the content of the rules changes. Results computed with the rules may be memoized
+        against it.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.path.join(get_project_root(), RB_FILTER_LISTS_FILEPATH)
+        self.version = 0
+        self.content_hash = None
+        self._stat = None  # (mtime, size) of the last read file
+        self._rules = defaultdict(list)
+        self._matchers: Dict[Tuple[int, bool], RuleMatcher] = {}
+
+    def _refresh(self):
+        try:
+            stat = os.stat(self.path)
+            stat = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            stat = None
+        if stat == self._stat and self.version:
+            return
+        self._stat = stat
+
+        content = b''
+        if stat is not None:
+            with open(self.path, 'rb') as f:
+                content = f.read()
+        content_hash = hashlib.sha1(content).hexdigest()
+        if content_hash == self.content_hash:  # touched but not changed
+            return
+
+        rules = defaultdict(list)
+        if content:
+            try:
+                rules = defaultdict(list, json.loads(content.decode('utf-8-sig')))
+            except ValueError:  # e.g. the file is being written right now. The previous rules stay
+                logger.error(f"Unable to parse the rules from {self.path}", exc_info=True)
+                self._stat = None  # to read it again next time
+                return
+        self._rules = rules
+        self._matchers = {}
+        self.content_hash = content_hash
+        self.version += 1
+        logger.info(f"Rule-based filter lists are loaded (version {self.version})")
+
+    def get_rules(self, dst_ch_id: int = None, use_common_rules=True) -> List[str]:
+        self._refresh()
+        rules = []
+        if use_common_rules:
+            rules += self._rules['_common_rb_list']
+        if dst_ch_id is not None:
+            rules += self._rules[str(dst_ch_id)]  # TODO: serialize during reading above?
+        return rules
+
+    def get_matcher(self, dst_ch_id: int = None, use_common_rules=True) -> RuleMatcher:
+        """Matcher of the rules of the destination, compiled once per version of the rules"""
+        rules = self.get_rules(dst_ch_id, use_common_rules)
+        key = (dst_ch_id, use_common_rules)
+        matcher = self._matchers.get(key)
+        if matcher is None:
+            matcher = self._matchers[key] = RuleMatcher(rules)
+        return matcher
+
+
+rule_set_cache = RuleSetCache()
@@ -17,6 +17,7 @@ from src.common.get_project_root import get_project_root
 from src.common.database_utils import (get_users, update_users, save_users, get_feeds, delete_users_channel)
 from src.common.channel import Channel, get_display_name, update_channels, get_channels
 from src.common.decorators import check_direct
+from src.common.client_manager import borrow_client
 
 from src.bot.admin.admin_utils import ADMIN_USER_IDS
 from src.bot.bot_utils import add_to_channel, get_answer_in_conv, get_users_channel_links
@@ -174,7 +175,7 @@ async def command_channel_info(event):
         #  The same has to be applied in channel constructor.
         #  A slightly changed but correct link will trigger cache update
         parsable = message[message.startswith('/channel_info') and len('/channel_info '):]
-        async with user_client_for_bot_cli:
+        async with borrow_client(user_client_for_bot_cli):
             logger.debug(f'Trying channel_info with parsable: {parsable}')
             dst_ch = Channel(parsable, client=user_client_for_bot_cli)
     except:
@@ -259,7 +260,7 @@ async def command_create_channel(event):
         await command_menu(event)
 
     from src.bot.bot_utils import create_channel, transfer_channel_ownership
-    async with user_client_for_bot_cli:
+    async with borrow_client(user_client_for_bot_cli):
         creation_result = await create_channel(client=user_client_for_bot_cli, channel_title=new_channel_name,
                                                about=new_channel_about, supergroup=False)  # ask about supergroup?
 
@@ -290,7 +291,7 @@ async def command_create_channel(event):
                                                              f"'{new_channel_name}' is created. Now you can find it "
                                                              "in the 'All Chats' Telegram folder")
                     break
-                async with user_client_for_bot_cli:
+                async with borrow_client(user_client_for_bot_cli):
                     logger.debug(f"Checking username request with new_channel_id {new_channel_id} and "
                                  f"desired_public_name {desired_public_name}")
                     try:
@@ -334,7 +335,7 @@ async def command_create_channel(event):
         await command_menu(event)
 
     # TODO: make a func from it?
-    async with user_client_for_bot_cli:
+    async with borrow_client(user_client_for_bot_cli):
         try:
             new_channel_id = int('-100' + str(new_channel_id))
 
@@ -380,7 +381,7 @@ async def command_delete_channel(event):  # callback function
 
     try:
         parsable = message[message.startswith('/delete_channel') and len('/delete_channel '):]
-        async with user_client_for_bot_cli:
+        async with borrow_client(user_client_for_bot_cli):
             target_ch = Channel(parsable=parsable, client=user_client_for_bot_cli)
     except:
         await event.reply(
@@ -1,12 +1,11 @@
 import asyncio
 import os
 import argparse
-from random import randint
 import time
 
 import logging
 
-from typing import List
+from typing import Dict, List
 
 from telethon import TelegramClient
 from telethon.tl.types import (TypeInputPeer, MessageMediaWebPage, WebPage, WebPageEmpty)
@@ -19,24 +18,55 @@ from telethon.errors import (ChannelPrivateError, UsernameNotOccupiedError, Mess
 
 from src.common.message_processing import format_forwarded_msg_as_original, ensure_media_access, msg_is_action, \
     msg_is_invoice, MSG_POSTFIX_TEMPLATE
-from src.common.utils import get_history, get_message_origins
+from src.common.utils import get_history, get_message_origins, iter_history_pages
+from src.common.client_manager import client_manager, borrow_client
 from src.common.get_project_root import get_project_root
 from src.common.database_utils import (get_last_channel_ids, update_last_channel_ids, get_feeds, log_messages,
-                                       invert_feeds, get_channel_owner)
-from src.common.channel import Channel
+                                       invert_feeds, get_channel_owner, get_channel_poll_stats,
+                                       save_channel_poll_stats, get_channel_backfill_caps,
+                                       get_last_channel_ids_time)
+from src.common.channel import Channel, channel_registry
+from src.common.channel_refresher import ChannelRefresher
+from src.common.send_pacer import SendPacer
+from src.common.message_context import BatchContext
+from src.common.fingerprint_store import seen_fingerprints, message_is_seen
+from src.common.request_governor import RequestGovernor
+from src.common.session_pool import SessionPool
+from src.common.polling_scheduler import PollingScheduler
+from src.common.push_ingest import PushIngest, TelethonUpdateSource
 
 from src import config
-from src.filtering.filter import Filter
+from src.filtering.filter import Filter, filter_messages_with_func
+from src.filtering.history_index import history_index
+from src.filtering.image_duplicates import image_index
 
 from src.recommender.recommender import ContentBasedRecommender
 
+logger = logging.getLogger(__name__)  # overwritten when run as a script. Used when imported by main_pipeline
+
 # MAIN_LOOP_DELAY_SEC_DEBUG = 900  # TODO: add nightmode
 MAIN_LOOP_DELAY_SEC_DEBUG = 1800
 MAIN_LOOP_DELAY_SEC_INFO = 1800
+MAX_CONCURRENT_SRC_CHANNELS = 8
+SRC_CHANNEL_DELAY_SEC = 2  # pause of a concurrency slot after each source channel
+ADAPTIVE_LOOP_MIN_DELAY_SEC = 60
+ADAPTIVE_LOOP_MAX_DELAY_SEC = 600
+PRIMARY_SESSION_NAME = 'telefeed_client'
+NEW_CHANNEL_MESSAGES = 15  # how many recent messages a just added source channel gives
+BACKFILL_PAGE_SIZE = 50
+BACKFILL_MAX_MESSAGES_PER_PASS = 500  # default per-channel cap. Overridden by get_channel_backfill_caps
+
+send_pacer = SendPacer()  # not to send all the messages in bulk
+request_governor = RequestGovernor()
+# requests performed by iter_new_channel_messages. A flood wait on any of them defers the channel
+HISTORY_REQUEST_TYPES = ('GetHistoryRequest', 'ResolveUsernameRequest', 'GetPeerDialogsRequest')
 
 
 async def send_group_if_non_empty(msg_list: List[Message], bot_client: TelegramClient, from_peer, peer_to_forward_to,
-                                  last_grouped_id=None, user_client: TelegramClient = None, send_not_forward=False):
+                                  last_grouped_id=None, user_client: TelegramClient = None, send_not_forward=False,
+                                  batch_context: BatchContext = None, on_sent=None):
+    """``on_sent`` is awaited with the messages once they are sent. Not called if sending failed"""
+    sent_msg_list = []
     if msg_list:
         if last_grouped_id:  # then msg_list is a group
             logger.log(5, f"Sending group of {len(msg_list)} message(s) "
@@ -57,13 +87,15 @@ async def send_group_if_non_empty(msg_list: List[Message], bot_client: TelegramC
                 await send_msg_list(msg_list=msg_list, bot_client=bot_client,
                                     peer_to_forward_to=peer_to_forward_to,
                                     last_grouped_id=last_grouped_id,
-                                    user_client=user_client)
+                                    user_client=user_client,
+                                    batch_context=batch_context)
             else:  # old option/regular forward
                 logger.log(5, "The first group message is (or all non-grouped messages are) more than 900 symbols. Just forward")
-                await forward_msg_by_id_list(client=bot_client, peer=from_peer,
-                                             msg_ids_to_forward=[m.id for m in msg_list],
-                                             peer_to_forward_to=peer_to_forward_to)
-            msg_list = []
+                sent = await forward_msg_by_id_list(client=bot_client, peer=from_peer,
+                                                    msg_ids_to_forward=[m.id for m in msg_list],
+                                                    peer_to_forward_to=peer_to_forward_to)
+                register_sent_messages(peer_to_forward_to, sent=sent, source_msg_list=msg_list)
+            sent_msg_list, msg_list = msg_list, []
 
         except ChannelPrivateError:
             logger.error(f"Unable to send to peer_to_forward_to={peer_to_forward_to}. The channel specified is private "
@@ -91,12 +123,30 @@ async def send_group_if_non_empty(msg_list: List[Message], bot_client: TelegramC
         except:
             logger.error(f'Failed in send_group_if_non_empty while sending to {peer_to_forward_to} the following messages:\n{[m.stringify() for m in msg_list]}', exc_info=True)
 
+    if sent_msg_list and on_sent is not None:
+        await on_sent(sent_msg_list)
     return msg_list
 
 
+def register_sent_messages(peer_to_forward_to, sent, source_msg_list: List[Message]):
+    """Adds the posted messages to the indexes used by the filter to look for duplicates"""
+    history_index.add(peer_to_forward_to, sent)
+    for msg in source_msg_list:  # photo hashes are known by the IDs of the source photos
+        image_index.add_message(peer_to_forward_to, msg)
+
+
+async def get_shared_message_origins(client: TelegramClient, msg: Message, batch_context: BatchContext = None):
+    origins = batch_context.get_origins(msg) if batch_context is not None else None
+    if origins is None:
+        async with borrow_client(client):
+            origins = await get_message_origins(client, msg)
+    return origins
+
+
 async def send_msg_list(msg_list: List[Message], bot_client: TelegramClient, peer_to_forward_to: TypeInputPeer,
                         last_grouped_id=None,
-                        user_client: TelegramClient = None):
+                        user_client: TelegramClient = None,
+                        batch_context: BatchContext = None):
     """
 
     Parameters
@@ -105,6 +155,8 @@ async def send_msg_list(msg_list: List[Message], bot_client: TelegramClient, pee
         List of 1+ messages. They may be grouped (same grouped_id) or not.
     bot_client
     peer_to_forward_to link or ID?
+    batch_context : BatchContext, optional
+        Context of the source batch. Message origins are taken from it if available.
 
     Returns
     -------
@@ -117,23 +169,25 @@ async def send_msg_list(msg_list: List[Message], bot_client: TelegramClient, pee
         # media is MessageMediaPhoto. the message with the smallest ID has the message field aka caption
         # like here https://stackoverflow.com/questions/64111232/python-telethon-send-album
         # group comes with ascending msg_id
-        async with user_client:
-            orig_channel, _, original_msg_id, _, _, _ = await get_message_origins(user_client, msg_list[0])
+        orig_channel, _, original_msg_id, _, _, _ = await get_shared_message_origins(user_client, msg_list[0],
+                                                                                     batch_context)
 
         album_msg_list = []
         for msg in msg_list:
             album_msg = await ensure_media_access(msg, user_client, bot_client, orig_channel.id)
             album_msg_list.append(album_msg)
 
-        async with bot_client:
+        async with borrow_client(bot_client):
             new_msg = format_forwarded_msg_as_original(album_msg_list[0], orig_channel,
                                                        original_msg_id)  # maybe it should be album_list but for some reason 0th album message doesn't have text
+            await send_pacer.wait(bot_client, peer_to_forward_to)
             try:
-                await bot_client.send_message(entity=peer_to_forward_to,
-                                              message=new_msg.message,
-                                              file=album_msg_list,  # event.messages is a List - meaning we're sending an album
-                                              formatting_entities=new_msg.entities,
-                                              link_preview=True)  # wrapper for functions.messages.SendMessageRequest
+                sent = await bot_client.send_message(entity=peer_to_forward_to,
+                                                     message=new_msg.message,
+                                                     file=album_msg_list,  # event.messages is a List - meaning we're sending an album
+                                                     formatting_entities=new_msg.entities,
+                                                     link_preview=True)  # wrapper for functions.messages.SendMessageRequest
+                register_sent_messages(peer_to_forward_to, sent=sent, source_msg_list=msg_list)
             except MediaEmptyError:
                 logger.error(f"Unable to send message to {peer_to_forward_to}\n{new_msg.stringify()}\n")
             except MediaCaptionTooLongError:  # 1024
@@ -146,13 +200,14 @@ async def send_msg_list(msg_list: List[Message], bot_client: TelegramClient, pee
 
     else:  # if the messages are independent, process one by one with a common .message extension
         for msg in msg_list:
-            async with user_client:
-                orig_channel, _, original_msg_id, _, _, _ = await get_message_origins(user_client, msg)
+            orig_channel, _, original_msg_id, _, _, _ = await get_shared_message_origins(user_client, msg,
+                                                                                         batch_context)
 
+            source_msg = msg
             msg = await ensure_media_access(msg, user_client, bot_client, orig_channel.id)
 
             # TODO: groups are not together
-            async with bot_client:
+            async with borrow_client(bot_client):
                 new_msg = format_forwarded_msg_as_original(msg, orig_channel, original_msg_id)
                 # from docs: If you want to “forward” a message without the forward header (the “forwarded from” text),
                 # you should use send_message with the original message instead. This will send a copy of it.
@@ -164,13 +219,15 @@ async def send_msg_list(msg_list: List[Message], bot_client: TelegramClient, pee
                     elif isinstance(new_msg.media.webpage, WebPageEmpty):
                         media = None  # Bots can't access web previews. TODO: create myself?
                         link_preview = True
+                await send_pacer.wait(bot_client, peer_to_forward_to)
                 try:
                     # TODO: fix TypeError: Cannot use <telethon.tl.types.MessageMediaPoll object at 0x125b8a8b0> as file
-                    await bot_client.send_message(entity=peer_to_forward_to,
-                                                  message=new_msg.message,
-                                                  file=media,  # TODO: make this a list of all the messages in a group
-                                                  formatting_entities=new_msg.entities,
-                                                  link_preview=link_preview)  # wrapper for functions.messages.SendMessageRequest
+                    sent = await bot_client.send_message(entity=peer_to_forward_to,
+                                                         message=new_msg.message,
+                                                         file=media,  # TODO: make this a list of all the messages in a group
+                                                         formatting_entities=new_msg.entities,
+                                                         link_preview=link_preview)  # wrapper for functions.messages.SendMessageRequest
+                    register_sent_messages(peer_to_forward_to, sent=sent, source_msg_list=[source_msg])
                 except MediaEmptyError:
                     logger.error(f"Unable to send message to {peer_to_forward_to}\n{new_msg.stringify()}\n"
                                  f"with media\n{media.stringify()}\n(caused by SendMediaRequest)")
@@ -190,7 +247,8 @@ async def send_msg_list(msg_list: List[Message], bot_client: TelegramClient, pee
 # TODO: add parameter send_as_mine/forward
 # TODO: why link is used!? Switch to id
 async def group_and_forward_msgs(bot_client: TelegramClient, src_ch: Channel, msg_list: List[Message],
-                                 peer_to_forward_to: TypeInputPeer, user_client: TelegramClient = None):
+                                 peer_to_forward_to: TypeInputPeer, user_client: TelegramClient = None,
+                                 batch_context: BatchContext = None, on_sent=None):
     """
     Forward messages in small pieces.
 
@@ -201,7 +259,10 @@ async def group_and_forward_msgs(bot_client: TelegramClient, src_ch: Channel, ms
     msg_list
     peer_to_forward_to
     user_client
-    filtering_details
+    batch_context
+    on_sent : optional
+        Awaited with every piece of the messages (a group, non-grouped messages or an action) once it is sent,
+        e.g. to record the progress.
 
     Returns
     -------
@@ -214,9 +275,11 @@ async def group_and_forward_msgs(bot_client: TelegramClient, src_ch: Channel, ms
     for msg in reversed(msg_list):  # starting from the chronologically first
         # client.send_message(peer_to_forward_to, msg)
         # TODO: should be filtered during the filtering stage via rules?
-        if await msg_is_action(msg=msg, client=bot_client, from_peer=src_ch, peer_to_forward_to=peer_to_forward_to):
-            continue
-        if await msg_is_invoice(msg=msg, client=bot_client, from_peer=src_ch, peer_to_forward_to=peer_to_forward_to):
+        if await msg_is_action(msg=msg, client=bot_client, from_peer=src_ch, peer_to_forward_to=peer_to_forward_to) \
+                or await msg_is_invoice(msg=msg, client=bot_client, from_peer=src_ch,
+                                        peer_to_forward_to=peer_to_forward_to):
+            if on_sent is not None:
+                await on_sent([msg])
             continue
 
         if msg.grouped_id is not None:  # the current message is a part of a group
@@ -231,7 +294,9 @@ async def group_and_forward_msgs(bot_client: TelegramClient, src_ch: Channel, ms
                                                                                        from_peer=src_ch.id,
                                                                                        peer_to_forward_to=peer_to_forward_to,
                                                                                        last_grouped_id=last_grouped_id,
-                                                                                       user_client=user_client)
+                                                                                       user_client=user_client,
+                                                                                       batch_context=batch_context,
+                                                                                       on_sent=on_sent)
                 last_grouped_id = msg.grouped_id
                 grouped_msg_list.append(msg)
                 logger.log(5, f"Group {msg.grouped_id} has one more message to be sent. "
@@ -241,7 +306,9 @@ async def group_and_forward_msgs(bot_client: TelegramClient, src_ch: Channel, ms
                                                        from_peer=src_ch.id,
                                                        peer_to_forward_to=peer_to_forward_to,
                                                        last_grouped_id=last_grouped_id,
-                                                       user_client=user_client)
+                                                       user_client=user_client,
+                                                       batch_context=batch_context,
+                                                       on_sent=on_sent)
             non_grouped_msg_list.append(msg)
             logger.log(5, f"Non-grouped messages list is extended. Total size: {len(non_grouped_msg_list)}")
 
@@ -251,26 +318,34 @@ async def group_and_forward_msgs(bot_client: TelegramClient, src_ch: Channel, ms
                                          from_peer=src_ch.id,
                                          peer_to_forward_to=peer_to_forward_to,
                                          last_grouped_id=last_grouped_id,
-                                         user_client=user_client)
+                                         user_client=user_client,
+                                         batch_context=batch_context,
+                                         on_sent=on_sent)
 
 
 async def resolve_and_send_groups(bot_client, grouped_msg_list, non_grouped_msg_list, from_peer, peer_to_forward_to,
-                                  last_grouped_id, user_client: TelegramClient = None):
+                                  last_grouped_id, user_client: TelegramClient = None,
+                                  batch_context: BatchContext = None, on_sent=None):
     non_grouped_msg_list = await send_group_if_non_empty(msg_list=non_grouped_msg_list, bot_client=bot_client,
                                                    from_peer=from_peer,
                                                    peer_to_forward_to=peer_to_forward_to,
                                                    last_grouped_id=None,
-                                                   user_client=user_client)
+                                                   user_client=user_client,
+                                                   batch_context=batch_context,
+                                                   on_sent=on_sent)
     grouped_msg_list = await send_group_if_non_empty(msg_list=grouped_msg_list, bot_client=bot_client,
                                                from_peer=from_peer, peer_to_forward_to=peer_to_forward_to,
                                                last_grouped_id=last_grouped_id,
-                                               user_client=user_client)
+                                               user_client=user_client,
+                                               batch_context=batch_context,
+                                               on_sent=on_sent)
     return grouped_msg_list, non_grouped_msg_list
 
 
 async def forward_msg_by_id_list(client: TelegramClient, peer: TypeInputPeer, msg_ids_to_forward: List[int],
-                                 peer_to_forward_to: TypeInputPeer):
+                                 peer_to_forward_to: TypeInputPeer) -> List[Message]:
     """
+    Returns the forwarded copies as they were posted to ``peer_to_forward_to``, with their own IDs.
 
     :param client:
     :param peer: Anything entity-like will work if the library can find its Input version
@@ -278,33 +353,46 @@ async def forward_msg_by_id_list(client: TelegramClient, peer: TypeInputPeer, ms
     :param msg_ids_to_forward: A list must be supplied.
     :param peer_to_forward_to: Anything entity-like will work if the library can find its Input version
     (e.g., usernames, Peer, User or Channel objects, etc.).
-    :return:
+    :return: the forwarded messages. The ones missing in the response are skipped
     """
-    if log_level != 'DEBUG':
-        time.sleep(randint(5, 20))  # not to send all the messages in bulk
+    await send_pacer.wait(client, peer_to_forward_to)
 
     logger.log(5, f'forwarding msg to {peer_to_forward_to}')
-    async with client:
-        await client(ForwardMessagesRequest(
+    async with borrow_client(client):
+        request = ForwardMessagesRequest(
             from_peer=peer,  # who sent these messages?
             id=msg_ids_to_forward,  # which are the messages? = grouped_ids
             to_peer=peer_to_forward_to,  # who are we forwarding them to?
             with_my_score=True
-        ))
+        )
+        result = await client(request)
+        # the same as TelegramClient.forward_messages does: the new messages are matched by the random IDs
+        sent = client._get_response_message(request, result, await client.get_input_entity(peer_to_forward_to))
     logger.log(5, f'forwarded msg ids: {msg_ids_to_forward} to {peer_to_forward_to}')
+    return [msg for msg in sent or [] if msg is not None]
 
 
 async def select_messages_for_dst_channel(msg_list: List[Message], src_ch: Channel, dst_ch: Channel,
-                                          recommender, user_client: TelegramClient, user_id) -> List[Message]:
+                                          recommender, user_client: TelegramClient, user_id,
+                                          batch_context: BatchContext = None) -> List[Message]:
     try:
         filtering_details = {k.id: None for k in msg_list}  # may be removed as initialized if empty inside the function
+        # content already decided for this destination (e.g. the same story from another source) skips the rest
+        messages_checked_list, filtering_details = filter_messages_with_func(msg_list, filter_func=message_is_seen,
+                                                                             filtering_details=filtering_details,
+                                                                             filter_name='seen',
+                                                                             store=seen_fingerprints,
+                                                                             dst_ch_id=dst_ch.id,
+                                                                             batch_context=batch_context)
         # TODO: perform history check later wrt the dst channel and it's rb list
-        async with user_client:
+        async with borrow_client(user_client):
             # logger.error('FILTERING IS NOT PERFORMED')
             filter_component = Filter(rule_base_check=True, history_check=True, client=user_client,
                                       dst_ch=dst_ch, use_common_rules=True,
                                       postfix_template_to_ignore=MSG_POSTFIX_TEMPLATE)
-            messages_checked_list, filtering_details = filter_component.filter_messages(msg_list, filtering_details)
+            if messages_checked_list:
+                messages_checked_list, filtering_details = await filter_component.filter_messages(
+                    messages_checked_list, filtering_details, batch_context=batch_context)
 
             if messages_checked_list:
                 messages_checked_list, filtering_details = recommender.filter_messages(msg_list=messages_checked_list,
@@ -313,175 +401,404 @@ async def select_messages_for_dst_channel(msg_list: List[Message], src_ch: Chann
                                                                                        user_channel_id=dst_ch.id,
                                                                                        user_id=user_id,
                                                                                        threshold=0.47)
+        for msg in msg_list:
+            if filtering_details.get(msg.id) != 'seen':
+                seen_fingerprints.record(dst_ch.id, msg, decision=filtering_details.get(msg.id),
+                                         fingerprint=batch_context.get_fingerprint(msg) if batch_context else None)
     except:
         logger.error('Failed to perform message selection. Passing further as they are', exc_info=True)
         messages_checked_list = msg_list
+        for msg in msg_list:  # reserved by the lookup but never decided
+            seen_fingerprints.release(dst_ch.id, msg,
+                                      fingerprint=batch_context.get_fingerprint(msg) if batch_context else None)
     return messages_checked_list, filtering_details
 
 
-async def check_new_channel_messages(src_ch: Channel, last_channel_ids, client):
+async def iter_new_channel_messages(src_ch: Channel, last_channel_ids, client, governor: RequestGovernor = None,
+                                    max_messages=BACKFILL_MAX_MESSAGES_PER_PASS):
+    """
+    Yields new messages of the channel in chunks (each chunk is descending, chunks go from the oldest to the newest).
+    The history is paged forward from the last processed ID, so there are no gaps after long disconnections.
+    After ``max_messages`` the generator stops; the caller persists the last yielded ID and the next pass continues
+    from it. If ``governor`` is given, a channel with an active flood wait is skipped and a new flood wait is
+    recorded there instead of being raised.
+    """
+    if governor is not None:
+        remaining_wait = max(governor.remaining_wait(request_type, src_ch.id)
+                             for request_type in HISTORY_REQUEST_TYPES)
+        if remaining_wait:
+            logger.log(7, f"Skipping {src_ch!r} for another {remaining_wait / 60:.1f} minutes due to a flood wait")
+            return
+
     try:
         # solution based on the last index mentioned in the json. We can't just check if there are some unread
         # messages because for that you have to be subscribed to the channel. Otherwise, you must anchor yourself to
-        # some message ID in the past - this is what we do. For the just added channel with the default last
-        # message id of 0, the batch will be large. But after disconnections this limit of 100 may be insufficient
-        # and there will be gaps
+        # some message ID in the past - this is what we do
         # peer=InputPeerChannel(entity_id, entity_hash)
-        messages = None
-        messages = await get_history(client=client, channel=src_ch, min_id=last_channel_ids[src_ch.id], limit=15)
-        if len(messages) == 0:
-            try:
-                # solution based on telegram dialog fields
-                async with client:
-                    # dialog = client(GetPeerDialogsRequest(peers=[src_ch.id])).dialogs[0]
-                    dialogs = await client(GetPeerDialogsRequest(peers=[src_ch.id]))
-                    dialog = dialogs.dialogs[0]
-                    # dialogs = await client.get_dialogs(offset_peer=src_ch.id)
-                    # dialog = dialogs[0]
-                    # logging.info(f'dialog fetched for id {src_ch.id}\n{dialog.stringify()}')
-                # there are naturally unread messages or the channel is marked as unread
-                # it's important that for channels on which you are not subscribed, both unread_count and unread_mask
-                # don't work
-            except FloodWaitError as e:
-                logger.error(
-                    f'Got FloodWaitError cause by GetPeerDialogsRequest. Have to sleep {e.seconds} seconds / {e.seconds / 60:.1f} minutes / '
-                    f'{e.seconds / 60 / 60:.1f} hours')
-
-            # TODO: add marked unread manually to the logs
-            if dialog.unread_count or dialog.unread_mark:
-                if dialog.unread_mark:
-                    logger.info(f"Channel {src_ch} is marked as unread manually")
-                    # if fetched message.grouped_id is not None, fetch until group changes and then send
-                    unread_mark_read_n_messages = 4
-                    messages = await get_history(client=client, channel=src_ch,
-                                                 min_id=dialog.top_message - unread_mark_read_n_messages,
-                                                 limit=unread_mark_read_n_messages)
-                else:  # this should not be triggered and has to be removed
-                    logger.info(f"Channel {src_ch} has {dialog.unread_count} unread posts")
-                    messages = await get_history(client=client, channel=src_ch, min_id=dialog.read_inbox_max_id,
-                                                 limit=dialog.unread_count)
+        if last_channel_ids[src_ch.id] == 0:
+            # the channel is just added. Only a small portion of the recent content instead of the whole history
+            messages = await get_history(client=client, channel=src_ch, min_id=0, limit=NEW_CHANNEL_MESSAGES)
+            if len(messages) != 0:
+                yield list(messages)
+            return
+
+        found_messages = False
+        async for chunk in iter_history_pages(client=client, channel=src_ch, min_id=last_channel_ids[src_ch.id],
+                                              page_size=BACKFILL_PAGE_SIZE, max_messages=max_messages):
+            found_messages = True
+            yield chunk
+        if found_messages:
+            return
+
+        try:
+            # solution based on telegram dialog fields
+            async with borrow_client(client):
+                # dialog = client(GetPeerDialogsRequest(peers=[src_ch.id])).dialogs[0]
+                dialogs = await client(GetPeerDialogsRequest(peers=[src_ch.id]))
+                dialog = dialogs.dialogs[0]
+                # dialogs = await client.get_dialogs(offset_peer=src_ch.id)
+                # dialog = dialogs[0]
+                # logging.info(f'dialog fetched for id {src_ch.id}\n{dialog.stringify()}')
+            # there are naturally unread messages or the channel is marked as unread
+            # it's important that for channels on which you are not subscribed, both unread_count and unread_mask
+            # don't work
+        except FloodWaitError as e:
+            logger.error(
+                f'Got FloodWaitError cause by GetPeerDialogsRequest. Have to sleep {e.seconds} seconds / {e.seconds / 60:.1f} minutes / '
+                f'{e.seconds / 60 / 60:.1f} hours')
+            if governor is None:
+                raise
+            governor.record_error(e, entity=src_ch.id)
+            return
+
+        # TODO: add marked unread manually to the logs
+        messages = []
+        if dialog.unread_count or dialog.unread_mark:
+            if dialog.unread_mark:
+                logger.info(f"Channel {src_ch} is marked as unread manually")
+                # if fetched message.grouped_id is not None, fetch until group changes and then send
+                unread_mark_read_n_messages = 4
+                messages = await get_history(client=client, channel=src_ch,
+                                             min_id=dialog.top_message - unread_mark_read_n_messages,
+                                             limit=unread_mark_read_n_messages)
+            else:  # this should not be triggered and has to be removed
+                logger.info(f"Channel {src_ch} has {dialog.unread_count} unread posts")
+                messages = await get_history(client=client, channel=src_ch, min_id=dialog.read_inbox_max_id,
+                                             limit=dialog.unread_count)
+        if len(messages) != 0:
+            yield list(messages)
     # TODO: remove channel from database or fetch the recent info
     except UsernameNotOccupiedError:
         logger.error(f"{src_ch} is not found.\nConsider removing from all readlists", exc_info=True)
         # remove_source_channel()
-        return None
     except ChannelPrivateError:
         logger.error('Consider removing from all readlists')
         # remove_source_channel()
-        return None
     except FloodWaitError as e:
-        # TODO: it looks like only some of the channels are blocked -> do not fetch them but all the others
-        # time.sleep(e.seconds)
-        raise
-    except:
-        # logger.error(f'Unknown fail in get_history with {src_ch}')
+        # only some of the channels are blocked -> do not fetch them but all the others
+        if governor is None:
+            raise
+        governor.record_error(e, entity=src_ch.id)
+    except Exception:  # not a bare except: GeneratorExit must reach the generator when the caller stops early
         logger.error(f'Unknown fail in get_history with {src_ch}', exc_info=True)
-        return None
 
-    if len(messages) == 0:
-        return None
-    return messages
+
+async def process_src_batch(src_ch: Channel, dst_ch_list: List[Channel], msg_list: List[Message], last_channel_ids,
+                            user_client: TelegramClient, bot_client: TelegramClient, recommender):
+    """Delivers one chunk of new messages (descending) of ``src_ch`` and saves the last processed ID."""
+    # logger.debug(f"Found {len(msg_list)} message(s) in '{messages.chats[0].title}' ({src_ch.link})")
+    logger.debug(f"Found {len(msg_list)} message(s) in '{src_ch!r})")
+
+    # origins, features, etc. do not depend on the destination. Compute them once for all the destinations
+    batch_context = await BatchContext.build(msg_list, user_client)
+
+    # TODO: Here recommender system should act and decide to which users send the content
+    for dst_ch in dst_ch_list:
+        # if dst_ch.id not in [-1001504355267, -1001851389727]:  # my channels
+        #     continue
+        user_id = get_channel_owner(dst_ch.id)
+        messages_checked_list, filtering_details = await select_messages_for_dst_channel(msg_list=msg_list,
+                                                                                         src_ch=src_ch,
+                                                                                         dst_ch=dst_ch,
+                                                                                         recommender=recommender,
+                                                                                         user_client=user_client,
+                                                                                         user_id=user_id,
+                                                                                         batch_context=batch_context)
+        # TODO: add logs after sending about sending time, original and changed message text
+        await log_messages(
+            client=user_client,
+            msg_list_before=msg_list,
+            filtering_details=filtering_details,
+            batch_context=batch_context,
+            src_channel_id=src_ch.id,
+            src_channel_link=src_ch.link,
+            src_channel_name=src_ch.name,
+            user_channel_id=dst_ch.id,
+            user_channel_link=dst_ch.link,
+            user_channel_name=dst_ch.name,
+            user_id=user_id)
+
+        # TODO: replace peers to channels to improve visibility
+        # TODO: pass filtering details which will be renamed to action_details
+        await group_and_forward_msgs(bot_client=bot_client, src_ch=src_ch, msg_list=messages_checked_list,
+                                     peer_to_forward_to=dst_ch.id, user_client=user_client,
+                                     batch_context=batch_context)
+
+    # TODO: this increment probably has to be performed anyway even in case of fail
+    last_msg_id = msg_list[0].id
+    last_channel_ids[src_ch.id] = last_msg_id
+    update_last_channel_ids(src_ch.id, last_msg_id)
+
+    # TODO: probably do this only for my subs.
+    await user_client.send_read_acknowledge(src_ch.id, msg_list)  # TODO: got flood by ResolveUsernameRequest -> switch to id?
+    client_me = await user_client.get_me()
+    logger.log(8, f"Channel {src_ch.link} is marked as read for me({client_me.id})")
+
+    logger.debug("\n")
+
+
+async def process_src_channel(src_ch: Channel, dst_ch_list: List[Channel], last_channel_ids,
+                              user_client: TelegramClient, bot_client: TelegramClient, recommender,
+                              msg_list: List[Message] = None, governor: RequestGovernor = None,
+                              max_messages=BACKFILL_MAX_MESSAGES_PER_PASS, fetch_client: TelegramClient = None):
+    """
+    Fetches new messages of one source channel and delivers the selected ones to all its destination channels.
+    Messages are fetched and delivered chunk by chunk, the last processed ID is saved after each chunk.
+
+    Parameters
+    ----------
+    src_ch : Channel
+        Source channel to poll.
+    dst_ch_list : List[Channel]
+        Destination channels subscribed to ``src_ch``.
+    last_channel_ids : defaultdict
+        Last processed message ID per source channel ID.
+    user_client : TelegramClient
+    bot_client : TelegramClient
+    recommender
+    msg_list : List[Message], optional
+        Already received new messages (descending). If not given, they are fetched from the channel history.
+    governor : RequestGovernor, optional
+        Flood wait tracker of the client reading the history. The process-wide one is used by default.
+    max_messages : int
+        Cap of the messages read from the channel history during this call.
+    fetch_client : TelegramClient, optional
+        Client reading the history, ``user_client`` by default. Everything else (filtering, media access, origins,
+        read acknowledgements) is done by ``user_client`` as the destinations are known to it only.
+
+    """
+    # TODO: resurrect it back. When the channel is just added with 0 from default dict, give some small portion of
+    # content. Not 100
+    # if channels[src_ch.link] == 0:  # last message_id is 0 because the channel is added manually
+    #     logger.debug(f"Channel {src_ch.link} is just added and doesn't have the last message id")
+    #     # if src_ch.link.find("t.me/joinchat") != -1:
+    #     #     ch = src_ch.link.split("/")
+    #     #     req = ch[len(ch)-1]
+    #     #     isCorrect = CheckCorrectlyPrivateLink(client, req)
+    #     #     if not isCorrect:
+    #     #         channels.pop(src_ch.link)
+    #     #         print("Removing incorrect channel")
+    #     #         break
+    #     #     Subs2PrivateChat(client, req)
+    #     channel_checked = check_channel_correctness(src_ch.link)
+    #     if channel_checked == 'error':
+    #         req = src_ch.link.split("/")[-1]
+    #         if not CheckCorrectlyPrivateLink(client, req):
+    #             channels.pop(src_ch.link)
+    #             print(f"Removing incorrect channel: {src_ch.link}")
+    #             break
+    #         Subs2PrivateChat(client, req)
+    #
+    #     channels = OpenUpdateTime()
+    try:
+        logger.log(5,
+                   f"Searching for new messages in channel: {src_ch!r} with the last msg_id {last_channel_ids[src_ch.id]}")
+
+        # the client is borrowed from the client manager and stays connected. Entering the client here would
+        # disconnect it for the channels processed concurrently
+        if msg_list is not None:
+            await process_src_batch(src_ch=src_ch, dst_ch_list=dst_ch_list, msg_list=msg_list,
+                                    last_channel_ids=last_channel_ids, user_client=user_client,
+                                    bot_client=bot_client, recommender=recommender)
+        else:
+            async for msg_list in iter_new_channel_messages(src_ch=src_ch, last_channel_ids=last_channel_ids,
+                                                            client=fetch_client or user_client,
+                                                            governor=governor or request_governor,
+                                                            max_messages=max_messages):
+                await process_src_batch(src_ch=src_ch, dst_ch_list=dst_ch_list, msg_list=msg_list,
+                                        last_channel_ids=last_channel_ids, user_client=user_client,
+                                        bot_client=bot_client, recommender=recommender)
+
+    except:
+        # TODO: process if channel doesn't exist. delete and notify
+        logger.error(f"Channel {src_ch} was not processed", exc_info=True)
 
 
 # TODO: simplify function
-async def main(user_client: TelegramClient, bot_client: TelegramClient, recommender):
+async def main(user_client: TelegramClient, bot_client: TelegramClient, recommender,
+               max_concurrent_channels=MAX_CONCURRENT_SRC_CHANNELS, scheduler: PollingScheduler = None,
+               push_ingest: PushIngest = None, session_pool: SessionPool = None,
+               semaphore: asyncio.Semaphore = None):
+    """
+    Performs one pass over all source channels. Up to ``max_concurrent_channels`` source channels are fetched and
+    processed at once, each slot is paced with a non-blocking delay after its channel. ``semaphore`` overrides the
+    limit, e.g. to share it with the pushed posts.
+    If ``session_pool`` is given, source channels are sharded between its user sessions and each session reads the
+    history of its share. The read messages are filtered and delivered by ``user_client``, with the same
+    concurrency limit for all the shares.
+    If ``scheduler`` is given, only the channels which are due according to it are polled.
+    If ``push_ingest`` is given, the channels the user account is subscribed to are not polled, except once after
+    they became pushed or the client reconnected. Their posts are processed as soon as they arrive as updates.
+    """
     last_channel_ids = get_last_channel_ids()
+    backfill_caps = get_channel_backfill_caps()
     feeds = get_feeds()  # which dst channel reads what source channels
     src2dst = await invert_feeds(feeds, user_client)
 
-    logger.log(7, f"Starting main with {len(src2dst)} source and {len(feeds)} destination channels")
-    for src_ch, dst_ch_list in src2dst.items():  # pool of all channels for all users
-        # if src_ch.id not in [-1001099860397, -1001288791823]:  # rbc and love death
-        #     continue
-        # TODO: resurrect it back. When the channel is just added with 0 from default dict, give some small portion of
-        # content. Not 100
-        # if channels[src_ch.link] == 0:  # last message_id is 0 because the channel is added manually
-        #     logger.debug(f"Channel {src_ch.link} is just added and doesn't have the last message id")
-        #     # if src_ch.link.find("t.me/joinchat") != -1:
-        #     #     ch = src_ch.link.split("/")
-        #     #     req = ch[len(ch)-1]
-        #     #     isCorrect = CheckCorrectlyPrivateLink(client, req)
-        #     #     if not isCorrect:
-        #     #         channels.pop(src_ch.link)
-        #     #         print("Removing incorrect channel")
-        #     #         break
-        #     #     Subs2PrivateChat(client, req)
-        #     channel_checked = check_channel_correctness(src_ch.link)
-        #     if channel_checked == 'error':
-        #         req = src_ch.link.split("/")[-1]
-        #         if not CheckCorrectlyPrivateLink(client, req):
-        #             channels.pop(src_ch.link)
-        #             print(f"Removing incorrect channel: {src_ch.link}")
-        #             break
-        #         Subs2PrivateChat(client, req)
-        #
-        #     channels = OpenUpdateTime()
-        try:
-            logger.log(5,
-                       f"Searching for new messages in channel: {src_ch!r} with the last msg_id {last_channel_ids[src_ch.id]}")
-
-            async with user_client:
-                msg_list = await check_new_channel_messages(src_ch=src_ch, last_channel_ids=last_channel_ids,
-                                                            client=user_client)
-            if msg_list is not None:
-                # time.sleep(randint(5, 10))
-                # logger.debug(f"Found {len(msg_list)} message(s) in '{messages.chats[0].title}' ({src_ch.link})")
-                logger.debug(f"Found {len(msg_list)} message(s) in '{src_ch!r})")
-
-                # TODO: Here recommender system should act and decide to which users send the content
-                for dst_ch in dst_ch_list:
-                    # if dst_ch.id not in [-1001504355267, -1001851389727]:  # my channels
-                    #     continue
-                    user_id = get_channel_owner(dst_ch.id)
-                    messages_checked_list, filtering_details = await select_messages_for_dst_channel(msg_list=msg_list,
-                                                                                                     src_ch=src_ch,
-                                                                                                     dst_ch=dst_ch,
-                                                                                                     recommender=recommender,
-                                                                                                     user_client=user_client,
-                                                                                                     user_id=user_id)
-                    # TODO: add logs after sending about sending time, original and changed message text
-                    await log_messages(
-                        client=user_client,
-                        msg_list_before=msg_list,
-                        filtering_details=filtering_details,
-                        src_channel_id=src_ch.id,
-                        src_channel_link=src_ch.link,
-                        src_channel_name=src_ch.name,
-                        user_channel_id=dst_ch.id,
-                        user_channel_link=dst_ch.link,
-                        user_channel_name=dst_ch.name,
-                        user_id=user_id)
-
-                    # TODO: replace peers to channels to improve visibility
-                    # TODO: pass filtering details which will be renamed to action_details
-                    await group_and_forward_msgs(bot_client=bot_client, src_ch=src_ch, msg_list=messages_checked_list,
-                                                 peer_to_forward_to=dst_ch.id, user_client=user_client)
-
-                # TODO: this increment probably has to be performed anyway even in case of fail
-                last_msg_id = msg_list[0].id
-                last_channel_ids = update_last_channel_ids(src_ch.id, last_msg_id)
-
-                # TODO: probably do this only for my subs.
-                async with user_client:
-                    await user_client.send_read_acknowledge(src_ch.id, msg_list)  # TODO: got flood by ResolveUsernameRequest -> switch to id?
-                    client_me = await client.get_me()
-                    logger.log(8, f"Channel {src_ch.link} is marked as read for me({client_me.id})")
-
-                logger.debug("\n")
-
-        except:
-            # TODO: process if channel doesn't exist. delete and notify
-            logger.error(f"Channel {src_ch} was not processed", exc_info=True)
-
-        # time.sleep(randint(30, 60))
-        time.sleep(2)
+    pushed_channel_ids, catch_up_channel_ids = set(), set()
+    if push_ingest is not None:
+        pushed_channel_ids = await push_ingest.sync_channels({src_ch.id: (src_ch, dst_ch_list)
+                                                              for src_ch, dst_ch_list in src2dst.items()})
+        catch_up_channel_ids = push_ingest.pop_catch_up()
+        logger.log(7, f"{len(pushed_channel_ids)} source channels are delivered via updates, "
+                      f"{len(catch_up_channel_ids)} of them are polled to catch up")
+
+    due_channel_ids = set()
+    if scheduler is not None:
+        scheduler.sync_channels([src_ch.id for src_ch in src2dst if src_ch.id not in pushed_channel_ids])
+        due_channel_ids = set(scheduler.pop_due())
+    src2dst = {src_ch: dst_ch_list for src_ch, dst_ch_list in src2dst.items()
+               if src_ch.id in catch_up_channel_ids
+               or (src_ch.id not in pushed_channel_ids and (scheduler is None or src_ch.id in due_channel_ids))}
+
+    logger.log(7, f"Starting main with {len(src2dst)} source and {len(feeds)} destination channels "
+                  f"({max_concurrent_channels} processed concurrently)")
+
+    semaphore = semaphore or asyncio.Semaphore(max_concurrent_channels)
+
+    async def process_share(client: TelegramClient, governor: RequestGovernor, src_ch_list: List[Channel]):
+        """``client`` only reads the history of the channels. They are processed by ``user_client``"""
+
+        async def poll_src_channel_bounded(src_ch, src_last_channel_ids):
+            async with semaphore:
+                await process_src_channel(src_ch=src_ch, dst_ch_list=src2dst[src_ch],
+                                          last_channel_ids=src_last_channel_ids, user_client=user_client,
+                                          bot_client=bot_client, recommender=recommender, governor=governor,
+                                          max_messages=backfill_caps.get(src_ch.id, BACKFILL_MAX_MESSAGES_PER_PASS),
+                                          fetch_client=client)
+                if src_ch.id in due_channel_ids:
+                    scheduler.record_poll(src_ch.id, last_channel_ids[src_ch.id])
+                # time.sleep(randint(30, 60))
+                await asyncio.sleep(SRC_CHANNEL_DELAY_SEC)
+
+        async def process_src_channel_bounded(src_ch):
+            if src_ch.id in catch_up_channel_ids:
+                # not to process the same posts as the pushed ones. Locked before the semaphore as by them.
+                # The IDs are read again as the pushed posts of the channel may have been processed meanwhile
+                async with push_ingest.get_lock(src_ch.id):
+                    await poll_src_channel_bounded(src_ch, get_last_channel_ids())
+            else:
+                await poll_src_channel_bounded(src_ch, last_channel_ids)
 
+        async with borrow_client(client), borrow_client(user_client):
+            await asyncio.gather(*[process_src_channel_bounded(src_ch) for src_ch in src_ch_list])
 
-async def main_loop(user_client: TelegramClient, bot_client: TelegramClient, recommender):
+    try:
+        if session_pool is None:
+            await process_share(user_client, request_governor, list(src2dst))  # pool of all channels for all users
+        else:
+            await session_pool.check_sessions()
+            session_pool.update_availability()
+            shards = session_pool.shard(src2dst)
+            await asyncio.gather(*[process_share(session_pool.clients[name], session_pool.governors[name], share)
+                                   for name, share in shards.items()])
+    finally:
+        if scheduler is not None:
+            # otherwise the channels whose processing failed or was cancelled would never be polled again
+            scheduler.reschedule_unpolled(due_channel_ids)
+            save_channel_poll_stats(scheduler.get_state())
+
+
+async def process_pushed_messages(route, msg_list: List[Message], user_client: TelegramClient,
+                                  bot_client: TelegramClient, recommender, semaphore: asyncio.Semaphore = None):
+    """``semaphore`` is the one of the polled channels, so pushed posts don't add to their concurrency"""
+    src_ch, dst_ch_list = route
+    async with semaphore or asyncio.Semaphore():  # unbounded without the shared one
+        last_channel_ids = get_last_channel_ids()
+        # the same posts may have been already fetched by a poll, e.g. the catch-up one
+        msg_list = [msg for msg in msg_list if msg.id > last_channel_ids[src_ch.id]]
+        if msg_list:
+            await process_src_channel(src_ch=src_ch, dst_ch_list=dst_ch_list, last_channel_ids=last_channel_ids,
+                                      user_client=user_client, bot_client=bot_client, recommender=recommender,
+                                      msg_list=msg_list)
+
+
+async def main_loop(user_client: TelegramClient, bot_client: TelegramClient, recommender,
+                    max_concurrent_channels=MAX_CONCURRENT_SRC_CHANNELS, adaptive_polling=False, push_ingest=False,
+                    update_source=None, extra_user_clients: Dict[str, TelegramClient] = None):
+    """
+    ``update_source`` overrides the source of updates used by ``push_ingest``, e.g. with a `FakeUpdateSource`
+    to run offline.
+    ``extra_user_clients`` (session name -> user client) enables sharding of the source channels between
+    ``user_client`` and these sessions.
+    """
+    if adaptive_polling:
+        scheduler = PollingScheduler(state=get_channel_poll_stats())
+        last_channel_ids_time = get_last_channel_ids_time()
+        if last_channel_ids_time is not None:  # the rates of the channels without stats are known after one poll
+            scheduler.seed(get_last_channel_ids(), as_of=last_channel_ids_time)
+    else:
+        scheduler = None
+    # shared by the polled channels of user_client and the pushed posts
+    semaphore = asyncio.Semaphore(max_concurrent_channels)
+    if push_ingest:
+        async def handler(route, msg_list):
+            await process_pushed_messages(route, msg_list, user_client=user_client, bot_client=bot_client,
+                                          recommender=recommender, semaphore=semaphore)
+
+        push_ingest = PushIngest(update_source=update_source or TelethonUpdateSource(user_client), handler=handler)
+    else:
+        push_ingest = None
+
+    await user_client.start()  # asks for the phone and the password if the session is not authorized yet
+    # both clients stay connected for the whole life of the process. Also needed to receive updates between passes
+    client_manager.register(user_client)
+    client_manager.register(bot_client)
+    if extra_user_clients:
+        for extra_user_client in extra_user_clients.values():
+            await extra_user_client.start()
+            client_manager.register(extra_user_client)
+        session_pool = SessionPool({PRIMARY_SESSION_NAME: user_client, **extra_user_clients},
+                                   governors={PRIMARY_SESSION_NAME: request_governor})
+        governors = session_pool.governors
+    else:
+        session_pool = None
+        governors = {PRIMARY_SESSION_NAME: request_governor}
+    await client_manager.start()
+    await channel_registry.start()  # the channels restored during the passes are written behind
+    # the cached channels are kept fresh here, never while processing messages
+    channel_refresher = ChannelRefresher(user_client, governor=request_governor)
+    await channel_refresher.start()
     while True:
         try:
-            await main(user_client=user_client, bot_client=bot_client, recommender=recommender)
-            if log_level == 'DEBUG':
+            pass_start = time.monotonic()
+            await main(user_client=user_client, bot_client=bot_client, recommender=recommender,
+                       max_concurrent_channels=max_concurrent_channels, scheduler=scheduler,
+                       push_ingest=push_ingest, session_pool=session_pool, semaphore=semaphore)
+            pass_duration = time.monotonic() - pass_start
+            logger.info(f"Pass over all source channels took {pass_duration:.1f} sec / {pass_duration / 60:.1f} min")
+            logger.info(f"Seen fingerprints: {seen_fingerprints.get_stats()}")
+            for session_name, governor in governors.items():
+                deferrals = governor.get_deferrals()
+                if deferrals:
+                    logger.info(f"{len(deferrals)} request(s) of {session_name} deferred due to flood waits:\n"
+                                + '\n'.join(f'{request_type} for {entity}: {remaining / 60:.1f} min'
+                                             for (request_type, entity), remaining in deferrals.items()))
+            if scheduler is not None:
+                # woken up regularly anyway to pick up the channels added to the feeds in the meantime
+                MAIN_LOOP_DELAY_SEC = min(max(scheduler.seconds_until_next_poll(), ADAPTIVE_LOOP_MIN_DELAY_SEC),
+                                          ADAPTIVE_LOOP_MAX_DELAY_SEC)
+            elif log_level == 'DEBUG':
                 MAIN_LOOP_DELAY_SEC = MAIN_LOOP_DELAY_SEC_DEBUG
             else:
                 MAIN_LOOP_DELAY_SEC = MAIN_LOOP_DELAY_SEC_INFO
@@ -489,7 +806,9 @@ async def main_loop(user_client: TelegramClient, bot_client: TelegramClient, rec
             await asyncio.sleep(MAIN_LOOP_DELAY_SEC)
 
         except KeyboardInterrupt:
-            user_client.disconnect()
+            await channel_refresher.close()
+            await client_manager.close()
+            await channel_registry.close()
             exit()
         except:
             logger.error("While main loop failed", exc_info=True)
@@ -499,6 +818,16 @@ async def main_loop(user_client: TelegramClient, bot_client: TelegramClient, rec
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--log-level', type=str, default='INFO', required=False)
+    parser.add_argument('--max-concurrent-channels', type=int, default=MAX_CONCURRENT_SRC_CHANNELS, required=False,
+                        help='Number of source channels fetched and processed at once')
+    parser.add_argument('--adaptive-polling', action='store_true',
+                        help='Poll each source channel according to its posting rate instead of every '
+                             f'{MAIN_LOOP_DELAY_SEC_INFO} sec')
+    parser.add_argument('--push-ingest', action='store_true',
+                        help='Receive posts of the subscribed source channels as updates instead of polling them')
+    parser.add_argument('--extra-user-sessions', type=str, nargs='*', default=[],
+                        help='Names of additional user session files in src/. Source channels are sharded between '
+                             f'them and {PRIMARY_SESSION_NAME}')
     args = parser.parse_args()
     log_level = args.log_level.upper()
 
@@ -519,10 +848,16 @@ if __name__ == '__main__':
     #     logging.getLogger('telethon').setLevel(logging.ERROR)
     logging.getLogger('telethon').setLevel(logging.ERROR)
 
-    user_client_path = os.path.join(get_project_root(), 'src/telefeed_client')
+    user_client_path = os.path.join(get_project_root(), f'src/{PRIMARY_SESSION_NAME}')
     client = TelegramClient(user_client_path, config.api_id, config.api_hash)
     logger.info(f'{user_client_path} created (not started)')
 
+    extra_user_clients = {}
+    for session_name in args.extra_user_sessions:
+        extra_user_clients[session_name] = TelegramClient(os.path.join(get_project_root(), f'src/{session_name}'),
+                                                          config.api_id, config.api_hash)
+        logger.info(f'{session_name} created (not started)')
+
     # TODO: check if may be used the regular bot client from src.bot import bot_client
     #  the same bot may not be used as it may process sth in the simultaneously working main_bot_cli process
     #  and the process in main_bot_cli should be listening for the updates constantly
@@ -536,4 +871,7 @@ if __name__ == '__main__':
     cb_recommender.load(os.path.join(get_project_root(), 'src/recommender/'))
     logger.info('ContentBasedRecommender is loaded')
 
-    asyncio.run(main_loop(user_client=client, bot_client=forwarding_bot_client, recommender=cb_recommender))
+    asyncio.run(main_loop(user_client=client, bot_client=forwarding_bot_client, recommender=cb_recommender,
+                          max_concurrent_channels=args.max_concurrent_channels,
+                          adaptive_polling=args.adaptive_polling, push_ingest=args.push_ingest,
+                          extra_user_clients=extra_user_clients))
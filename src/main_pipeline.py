@@ -0,0 +1,266 @@
+"""
+Staged alternative to main_feed.py. Fetching, selection (Filter + recommender) and delivery run in separate
+processes connected by durable SQLite queues, so each stage may be scaled and restarted on its own and CPU-heavy
+scoring doesn't delay sends:
+
+    python -m src.main_pipeline --stage ingest
+    python -m src.main_pipeline --stage select --session telefeed_client_select_2
+    python -m src.main_pipeline --stage deliver
+    python -m src.main_pipeline --stage all  # one process per stage
+
+Each process needs its own user session file (copy src/telefeed_client.session to src/<session>.session) as
+a session may not be opened by two processes at once. Do not run main_feed.py at the same time.
+"""
+import asyncio
+import os
+import argparse
+import multiprocessing
+import time
+
+import logging
+
+from typing import List
+
+from telethon import TelegramClient
+from telethon.extensions import BinaryReader
+from telethon.tl.patched import Message
+
+from src.common.get_project_root import get_project_root
+from src.common.client_manager import client_manager, borrow_client
+from src.common.database_utils import (get_last_channel_ids, update_last_channel_ids, get_feeds, log_messages,
+                                       invert_feeds, get_channel_owner, get_channel_backfill_caps)
+from src.common.channel import Channel, resolve_channels, channel_registry
+from src.common.channel_refresher import ChannelRefresher
+from src.common.durable_queue import DurableQueue, DeliveryLog
+from src.common.message_context import BatchContext
+from src.filtering.history_index import history_index
+from src.main_feed import (iter_new_channel_messages, select_messages_for_dst_channel, group_and_forward_msgs,
+                           request_governor, MAIN_LOOP_DELAY_SEC_INFO, MAX_CONCURRENT_SRC_CHANNELS,
+                           SRC_CHANNEL_DELAY_SEC, BACKFILL_MAX_MESSAGES_PER_PASS)
+
+from src import config
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_QUEUE_FILEPATH = 'src/data/pipeline_queue.sqlite'
+FETCHED_QUEUE = 'fetched'  # ingest -> select
+TO_DELIVER_QUEUE = 'to_deliver'  # select -> deliver
+QUEUE_POLL_DELAY_SEC = 5
+STAGES = ('ingest', 'select', 'deliver')
+
+
+def get_queue(name: str) -> DurableQueue:
+    return DurableQueue(os.path.join(get_project_root(), PIPELINE_QUEUE_FILEPATH), name)
+
+
+def get_delivery_log() -> DeliveryLog:
+    return DeliveryLog(os.path.join(get_project_root(), PIPELINE_QUEUE_FILEPATH))
+
+
+async def run_blocking(func, *args):
+    """Runs a blocking call, e.g. of a `DurableQueue`, outside of the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+def serialize_messages(msg_list: List[Message]) -> List[bytes]:
+    # TL serialization instead of pickle as messages hold a reference to the client
+    return [bytes(msg) for msg in msg_list]
+
+
+def deserialize_messages(data: List[bytes], client: TelegramClient) -> List[Message]:
+    msg_list = []
+    for msg_bytes in data:
+        with BinaryReader(msg_bytes) as reader:
+            msg = reader.tgread_object()
+        msg._finish_init(client, {}, None)
+        msg_list.append(msg)
+    return msg_list
+
+
+async def run_ingest(user_client: TelegramClient, max_concurrent_channels=MAX_CONCURRENT_SRC_CHANNELS):
+    fetched_queue = get_queue(FETCHED_QUEUE)
+    while True:
+        last_channel_ids = get_last_channel_ids()
+        backfill_caps = get_channel_backfill_caps()
+        src2dst = await invert_feeds(get_feeds(), user_client)
+        semaphore = asyncio.Semaphore(max_concurrent_channels)
+
+        async def ingest_src_channel(src_ch, dst_ch_list):
+            async with semaphore:
+                try:
+                    # chunk by chunk, so a long backfill is handed over to the next stage without waiting for its end
+                    max_messages = backfill_caps.get(src_ch.id, BACKFILL_MAX_MESSAGES_PER_PASS)
+                    async for msg_list in iter_new_channel_messages(src_ch=src_ch, last_channel_ids=last_channel_ids,
+                                                                    client=user_client, governor=request_governor,
+                                                                    max_messages=max_messages):
+                        await run_blocking(fetched_queue.put, {'src_ch_id': src_ch.id,
+                                                               'dst_ch_ids': [dst_ch.id for dst_ch in dst_ch_list],
+                                                               'messages': serialize_messages(msg_list)})
+                        # the chunk is persisted, so the channel may be moved forward
+                        last_channel_ids[src_ch.id] = msg_list[0].id
+                        update_last_channel_ids(src_ch.id, msg_list[0].id)
+                        await user_client.send_read_acknowledge(src_ch.id, msg_list)
+                        logger.debug(f"Queued {len(msg_list)} message(s) of {src_ch!r}")
+                except:
+                    logger.error(f"Channel {src_ch} was not ingested", exc_info=True)
+                await asyncio.sleep(SRC_CHANNEL_DELAY_SEC)
+
+        pass_start = time.monotonic()
+        async with borrow_client(user_client):
+            await asyncio.gather(*[ingest_src_channel(src_ch, dst_ch_list)
+                                   for src_ch, dst_ch_list in src2dst.items()])
+        logger.info(f"Ingest pass took {time.monotonic() - pass_start:.1f} sec. "
+                    f"{await run_blocking(len, fetched_queue)} batch(es) wait for selection")
+        await asyncio.sleep(MAIN_LOOP_DELAY_SEC_INFO)
+
+
+async def run_select(user_client: TelegramClient, recommender):
+    fetched_queue = get_queue(FETCHED_QUEUE)
+    # the posts are sent by the deliver stage, so they can't be added to the history index of this process
+    delivery_log = get_delivery_log()
+    while True:
+        leased = await run_blocking(fetched_queue.get)
+        if leased is None:
+            await asyncio.sleep(QUEUE_POLL_DELAY_SEC)
+            continue
+
+        item_id, item = leased
+        try:
+            async with borrow_client(user_client):
+                msg_list = deserialize_messages(item['messages'], user_client)
+                src_ch = await Channel.create(channel_id=item['src_ch_id'], client=user_client)
+                batch_context = await BatchContext.build(msg_list, user_client)
+                dst_channels = await resolve_channels([Channel(channel_id=dst_ch_id, client=user_client,
+                                                               restore_values=False)
+                                                       for dst_ch_id in item['dst_ch_ids']], user_client)
+                delivery_times = await run_blocking(delivery_log.get_delivery_times)
+                for dst_ch in dst_channels:
+                    history_index.invalidate_if_older(dst_ch.id, delivery_times.get(dst_ch.id))
+                # a retry after a failure in the middle skips the destinations which were already handed over
+                done_dst_ch_ids = item.setdefault('done_dst_ch_ids', [])
+                for dst_ch in dst_channels:
+                    if dst_ch.id in done_dst_ch_ids:
+                        continue
+                    user_id = get_channel_owner(dst_ch.id)
+                    messages_checked_list, filtering_details = await select_messages_for_dst_channel(
+                        msg_list=msg_list, src_ch=src_ch, dst_ch=dst_ch, recommender=recommender,
+                        user_client=user_client, user_id=user_id, batch_context=batch_context)
+                    await log_messages(client=user_client, msg_list_before=msg_list,
+                                       filtering_details=filtering_details, batch_context=batch_context,
+                                       src_channel_id=src_ch.id, src_channel_link=src_ch.link,
+                                       src_channel_name=src_ch.name, user_channel_id=dst_ch.id,
+                                       user_channel_link=dst_ch.link, user_channel_name=dst_ch.name, user_id=user_id)
+                    done_dst_ch_ids.append(dst_ch.id)
+                    if messages_checked_list:  # handed over together with the progress
+                        await run_blocking(fetched_queue.update, item_id, item, TO_DELIVER_QUEUE,
+                                           {'src_ch_id': src_ch.id, 'dst_ch_id': dst_ch.id,
+                                            'messages': serialize_messages(messages_checked_list)})
+                    else:
+                        await run_blocking(fetched_queue.update, item_id, item)
+            await run_blocking(fetched_queue.ack, item_id)
+        except:
+            logger.error(f"Failed to select messages of {item['src_ch_id']}", exc_info=True)
+            await run_blocking(fetched_queue.nack, item_id)
+
+
+async def run_deliver(user_client: TelegramClient, bot_client: TelegramClient):
+    to_deliver_queue = get_queue(TO_DELIVER_QUEUE)
+    delivery_log = get_delivery_log()
+    while True:
+        leased = await run_blocking(to_deliver_queue.get)
+        if leased is None:
+            await asyncio.sleep(QUEUE_POLL_DELAY_SEC)
+            continue
+
+        item_id, item = leased
+        # a retry after a failure in the middle skips the messages which were already sent
+        sent_msg_ids = item.setdefault('sent_msg_ids', [])
+
+        async def record_sent(sent_msg_list: List[Message]):
+            sent_msg_ids.extend(msg.id for msg in sent_msg_list)
+            await run_blocking(to_deliver_queue.update, item_id, item)
+
+        try:
+            async with borrow_client(user_client):
+                msg_list = [msg for msg in deserialize_messages(item['messages'], user_client)
+                            if msg.id not in sent_msg_ids]
+                src_ch = await Channel.create(channel_id=item['src_ch_id'], client=user_client)
+                await group_and_forward_msgs(bot_client=bot_client, src_ch=src_ch, msg_list=msg_list,
+                                             peer_to_forward_to=item['dst_ch_id'], user_client=user_client,
+                                             on_sent=record_sent)
+            await run_blocking(to_deliver_queue.ack, item_id)
+        except:
+            logger.error(f"Failed to deliver messages of {item['src_ch_id']} to {item['dst_ch_id']}", exc_info=True)
+            await run_blocking(to_deliver_queue.nack, item_id)
+        finally:  # a failed delivery may have sent a part of the messages as well
+            await run_blocking(delivery_log.record, item['dst_ch_id'])
+
+
+async def run_stage(stage: str, session: str, max_concurrent_channels=MAX_CONCURRENT_SRC_CHANNELS):
+    user_client = TelegramClient(os.path.join(get_project_root(), f'src/{session}'), config.api_id, config.api_hash)
+    await user_client.start()
+    client_manager.register(user_client)
+    await channel_registry.start()
+
+    if stage == 'ingest':
+        await client_manager.start()
+        # one stage keeps the cached channels fresh for all of them
+        await ChannelRefresher(user_client, governor=request_governor).start()
+        await run_ingest(user_client, max_concurrent_channels=max_concurrent_channels)
+    elif stage == 'select':
+        from src.recommender.recommender import ContentBasedRecommender
+
+        cb_recommender = ContentBasedRecommender()
+        cb_recommender.load(os.path.join(get_project_root(), 'src/recommender/'))
+        logger.info('ContentBasedRecommender is loaded')
+        await client_manager.start()
+        await run_select(user_client, recommender=cb_recommender)
+    elif stage == 'deliver':
+        bot_client = TelegramClient(os.path.join(get_project_root(), f'src/bot_for_feed_{config.bot_id}'),
+                                    config.api_id, config.api_hash)
+        await bot_client.start(bot_token=config.bot_token)
+        client_manager.register(bot_client)
+        await client_manager.start()
+        await run_deliver(user_client, bot_client)
+    else:
+        raise ValueError(f"Unknown stage '{stage}'. Expected one of {STAGES}")
+
+
+def start_stage_process(stage: str, session: str, log_level: str, max_concurrent_channels):
+    configure_logging(log_level)
+    asyncio.run(run_stage(stage, session, max_concurrent_channels=max_concurrent_channels))
+
+
+def configure_logging(log_level: str):
+    logging.basicConfig(
+        format='%(asctime)s %(processName)s %(module)s %(levelname)s: %(message)s',
+        level=logging.DEBUG,
+        datefmt='%a %d.%m.%Y %H:%M:%S',
+        force=True)
+    logging.getLogger('src').setLevel(log_level)
+    logging.getLogger('__main__').setLevel(log_level)
+    logging.getLogger('telethon').setLevel(logging.ERROR)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stage', type=str, choices=STAGES + ('all',), required=True)
+    parser.add_argument('--session', type=str, default=None, required=False,
+                        help="User session file name in src/. Default: 'telefeed_client_<stage>'")
+    parser.add_argument('--log-level', type=str, default='INFO', required=False)
+    parser.add_argument('--max-concurrent-channels', type=int, default=MAX_CONCURRENT_SRC_CHANNELS, required=False)
+    args = parser.parse_args()
+    log_level = args.log_level.upper()
+
+    if args.stage == 'all':
+        processes = [multiprocessing.Process(target=start_stage_process, name=stage,
+                                             args=(stage, f'telefeed_client_{stage}', log_level,
+                                                   args.max_concurrent_channels))
+                     for stage in STAGES]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    else:
+        start_stage_process(args.stage, args.session or f'telefeed_client_{args.stage}', log_level,
+                            args.max_concurrent_channels)